@@ -0,0 +1,49 @@
+'''
+Benchmark of the compiled inference model against the sklearn pipeline it was exported from:
+checks that the probabilities are identical on a sample of the data and reports the median
+latency of predict for small inputs, the realtime case. Run from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_compiled_model.py --model registry/trained_pipeline_v1.pkl
+'''
+from components.bq_connector import BatchFetcher
+from components.preprocessor import Preprocessor
+from components.utils.compiled_model import compile_pipeline
+from components.utils.model_io import load_artifact
+import argparse
+import time
+import numpy as np
+
+def median_latency_ms(predict, inputs: list) -> float:
+    predict(inputs[0])
+    latencies = []
+    for X in inputs:
+        start_time = time.perf_counter()
+        predict(X)
+        latencies.append(time.perf_counter() - start_time)
+    return float(np.median(latencies)) * 1e3
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="registry/trained_pipeline_v1.pkl")
+    parser.add_argument("--check-rows", type=int, default=20_000, help="Rows whose probabilities are compared.")
+    parser.add_argument("--calls", type=int, default=200, help="Calls timed per input size.")
+    args = parser.parse_args()
+
+    model = load_artifact(args.model)
+    start_time = time.perf_counter()
+    compiled_model = compile_pipeline(model)
+    print(f"Compiled in {time.perf_counter() - start_time:.2f}s: {compiled_model.n_features} features, "
+          f"{len(compiled_model.forest.feature)} nodes in {len(compiled_model.forest.roots)} trees\n")
+
+    data = Preprocessor().transform(BatchFetcher(mode="training").load_data())
+    X = data.drop(columns=["target_category"]).sample(frac=1, random_state=42)
+    X_check = X.head(args.check_rows)
+    identical = np.array_equal(model.predict_proba(X_check), compiled_model.predict_proba(X_check))
+    print(f"Identical probabilities on {len(X_check)} rows: {identical}\n")
+
+    print(f"{'rows':>5} {'pipeline (ms)':>14} {'compiled (ms)':>14} {'speedup':>8}")
+    for rows in (1, 4, 16, 64):
+        inputs = [X.iloc[i * rows:(i + 1) * rows] for i in range(args.calls)]
+        pipeline_ms = median_latency_ms(model.predict, inputs)
+        compiled_ms = median_latency_ms(compiled_model.predict, inputs)
+        print(f"{rows:>5} {pipeline_ms:>14.2f} {compiled_ms:>14.2f} {pipeline_ms / compiled_ms:>7.1f}x")
@@ -0,0 +1,62 @@
+'''
+Micro-benchmark of the feature builders against their previous row-wise implementations
+(Series.apply with list membership and nested np.where). Run from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_feature_functions.py --rows 1000000
+'''
+from components.bq_connector import BatchFetcher
+from components.utils.feature_functions import classify_transactions, compress_low_frequency_categories
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+LOW_FREQ = ['Pets & Pet Care', 'Travel', 'Insurance', 'Transportation', 'Health & Wellness',
+            'Entertainment', 'Education', 'Childcare & Parenting']
+
+def legacy_classify_transactions(X: pd.DataFrame) -> pd.DataFrame:
+    X['transactionType'] = np.where(
+        (X['withdrawal_amt'] > 0) & pd.isnull(X['deposit_amt']), 'withdrawal',
+        np.where(pd.isnull(X['withdrawal_amt']) & (X['deposit_amt'] > 0), 'deposit',
+        np.where(pd.isnull(X['withdrawal_amt']) & pd.isnull(X['deposit_amt']), 'no transaction', 'both')
+        )
+    )
+    return X
+
+def legacy_compress_low_frequency_categories(X: pd.DataFrame) -> pd.DataFrame:
+    classes = X['category'].value_counts().index.tolist()
+    not_low_freq = [x for x in classes if x not in LOW_FREQ]
+    X['target_category'] = X['category'].apply(lambda x: 'others' if x not in not_low_freq else x)
+    X.drop('category', axis=1, inplace=True)
+    return X
+
+def timed(fn, X: pd.DataFrame, repeat: int) -> tuple:
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        X_copy = X.copy()
+        start_time = time.perf_counter()
+        result = fn(X_copy)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    raw_data = BatchFetcher(mode="training").load_data()
+    X = raw_data.sample(n=args.rows, replace=True, random_state=42).reset_index(drop=True)
+    print(f"Rows: {len(X)}\n")
+
+    benchmarks = [
+        ("classify_transactions", legacy_classify_transactions, classify_transactions, "transactionType"),
+        ("compress_low_frequency_categories", legacy_compress_low_frequency_categories,
+         compress_low_frequency_categories, "target_category"),
+    ]
+    print(f"{'function':<36} {'legacy (s)':>11} {'vectorized (s)':>15} {'speedup':>8}")
+    for name, legacy_fn, vectorized_fn, output_col in benchmarks:
+        legacy_time, legacy_result = timed(legacy_fn, X, args.repeat)
+        vectorized_time, vectorized_result = timed(vectorized_fn, X, args.repeat)
+        assert (legacy_result[output_col].to_numpy() == vectorized_result[output_col].to_numpy()).all()
+        print(f"{name:<36} {legacy_time:>11.3f} {vectorized_time:>15.3f} {legacy_time / vectorized_time:>7.1f}x")
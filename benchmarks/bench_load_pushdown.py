@@ -0,0 +1,65 @@
+'''
+Benchmark of the projection and filter pushdown of BatchFetcher.load_data: times a full read of
+an inference table against reads of the model columns only and of a date range of them. The
+training data is replicated and written clustered by date like the out of sample table, so the
+date filters skip row groups through their statistics. Run from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_load_pushdown.py --copies 5
+'''
+from components.bq_connector import BatchFetcher, write_clustered_parquet
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+def best_of(load, repeats: int) -> tuple:
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        data = load()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings), data
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=5, help="Times the training data is replicated.")
+    parser.add_argument("--repeats", type=int, default=5, help="Reads timed per case, the best is reported.")
+    args = parser.parse_args()
+
+    raw_data = BatchFetcher(mode="training").load_data()
+    data = pd.concat([raw_data] * args.copies, ignore_index=True)
+    suffix = pd.Series(np.arange(len(data)) // len(raw_data), dtype=str)
+    data["transaction_details"] = data["transaction_details"] + suffix.where(data["transaction_details"].notna())
+    columns = [col for col in data.columns if col != "chq_no"]
+    last_day = data["date"].max()
+    del raw_data
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # BatchFetcher reads from <cwd>/data
+        os.makedirs(os.path.join(tmp_dir, "data"))
+        write_clustered_parquet(data, os.path.join(tmp_dir, "data", "input.parquet"))
+        del data
+        os.chdir(tmp_dir)
+        try:
+            batchFetcher = BatchFetcher(mode="training", file_path="input.parquet")
+            metadata = pq.read_metadata("data/input.parquet")
+            print(f"{metadata.num_rows} rows in {metadata.num_row_groups} row groups\n")
+
+            cases = [
+                ("all columns", dict()),
+                ("model columns", dict(columns=columns)),
+                ("last 30 days", dict(columns=columns, since=last_day - pd.Timedelta(days=30))),
+                ("last day", dict(columns=columns, since=last_day - pd.Timedelta(days=1))),
+            ]
+            print(f"{'read':<15} {'rows':>8} {'seconds':>8} {'vs full':>8}")
+            full_time = None
+            for name, kwargs in cases:
+                seconds, loaded = best_of(lambda: batchFetcher.load_data(**kwargs), args.repeats)
+                full_time = full_time or seconds
+                print(f"{name:<15} {len(loaded):>8} {seconds:>8.3f} {seconds / full_time:>7.0%}")
+        finally:
+            os.chdir(cwd)
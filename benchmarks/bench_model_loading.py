@@ -0,0 +1,60 @@
+'''
+Benchmark of the model loading: plain pickle vs the memory-mapped registry artifact. Each
+load runs in a fresh process with sklearn already imported, and reports the load time and the
+memory it added (RSS, and the anonymous part of it, which is what each extra worker really
+costs: file-backed mapped pages are shared between processes through the page cache). Run
+from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_model_loading.py --model registry/trained_pipeline_v1.pkl
+'''
+from components.utils.model_io import save_artifact, load_artifact
+import argparse
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+
+def memory_mb() -> tuple:
+    # linux only
+    with open("/proc/self/smaps_rollup") as f:
+        fields = dict(line.split(":", 1) for line in f.read().splitlines()[1:])
+    kb = lambda name: int(fields[name].split()[0])
+    return kb("Rss") / 1024, kb("Anonymous") / 1024
+
+def load(loader: str, path: str, queue) -> None:
+    rss_before, anonymous_before = memory_mb()
+    start_time = time.perf_counter()
+    if loader == "pickle":
+        with open(path, "rb") as f:
+            model = pickle.load(f)
+    else:
+        model = load_artifact(path, memory_map=loader == "artifact (mmap)")
+    elapsed = time.perf_counter() - start_time
+    rss_after, anonymous_after = memory_mb()
+    queue.put((elapsed, rss_after - rss_before, anonymous_after - anonymous_before))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="registry/trained_pipeline_v1.pkl")
+    args = parser.parse_args()
+
+    model = load_artifact(args.model)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, "model.pickle")
+        artifact_path = os.path.join(tmp_dir, "model.pkl")
+        with open(pickle_path, "wb") as f:
+            pickle.dump(model, f)
+        save_artifact(model, artifact_path)
+        del model
+        print(f"pickle: {os.path.getsize(pickle_path) / 1e6:.1f} MB, artifact: {os.path.getsize(artifact_path) / 1e6:.1f} MB\n")
+
+        context = multiprocessing.get_context("spawn")
+        print(f"{'loader':<16} {'load (s)':>9} {'+rss (MB)':>10} {'+anonymous (MB)':>16}")
+        for loader, path in (("pickle", pickle_path), ("artifact (read)", artifact_path), ("artifact (mmap)", artifact_path)):
+            queue = context.Queue()
+            process = context.Process(target=load, args=(loader, path, queue))
+            process.start()
+            elapsed, rss, anonymous = queue.get()
+            process.join()
+            print(f"{loader:<16} {elapsed:>9.3f} {rss:>10.1f} {anonymous:>16.1f}")
@@ -0,0 +1,59 @@
+'''
+Memory benchmark of the preprocessing: reports the peak memory of every stage of
+Preprocessor.transform above the memory held by the input, and the peak relative to the input.
+The training data is replicated (with distinct transaction details, so nothing is dropped as a
+duplicate) and read back from Parquet like BatchFetcher does. Every mode is run in a fresh
+process, so the measures don't include memory left by the other one. Run from the root of the
+repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_preprocessing_memory.py --copies 5
+'''
+from components.bq_connector import BatchFetcher, arrow_to_pandas
+from components.preprocessor import Preprocessor
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+def write_input(path: str, copies: int) -> None:
+    raw_data = BatchFetcher(mode="training").load_data()
+    data = pd.concat([raw_data] * copies, ignore_index=True)
+    suffix = pd.Series(np.arange(len(data)) // len(raw_data), dtype=str)
+    data["transaction_details"] = data["transaction_details"] + suffix.where(data["transaction_details"].notna())
+    data.to_parquet(path)
+
+def run(path: str, inplace: bool) -> None:
+    outsample_path = os.path.join(os.path.dirname(path), "outsample.parquet")
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor(mode="training", outsample_path=outsample_path, track_memory=True)
+    raw_data = arrow_to_pandas(pq.read_table(path))
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor.preprocess(raw_data, inplace=inplace)
+    report = preprocessor.memory_report
+    print(f"\n{'inplace' if inplace else 'copy'} ({len(raw_data)} rows):")
+    for stage in report["stages"]:
+        print(f"  {stage['stage']:<20} peak {stage['peak_mb']:>7.1f} MB  retained {stage['retained_mb']:>7.1f} MB")
+    print(f"  input {report['input_mb']:.1f} MB, peak {report['peak_to_input']:.2f}x the input")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=5, help="Times the training data is replicated.")
+    parser.add_argument("--input", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--inplace", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.input is not None:
+        run(args.input, args.inplace)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "input.parquet")
+        write_input(path, args.copies)
+        for mode in ([], ["--inplace"]):
+            subprocess.run([sys.executable, __file__, "--input", path, *mode], check=True)
@@ -0,0 +1,48 @@
+'''
+Benchmark of the sharded batch inference: rows/sec vs. number of worker processes.
+Requires a trained model in the registry. Run from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_sharded_inference.py --rows 200000
+'''
+from components.bq_connector import BatchFetcher
+from pipelines.inference_pipeline import run_sharded_inference
+import argparse
+import os
+import time
+import pandas as pd
+
+def build_input(n_rows: int) -> pd.DataFrame:
+    '''
+    Replicates the out of sample data up to n_rows. Each replica gets a small balance offset
+    so rows are not dropped as duplicates.
+    '''
+    raw_data = BatchFetcher().load_data()
+    replicas = []
+    for i in range(n_rows // len(raw_data) + 1):
+        replica = raw_data.copy()
+        replica["balance_amt"] = replica["balance_amt"] + i * 0.01
+        replicas.append(replica)
+    return pd.concat(replicas, ignore_index=True).head(n_rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=None,
+                        help="Worker counts to benchmark. Defaults to powers of two up to the CPU count.")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    workers = args.workers or sorted({1, *[2 ** i for i in range(1, cpus.bit_length()) if 2 ** i <= cpus], cpus})
+    raw_data = build_input(args.rows)
+
+    results = []
+    for n_workers in workers:
+        start_time = time.perf_counter()
+        run_sharded_inference(raw_data, n_workers=n_workers)
+        results.append((n_workers, time.perf_counter() - start_time))
+
+    # timings include spawning the workers and loading the model once per worker
+    print(f"\nRows: {len(raw_data)} | CPUs: {cpus}\n")
+    print(f"{'workers':>8} {'seconds':>10} {'rows/sec':>12} {'speedup':>8}")
+    for n_workers, elapsed_time in results:
+        print(f"{n_workers:>8} {elapsed_time:>10.2f} {len(raw_data) / elapsed_time:>12.0f} {results[0][1] / elapsed_time:>7.2f}x")
@@ -0,0 +1,61 @@
+'''
+Benchmark of the staged streaming inference: runs the streaming inference over the training
+data replicated (as the inference input) with the stages run one after the other
+(--prefetch 0) and concurrently, and prints the wall time and the utilization of every stage.
+Needs a trained model in the registry. Run from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_staged_inference.py --copies 3 --chunk-size 20000
+'''
+from components.bq_connector import BatchFetcher
+from components.classifier import ClassificationPipeline
+from components.preprocessor import Preprocessor
+from pipelines.inference_pipeline import run_streaming_inference
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=3, help="Times the training data is replicated.")
+    parser.add_argument("--chunk-size", type=int, default=20_000, help="Rows per chunk.")
+    parser.add_argument("--prefetch", type=int, default=2, help="Chunks queued between the stages.")
+    args = parser.parse_args()
+
+    raw_data = BatchFetcher(mode="training").load_data()
+    data = pd.concat([raw_data] * args.copies, ignore_index=True)
+    suffix = pd.Series(np.arange(len(data)) // len(raw_data), dtype=str)
+    data["transaction_details"] = data["transaction_details"] + suffix.where(data["transaction_details"].notna())
+    del raw_data
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # BatchFetcher reads from <cwd>/data and the model from <cwd>/registry
+        os.makedirs(os.path.join(tmp_dir, "data"))
+        data.to_parquet(os.path.join(tmp_dir, "data", "input.parquet"))
+        os.symlink(os.path.join(cwd, "registry"), os.path.join(tmp_dir, "registry"))
+        print(f"{len(data)} rows in chunks of {args.chunk_size}\n")
+        del data
+
+        os.chdir(tmp_dir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                batchFetcher = BatchFetcher(out_sample_path="input.parquet")
+                predictor = ClassificationPipeline()
+            for prefetch in (0, args.prefetch):
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    preprocessor = Preprocessor()
+                    start_time = time.perf_counter()
+                    run_streaming_inference(batchFetcher, preprocessor, predictor, args.chunk_size, prefetch=prefetch)
+                    elapsed = time.perf_counter() - start_time
+                print(f"prefetch {prefetch}: {elapsed:.2f}s")
+                if prefetch:
+                    lines = output.getvalue().splitlines()
+                    start = next(i for i, line in enumerate(lines) if line.startswith("- Pipeline stages"))
+                    print("\n".join(lines[start:start + 6]))
+        finally:
+            os.chdir(cwd)
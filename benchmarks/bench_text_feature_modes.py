@@ -0,0 +1,79 @@
+'''
+Side by side comparison of the text feature modes of the model ('tfidf' vs 'hashing', with
+and without idf): test accuracy, size of the text stage and of the whole artifact, load time
+and predict latency. Every mode is trained on the same split with the same forest seed. Run
+from the root of the repository (the whole parquet takes a few minutes per mode):
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_text_feature_modes.py --rows 30000
+'''
+from components.bq_connector import BatchFetcher
+from components.classifier import ClassificationPipeline
+from components.preprocessor import Preprocessor
+from components.utils.model_io import save_artifact, load_artifact
+from sklearn.metrics import accuracy_score
+import argparse
+import contextlib
+import io
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+
+MODES = [
+    ("tfidf", dict(text_features="tfidf")),
+    ("hashing + idf", dict(text_features="hashing", hashing_idf=True)),
+    ("hashing", dict(text_features="hashing", hashing_idf=False)),
+]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=None, help="Training rows. Default is the whole parquet.")
+    parser.add_argument("--n-features", type=int, default=2**14, help="Hashed columns.")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        raw_data = BatchFetcher(mode="training").load_data()
+        if args.rows is not None:
+            raw_data = raw_data.sample(n=args.rows, random_state=42)
+        data = Preprocessor(mode="inference").transform(raw_data, drop_duplicates=True)
+    print(f"Rows: {len(data)}\n")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, params in MODES:
+            with contextlib.redirect_stdout(io.StringIO()):
+                trainer = ClassificationPipeline(mode="training", hashing_n_features=args.n_features, **params)
+                X_train, X_test, y_train, y_test = trainer.tt_split(data)
+                model = trainer.create_model_pipeline()
+                model.set_params(classifier__random_state=42)
+
+            start_time = time.perf_counter()
+            model.fit(X_train, np.array(y_train))
+            fit_time = time.perf_counter() - start_time
+
+            text_stage = model.named_steps["preprocessor"].named_transformers_["text_features"]
+            text_size = len(pickle.dumps(text_stage))
+            artifact_path = os.path.join(tmp_dir, f"{name}.pkl")
+            artifact_size = save_artifact(model, artifact_path)
+            start_time = time.perf_counter()
+            model = load_artifact(artifact_path)
+            load_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            y_pred = model.predict(X_test)
+            batch_time = time.perf_counter() - start_time
+            single_times = []
+            for i in range(50):
+                start_time = time.perf_counter()
+                model.predict(X_test.iloc[[i]])
+                single_times.append(time.perf_counter() - start_time)
+
+            rows.append((name, accuracy_score(y_test, y_pred), text_size / 1e6, artifact_size / 1e6,
+                         fit_time, load_time, batch_time / len(X_test) * 1e6, np.median(single_times) * 1e3))
+
+    print(f"{'mode':<14} {'accuracy':>9} {'text (MB)':>10} {'model (MB)':>11} {'fit (s)':>8} "
+          f"{'load (s)':>9} {'batch (us/row)':>15} {'single (ms)':>12}")
+    for row in rows:
+        print(f"{row[0]:<14} {row[1]:>9.4f} {row[2]:>10.2f} {row[3]:>11.1f} {row[4]:>8.1f} "
+              f"{row[5]:>9.3f} {row[6]:>15.1f} {row[7]:>12.2f}")
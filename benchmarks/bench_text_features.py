@@ -0,0 +1,45 @@
+'''
+Micro-benchmark of the TF-IDF stage of the model over transaction_details: the plain
+TfidfVectorizer vs CachedTfidfVectorizer deduplicating the strings of the batch, and with its
+cross-batch cache warm. Run from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_text_features.py --rows 1000000
+'''
+from components.bq_connector import BatchFetcher
+from components.utils.text_features import CachedTfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer
+import argparse
+import time
+
+def timed(fn, repeat: int) -> tuple:
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=None, help="Rows sampled with replacement. Default is the whole parquet.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    details = BatchFetcher(mode="training").load_data()["transaction_details"].dropna()
+    if args.rows is not None:
+        details = details.sample(n=args.rows, replace=True, random_state=42)
+    details = details.reset_index(drop=True)
+    print(f"Rows: {len(details)}, distinct strings: {details.nunique()}\n")
+
+    vectorizer = TfidfVectorizer().fit(details)
+    deduplicated = CachedTfidfVectorizer(vectorizer).fit(details)
+    cached = CachedTfidfVectorizer(vectorizer, cache_size=len(details)).fit(details)
+    cached.transform(details)
+
+    plain_time, expected = timed(lambda: vectorizer.transform(details), args.repeat)
+    print(f"{'vectorizer':<28} {'time (s)':>9} {'speedup':>8}")
+    print(f"{'TfidfVectorizer':<28} {plain_time:>9.3f} {1:>7.1f}x")
+    for name, transformer in (("deduplicated", deduplicated), ("deduplicated + warm cache", cached)):
+        elapsed, result = timed(lambda: transformer.transform(details), args.repeat)
+        assert (result != expected).nnz == 0
+        print(f"{name:<28} {elapsed:>9.3f} {plain_time / elapsed:>7.1f}x")
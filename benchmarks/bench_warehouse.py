@@ -0,0 +1,53 @@
+'''
+Benchmark of the SQLite warehouse stand-in: rows/second of the bulk insert, of a full streaming
+read in Arrow batches and of a read filtered to the last 30 days (through the date index),
+next to the same reads from Parquet. Run from the root of the repository:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_warehouse.py --copies 2
+'''
+from components.bq_connector import BatchFetcher
+from components.warehouse import connect
+import argparse
+import os
+import tempfile
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+def timed(function) -> tuple:
+    start_time = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start_time, result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=2, help="Times the training data is replicated.")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="Rows per streamed batch.")
+    args = parser.parse_args()
+
+    raw_data = BatchFetcher(mode="training").load_data()
+    table = pa.Table.from_pandas(pd.concat([raw_data] * args.copies, ignore_index=True), preserve_index=False)
+    since = pd.Timestamp(raw_data["date"].max()) - pd.Timedelta(days=30)
+    del raw_data
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parquet_path = os.path.join(tmp_dir, "input.parquet")
+        pq.write_table(table, parquet_path)
+        with connect(f"sqlite:///{os.path.join(tmp_dir, 'warehouse.db')}") as connector:
+            seconds, _ = timed(lambda: connector.write_batches("input", table.to_batches(max_chunksize=args.batch_size)))
+            connector.create_index("input", ["date"])
+            print(f"{table.num_rows} rows, bulk insert: {table.num_rows / seconds:,.0f} rows/s\n")
+
+            filters = [("date", ">", since)]
+            cases = [
+                ("full read", lambda: connector.read_batches("input", batch_size=args.batch_size),
+                 lambda: pq.ParquetFile(parquet_path).iter_batches(batch_size=args.batch_size)),
+                ("last 30 days", lambda: connector.read_batches("input", filters=filters, batch_size=args.batch_size),
+                 lambda: pq.read_table(parquet_path, filters=filters).to_batches()),
+            ]
+            print(f"{'read':<14} {'rows':>8} {'sqlite rows/s':>14} {'parquet rows/s':>15}")
+            for name, read_sqlite, read_parquet in cases:
+                sqlite_seconds, rows = timed(lambda: sum(batch.num_rows for batch in read_sqlite()))
+                parquet_seconds, _ = timed(lambda: sum(batch.num_rows for batch in read_parquet()))
+                print(f"{name:<14} {rows:>8} {rows / sqlite_seconds:>14,.0f} {rows / parquet_seconds:>15,.0f}")
@@ -0,0 +1,141 @@
+'''
+This file contains the micro-batching request coalescer used by the realtime endpoint.
+Concurrent single-row requests are gathered for a short window and predicted with one
+vectorized call, which amortizes the per-call overhead of the sklearn pipeline.
+'''
+import asyncio
+import time
+from typing import Any, Callable, Optional
+from concurrent.futures import Executor
+from .utils.metrics import Histogram
+
+
+class MicroBatcher:
+    def __init__(
+            self,
+            predict_fn: Callable[[list], list],
+            max_batch_size: int = 64,
+            max_wait_ms: float = 2.0,
+            executor: Optional[Executor] = None,
+        ):
+        """
+        Initialize the MicroBatcher.
+
+        Parameters:
+            predict_fn (Callable): Function receiving a list of items and returning a list
+                of predictions of the same length and order.
+            max_batch_size (int): Maximum number of items predicted in a single call.
+            max_wait_ms (float): Maximum time the first item of a batch waits for others.
+            executor (Executor): Executor where predict_fn runs, so the event loop is never
+                blocked. Defaults to the loop's default executor.
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.batch_size_histogram = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.queue_wait_histogram = Histogram([0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250])
+        self._queue = None
+        self._task = None
+
+    async def start(self) -> None:
+        """
+        Starts the background task that consumes the queue. Must be called from the event loop.
+        """
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the background task. Pending requests are cancelled.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            future.cancel()
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Enqueues a single item and waits for its prediction.
+
+        Parameters:
+            item (Any): A single input for predict_fn.
+
+        Returns:
+            Any: The prediction for the item.
+        """
+        if self._task is None:
+            raise RuntimeError("MicroBatcher was not started.")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+
+    def stats(self) -> dict:
+        """
+        Returns the batch-size and queue-wait (ms) histograms.
+        """
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batch_size": self.batch_size_histogram.snapshot(),
+            "queue_wait_ms": self.queue_wait_histogram.snapshot(),
+        }
+
+    async def _collect_batch(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # drain whatever is already queued before waiting for stragglers
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # callers that gave up (e.g. client disconnected) don't need a prediction
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                continue
+
+            dispatched_at = time.perf_counter()
+            self.batch_size_histogram.observe(len(batch))
+            for _, _, enqueued_at in batch:
+                self.queue_wait_histogram.observe((dispatched_at - enqueued_at) * 1000)
+
+            items = [item for item, _, _ in batch]
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.predict_fn, items)
+            except asyncio.CancelledError:
+                for _, future, _ in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future, _), prediction in zip(batch, predictions):
+                if not future.done():
+                    future.set_result(prediction)
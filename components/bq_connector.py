@@ -1,11 +1,90 @@
 '''
 This file simulates batch data loading from BigQuery (or any other warehouse) for 
 demonstration purposes. The data is loaded from a parquet file and returned as a 
-data frame in this file.
+data frame in this file. Given a warehouse url, the tables are read from and written to a
+warehouse connector instead (see warehouse.py).
 '''
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-from datetime import datetime
+import time
+import pyarrow.dataset as ds
+from typing import Iterable, Iterator, Optional
+from .sinks import Sink, WarehouseSink, create_sink
+from .warehouse import connect
+from .utils.metrics import METRICS
+from .registry import file_sha256, get_registry
+
+READ_SECONDS = METRICS.histogram("batch_fetcher_read_seconds", "Time reading and decoding an input table, or a chunk of it when streaming.")
+ROWS_READ = METRICS.counter("batch_fetcher_rows_read_total", "Rows read from the input tables.")
+
+# strings are read as Arrow strings, with NaN as missing value (pandas 3's default 'str' dtype)
+try:
+    ARROW_STRING = pd.StringDtype("pyarrow", na_value=np.nan)
+except TypeError:
+    ARROW_STRING = pd.StringDtype("pyarrow_numpy")
+
+def arrow_to_pandas(data) -> pd.DataFrame:
+    """
+    Converts an Arrow table or record batch to pandas without an intermediate copy: string
+    columns keep their Arrow buffers, and the other columns are released from the Arrow
+    data as soon as they are converted, so the peak is not input + output.
+    """
+    string_types = {pa.string(): ARROW_STRING, pa.large_string(): ARROW_STRING}
+    return data.to_pandas(types_mapper=string_types.get, split_blocks=True, self_destruct=True)
+
+# rows per row group of the tables written clustered by date: the min/max statistics of every
+# row group then cover a narrow date range, and reads filtered by date skip the others
+ROW_GROUP_SIZE = 10_000
+
+def write_clustered_parquet(df: pd.DataFrame, path: str, cluster_by: str = "date", row_group_size: int = ROW_GROUP_SIZE) -> None:
+    """
+    Writes a DataFrame as parquet sorted by cluster_by, in row groups of row_group_size rows,
+    so the filters of BatchFetcher.load_data on that column are pushed down to the row
+    group statistics. The index is not written, readers get a default one. The sort order is
+    recorded in the row group metadata (see BatchFetcher.sorted_by).
+    """
+    sorting_columns = None
+    if cluster_by in df.columns:
+        df = df.sort_values(cluster_by, kind="stable")
+        sorting_columns = [pq.SortingColumn(list(df.columns).index(cluster_by))]
+    df.to_parquet(path, index=False, row_group_size=row_group_size, sorting_columns=sorting_columns)
+
+def build_filters(
+        date_col: str = "date",
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        account_ids: Optional[list] = None,
+        since_inclusive: bool = False,
+    ) -> Optional[list]:
+    """
+    Builds the pyarrow filters of a read (conjunction of (column, op, value) tuples).
+
+    params
+        date_col: Column the date range applies to.
+        since: Only rows with date_col after it (exclusive, unless since_inclusive).
+        until: Only rows with date_col before it (exclusive).
+        account_ids: Only rows of these accounts. The raw table stores the ids quoted
+            ("'409000362497'"), ids are matched with or without the quotes.
+
+    returns:
+        List of filters, or None if no filter is given.
+    """
+    filters = []
+    if since is not None:
+        filters.append((date_col, ">=" if since_inclusive else ">", pd.Timestamp(since)))
+    if until is not None:
+        filters.append((date_col, "<", pd.Timestamp(until)))
+    if account_ids is not None:
+        ids = [str(account_id).strip("'") for account_id in account_ids]
+        filters.append(("account_id", "in", ids + [f"'{account_id}'" for account_id in ids]))
+    return filters or None
+
+def _warn_no_accounts(table_name: str, account_ids: list) -> None:
+    # an empty selection is a valid result, but a mistyped id would look like one
+    print(f"Warning: the account filter selected no rows of {table_name} (account ids: {', '.join(map(str, account_ids))}).")
 
 class BatchFetcher:
     def __init__(
@@ -13,36 +92,210 @@ class BatchFetcher:
             mode: str = "inference",
             file_path: str = "bank_transactions.parquet", 
             out_sample_path: str = "bank_transactions_outsample.parquet",
+            output_format: str = "parquet",
+            model_version: Optional[int] = None,
+            warehouse: Optional[str] = None,
         ):
         """
         Initialize the BatchFetcher with the path to the parquet file.
 
         params
+            mode: 'inference' reads the out of sample table, projected by default to the
+                columns of the model. Otherwise the training table is read.
             file_path: Path to the parquet file.
+            output_format: Format of the output tables, 'parquet' (default) or 'csv' (legacy).
+            model_version: Version of the model in the registry whose raw features are read
+                in 'inference' mode. Default is the production model.
+            warehouse: Url of a warehouse (e.g. 'sqlite:///data/warehouse.db'). If given, the
+                table named like the parquet file (without extension) is read from it,
+                and the output tables are written to it. A table missing from the warehouse
+                is loaded from the parquet file first.
         """
+        self.mode = mode
         if mode == "inference":
             self.file_path = out_sample_path
         else:
             self.file_path = file_path
+        self.output_format = output_format
+        self.model_version = model_version
+        self.table_name = os.path.splitext(os.path.basename(self.file_path))[0]
+        self.connector = connect(warehouse) if warehouse is not None else None
+        if self.connector is not None and not self.connector.table_exists(self.table_name):
+            print(f"Loading {self.file_path} into the warehouse table {self.table_name}...")
+            self.connector.import_parquet(f"{os.getcwd()}/data/{self.file_path}", self.table_name)
+            if "date" in self.connector.schema(self.table_name).names:
+                self.connector.create_index(self.table_name, ["date"])
+
+    def sorted_by(self, column: str) -> bool:
+        """
+        Whether load_data and iter_batches return the rows sorted by column, i.e. the parquet
+        file was written by write_clustered_parquet on that column. Warehouse reads have no
+        guaranteed order.
+        """
+        if self.connector is not None:
+            return False
+        metadata = pq.ParquetFile(f"{os.getcwd()}/data/{self.file_path}").metadata
+        for i in range(metadata.num_row_groups):
+            sorting_columns = metadata.row_group(i).sorting_columns
+            if (not sorting_columns or sorting_columns[0].descending
+                    or metadata.schema.column(sorting_columns[0].column_index).name != column):
+                return False
+        return metadata.num_row_groups > 0
+
+    def model_columns(self) -> Optional[list]:
+        """
+        Columns of the source table used by the registered model: its raw features, plus the
+        label if the table has it (kept with the predictions). Columns the preprocessing drops
+        (like chq_no) are not read.
 
-    def load_data(self) -> pd.DataFrame:
+        returns:
+            List of columns in table order, or None (all columns) if the model has no raw
+            features recorded.
         """
-        Load data from the parquet file.
+        entry = get_registry().get(self.model_version)
+        raw_features = entry.get("raw_features") if entry else None
+        if not raw_features:
+            return None
+        if self.connector is not None:
+            schema = self.connector.schema(self.table_name)
+        else:
+            schema = pq.read_schema(f"{os.getcwd()}/data/{self.file_path}")
+        return [col for col in schema.names if col in raw_features or col == "category"]
+
+    def _default_columns(self, columns: Optional[list]) -> Optional[list]:
+        if columns is not None or self.mode != "inference":
+            return columns
+        return self.model_columns()
+
+    def load_data(
+            self,
+            since: Optional[str] = None,
+            date_col: str = "date",
+            columns: Optional[list] = None,
+            until: Optional[str] = None,
+            account_ids: Optional[list] = None,
+            since_inclusive: bool = False,
+        ) -> pd.DataFrame:
+        """
+        Load data from the parquet file (or the warehouse table). Columns and filters are pushed
+        down to the parquet reader: only the requested columns are decoded, and row groups
+        whose statistics don't match the filters are skipped. In the warehouse they are part
+        of the query.
+
+        params
+            since: If given, only the transactions with date_col after it are loaded (e.g. the
+                data watermark of the last registered model).
+            date_col: Column compared against since and until.
+            columns: Columns to read. In 'inference' mode the default are the columns of the
+                model (see model_columns), otherwise all of them.
+            until: If given, only the transactions with date_col before it are loaded.
+            account_ids: If given, only the transactions of these accounts are loaded.
+            since_inclusive: Also load the transactions dated exactly since.
 
         returns:
             DataFrame containing the loaded data, or None if an error occurs.
         """
         try:
             cwd = os.getcwd()
-            data = pd.read_parquet(f"{cwd}/data/{self.file_path}")
+            start_time = time.perf_counter()
+            filters = build_filters(date_col, since=since, until=until, account_ids=account_ids, since_inclusive=since_inclusive)
+            if self.connector is not None:
+                table = self.connector.read_table(self.table_name, self._default_columns(columns), filters)
+            else:
+                table = pq.read_table(f"{cwd}/data/{self.file_path}", columns=self._default_columns(columns), filters=filters)
+            data = arrow_to_pandas(table)
+            READ_SECONDS.labels(table=self.table_name, mode="batch").observe(time.perf_counter() - start_time)
+            ROWS_READ.labels(table=self.table_name).inc(len(data))
+            if account_ids is not None and data.empty:
+                _warn_no_accounts(self.table_name, account_ids)
             return data
         except Exception as e:
             print(f"Error loading data: {e}")
             return None
     
+    def fingerprint(self) -> str:
+        """
+        Hash of the content of the source table (simulated: of the parquet file), changes
+        whenever its data changes.
+        """
+        cwd = os.getcwd()
+        return file_sha256(f"{cwd}/data/{self.file_path}")
+
+    def iter_batches(
+            self,
+            chunk_size: int = 50_000,
+            columns: Optional[list] = None,
+            since: Optional[str] = None,
+            until: Optional[str] = None,
+            account_ids: Optional[list] = None,
+            date_col: str = "date",
+        ) -> Iterator[pd.DataFrame]:
+        """
+        Stream data from the parquet file in chunks, so memory does not scale with the
+        size of the input. Columns and filters are pushed down like in load_data.
+
+        params
+            chunk_size: Maximum number of rows per chunk.
+            columns, since, until, account_ids, date_col: See load_data.
+
+        returns:
+            Iterator of DataFrames with at most chunk_size rows each.
+        """
+        filters = build_filters(date_col, since=since, until=until, account_ids=account_ids)
+        if self.connector is not None:
+            # streamed from a cursor on the warehouse
+            batches = self.connector.read_batches(self.table_name, self._default_columns(columns), filters, batch_size=chunk_size)
+        else:
+            cwd = os.getcwd()
+            dataset = ds.dataset(f"{cwd}/data/{self.file_path}", format="parquet")
+            batches = dataset.to_batches(
+                columns=self._default_columns(columns),
+                filter=pq.filters_to_expression(filters) if filters else None,
+                batch_size=chunk_size,
+            )
+        return self._timed_chunks(batches, account_ids)
+
+    def _timed_chunks(self, batches: Iterable, account_ids: Optional[list] = None) -> Iterator[pd.DataFrame]:
+        # only the time spent producing a chunk is observed, not the time the consumer holds it
+        iterator = iter(batches)
+        rows = 0
+        while True:
+            start_time = time.perf_counter()
+            batch = next(iterator, None)
+            if batch is None:
+                if account_ids is not None and rows == 0:
+                    _warn_no_accounts(self.table_name, account_ids)
+                return
+            # filtered row groups yield empty batches
+            if not batch.num_rows:
+                continue
+            chunk = arrow_to_pandas(batch)
+            rows += len(chunk)
+            READ_SECONDS.labels(table=self.table_name, mode="stream").observe(time.perf_counter() - start_time)
+            ROWS_READ.labels(table=self.table_name).inc(len(chunk))
+            yield chunk
+
+    def open_sink(self, table_name: str) -> Sink:
+        """
+        Open a BigQuery table for incremental writes. (simulated: it will instead write into
+        parquet or csv files at /outputs dir). The run is published when the sink is closed.
+
+        params
+            table_name: Name of the table to write to.
+
+        returns:
+            Sink receiving the DataFrames of the run through write().
+        """
+        if self.connector is not None:
+            print(f"Opening warehouse table {table_name} ({self.connector.url})...")
+            return WarehouseSink(table_name, self.connector)
+        print(f"Opening BigQuery table {table_name} ({self.output_format})...")
+        return create_sink(self.output_format, table_name)
+
     def write_to_bq(self, df: pd.DataFrame, table_name: str):
         """
-        Write data to a BigQuery table. (simulated: it will instead write into a csv at /outputs dir)
+        Write data to a BigQuery table. (simulated: it will instead write into parquet or csv
+        files at /outputs dir)
 
         params
             df: DataFrame containing the data to write.
@@ -51,7 +304,7 @@ class BatchFetcher:
         try:
             # write data to BigQuery
             print(f"Writing data to BigQuery table {table_name}...")
-            now = datetime.now()
-            df.to_csv(f"outputs/{table_name}.csv", index=False)
+            with self.open_sink(table_name) as sink:
+                sink.write(df)
         except Exception as e:
             print(f"Error writing data to BigQuery: {e}")
\ No newline at end of file
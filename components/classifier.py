@@ -1,22 +1,44 @@
 import pandas as pd
-import pickle
-from typing import Any, Union
+from typing import Any, Optional, Union
 import os
+import time
 import numpy as np
+import scipy.sparse as sp
 from sklearn.pipeline import Pipeline
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
-from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import accuracy_score
 from sklearn.impute import SimpleImputer
 from sklearn.model_selection import train_test_split
-from sklearn.model_selection import cross_val_score
-from sklearn.metrics import classification_report
+from sklearn.metrics import accuracy_score
+from .utils.model_io import save_artifact, load_artifact
+from .registry import get_registry
+from .prediction_cache import PredictionCache
+from .utils.text_features import cache_text_features, make_text_vectorizer
+from .training_engine import TrainingEngine
+from .utils.compiled_model import compile_pipeline
+from .utils.metrics import METRICS
+
+LOAD_SECONDS = METRICS.histogram("model_load_seconds", "Time loading a model artifact from the registry.")
+PREDICT_SECONDS = METRICS.histogram("model_predict_seconds", "Time of a predict call, by model path (compiled or pipeline).")
+PREDICTED_ROWS = METRICS.counter("model_predicted_rows_total", "Rows predicted by the loaded models.")
 
 
 class ClassificationPipeline:
-    def __init__(self, weights_path: str = "latest", mode: str = "inference"):
+    def __init__(
+            self,
+            weights_path: str = "latest",
+            mode: str = "inference",
+            memory_map: bool = True,
+            version: Optional[int] = None,
+            prediction_cache: Optional[PredictionCache] = None,
+            text_cache_size: int = 0,
+            text_features: str = "tfidf",
+            hashing_n_features: int = 2**14,
+            hashing_idf: bool = True,
+            compiled: bool = False,
+            compiled_max_rows: int = 16,
+        ):
         """
         Initialize the ClassificationPipeline.
 
@@ -24,33 +46,52 @@ class ClassificationPipeline:
             weights_path (str): Path to a SPECIFIC model weights file. if not specified, 
                 it will default to the latest version
             mode (str): Mode of operation, either 'inference' or other. Default is 'inference'.
+            memory_map (bool): Memory-map the model arrays instead of reading them into private
+                memory. Default is True.
+            version (int): Registry version of the model to load. If not specified, the
+                production model is loaded.
+            prediction_cache (PredictionCache): If given, predictions of rows already seen
+                by this model are looked up instead of recomputed.
+            text_cache_size (int): Number of transaction_details strings whose TF-IDF rows are
+                cached between predict calls. Default is 0 (only deduplicated within a call).
+            text_features (str): Text feature mode of the models trained by this component:
+                'tfidf' (default, fitted vocabulary) or 'hashing' (fixed number of hashed
+                columns, so memory and model size don't grow with the corpus).
+            hashing_n_features (int): Number of hashed columns in 'hashing' mode.
+            hashing_idf (bool): Weight the hashed counts with idf in 'hashing' mode.
+            compiled (bool): Also load the compiled inference model exported with the registry
+                version, used for small inputs (lower per call overhead, same predictions).
+            compiled_max_rows (int): Largest input predicted with the compiled model, the
+                sklearn pipeline is faster on bigger batches.
         """
         print("\n====================================")
         print("Starting Classifier Pipeline Component")
         print("====================================\n")
         self.weights_path = weights_path
         self.mode = mode
+        self.memory_map = memory_map
+        self.registry = get_registry()
+        self.version = version
+        self.prediction_cache = prediction_cache
+        self.text_cache_size = text_cache_size
+        self.text_features = text_features
+        self.hashing_n_features = hashing_n_features
+        self.hashing_idf = hashing_idf
+        self.compiled = compiled
+        self.compiled_max_rows = compiled_max_rows
+        self.compiled_model = None
         if self.mode == "inference":
             self.model = self.load_model()
 
         print("- Weights at:", self.weights_path)
+        print("- Version:", self.version)
         print("- Mode:", self.mode)
+        if self.mode == "training":
+            print("- Text features:", self.text_features)
 
-    def get_latest_version_from_registry(self):
-        print("Current working directory:", os.getcwd())
-        cwd = os.getcwd()
-        files = os.listdir(f"{cwd}/registry")
-        files = [file for file in files if ".pkl" in file]
-        
-        suffixes = [f.split('_v')[-1] for f in files]
-        suffixes = [s.split('.')[0] for s in suffixes]
-
-        print("Model versions in weights directory:", suffixes)
-        try:
-            latest_version = max([int(s) for s in suffixes])
-        except Exception as e:
-            latest_version = 0
-
+    def get_latest_version_from_registry(self) -> int:
+        latest_version = self.registry.latest_version() or 0
+        print("Latest model version in registry:", latest_version)
         return latest_version
 
     def load_model(self) -> Union[Any, None]:
@@ -61,16 +102,27 @@ class ClassificationPipeline:
             model (Any): The loaded model object, or None if loading fails.
         """
         try:
-            # simulate getting latest versions from "model registry"
-            latest_version = self.get_latest_version_from_registry()
             cwd = os.getcwd()
+            start_time = time.perf_counter()
             if self.weights_path != "latest":
                 # load a specific model version
-                model = pickle.load(open(f"{cwd}/registry/{self.weights_path}", 'rb'))
+                model = load_artifact(f"{cwd}/registry/{self.weights_path}", memory_map=self.memory_map)
             else:
-                # default: load latest version
-                model = pickle.load(open(f"{cwd}/registry/trained_pipeline_v{latest_version}.pkl", 'rb'))
+                # default: load the requested version, or the model promoted to production
+                # in the "model registry"
+                entry = self.registry.get(self.version)
+                if entry is None:
+                    raise FileNotFoundError(f"Model version {self.version or 'in production'} not found in the registry.")
+                model = load_artifact(f"{cwd}/registry/{entry['artifact']}", memory_map=self.memory_map)
+                self.version = entry["version"]
+                if self.compiled and entry.get("compiled_artifact"):
+                    self.compiled_model = load_artifact(f"{cwd}/registry/{entry['compiled_artifact']}", memory_map=self.memory_map)
 
+            # models trained before the cached vectorizer get it without retraining
+            model = cache_text_features(model, cache_size=self.text_cache_size)
+            LOAD_SECONDS.labels(version=self.version if self.version is not None else self.weights_path).observe(
+                time.perf_counter() - start_time
+            )
             return model
         except Exception as e:
             print("Error loading model:", e)
@@ -87,7 +139,7 @@ class ClassificationPipeline:
             Any: Prediction results or an error message if not in inference mode.
         """
         if self.mode == "inference":
-            return self.model.predict(X)
+            return self.predict(X)
         else:
             return "Can't perform realtime inference if not in inference mode."
 
@@ -102,9 +154,34 @@ class ClassificationPipeline:
             pd.DataFrame: Prediction results or an error message if not in inference mode.
         """
         if self.mode == "inference":
-            return self.model.predict(X)
+            return self.predict(X)
         else:
             return "Can't perform batch inference if not in inference mode."
+
+    def predict(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Predicts with the loaded model, through the prediction cache if there is one.
+
+        Parameters:
+            X (pd.DataFrame): Input data for prediction.
+
+        Returns:
+            np.ndarray: The predicted categories.
+        """
+        start_time = time.perf_counter()
+        predict_fn, model_path = self.model.predict, "pipeline"
+        if self.compiled_model is not None and len(X) <= self.compiled_max_rows:
+            predict_fn, model_path = self.compiled_model.predict, "compiled"
+        if self.prediction_cache is None:
+            predictions = predict_fn(X)
+        else:
+            # only the columns the model was trained on are part of the cache key
+            columns = list(getattr(self.model, "feature_names_in_", X.columns))
+            model_version = self.version if self.version is not None else self.weights_path
+            predictions = self.prediction_cache.predict(predict_fn, X, model_version, columns=columns)
+        PREDICT_SECONDS.labels(path=model_path).observe(time.perf_counter() - start_time)
+        PREDICTED_ROWS.labels(path=model_path).inc(len(X))
+        return predictions
     
     def create_model_pipeline(self):
         """
@@ -114,7 +191,7 @@ class ClassificationPipeline:
         """
         preprocessor = ColumnTransformer(
             transformers=[
-                ('text_features', TfidfVectorizer(), 'transaction_details'), 
+                ('text_features', make_text_vectorizer(self.text_features, self.hashing_n_features, self.hashing_idf), 'transaction_details'), 
                 ('numerical_features', Pipeline(
                     [
                         ('imputer', SimpleImputer(strategy='constant', fill_value=0)),
@@ -146,6 +223,7 @@ class ClassificationPipeline:
             data: pd.DataFrame,
             test_size: float = 0.2,
             target_col: str = "target_category",
+            stratify: bool = True,
         ):
         
         X = data.drop(columns=[target_col])
@@ -154,78 +232,110 @@ class ClassificationPipeline:
         print("\n- Model Features after split:", X.columns.to_list())
         print("\n- Target column after split:", target_col)
 
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=42, stratify=y)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=42, stratify=y if stratify else None)
         
         return X_train, X_test, y_train, y_test
     
-    def report_cross_val_score(
-            self,
-            model: Pipeline, 
-            X_train: pd.DataFrame,
-            y_train: pd.Series,
-            report_metric: str = "accuracy"
-            ) -> None:
-        cv_scores = cross_val_score(model, X_train, y_train, cv=5, scoring=report_metric)
-        cv_mean = np.mean(cv_scores)
-        cv_std = np.std(cv_scores)
-
-        print("\n====================================")
-        print("Cross Validation Score")
-        print("====================================\n")
-        print(f"Mean CV Score ({report_metric}): {cv_mean}")
-        print(f"Std CV Score ({report_metric}): {cv_std}")
-        
-    def report_classification_test_score(
+    def save_model_to_registry(
             self,
             model: Pipeline,
-            X_test: pd.DataFrame,
-            y_test: pd.Series,
             X_train: pd.DataFrame,
-            y_train: pd.Series,
-        )-> None:
-        print("\n> Reporting classification metrics on the Test Set")
-        y_pred_train = model.predict(X_train)
-        y_pred_test = model.predict(X_test)
-
-        # Report train and test accuracy to have an idea of potencial Overfitting
-        print("\n====================================")
-        print(f"Train Accuracy: {accuracy_score(y_train, y_pred_train)}")
-        print(f"Test Accuracy: {accuracy_score(y_test, y_pred_test)}")
-        print("====================================\n")
-
-        # Report classification metrics on the test set
-        report = classification_report(y_test, y_pred_test)
-        print("==================================================================")
-        print("                        Test Set Clasiffication Report")
-        print("==================================================================\n")
-        print(report)
-
-    def save_model_to_registry(self, model: Pipeline, X_train: pd.DataFrame) -> None:
+            raw_features: Optional[list] = None,
+            metrics: Optional[dict] = None,
+            data_watermark: Optional[str] = None,
+            parent_version: Optional[int] = None,
+            watermark_row_hashes: Optional[list] = None,
+            promote: bool = True,
+        ) -> None:
         """
-        Save the model to the "model registry" (a local directory for this toy project).
+        Save the model to the "model registry" (a local directory for this toy project) and
+        record it in the registry index, along with its features and metrics, as the
+        production model unless promote is False.
 
         Parameters:
             model (Pipeline): The model to save.
+            X_train (pd.DataFrame): Training data, its columns are the model features.
+            raw_features (list): Raw input columns expected by the preprocessing.
+            metrics (dict): Evaluation metrics of the model.
+            data_watermark (str): Date of the most recent transaction the model was trained on.
+            parent_version (int): Version the model was incrementally retrained from.
+            watermark_row_hashes (list): Row hashes of the transactions at the data watermark.
+            promote (bool): Make the model the production model.
         """
         try:
             cwd = os.getcwd()
-            latest_version = self.get_latest_version_from_registry()
-            new_version = latest_version + 1
-            pickle.dump(model, open(f"{cwd}/registry/trained_pipeline_v{new_version}.pkl", 'wb'))
-            print(f"Model saved to {cwd}/registry/trained_pipeline_v{new_version}.pkl")
-            
-            # TODO: Apply versioning to model features as well
-            pd.DataFrame(X_train.columns.tolist()).to_csv(f"registry/model_features.csv", index= False, header=False)
+            new_version = self.registry.reserve_version()
+            artifact_path = f"{cwd}/registry/trained_pipeline_v{new_version}.pkl"
+            artifact_size = save_artifact(model, artifact_path)
+            print(f"Model saved to {artifact_path} ({artifact_size / 1e6:.1f} MB)")
+            compiled_path = self.export_compiled_model(model, f"{cwd}/registry/compiled_pipeline_v{new_version}.pkl", X_train)
+
+            self.registry.register(
+                artifact_path,
+                version=new_version,
+                features=X_train.columns.tolist(),
+                raw_features=raw_features,
+                metrics=metrics,
+                data_watermark=data_watermark,
+                parent_version=parent_version,
+                compiled_artifact=compiled_path,
+                watermark_row_hashes=watermark_row_hashes,
+                promote=promote,
+            )
+            print(f"Model version {new_version} registered" + (" and promoted to production" if promote else ", not promoted"))
         except Exception as e:
             print("Error saving model:", e)
 
-    def train_classifier(self, raw_data: pd.DataFrame, report_cv_score: bool = False) -> Any:
+    def export_compiled_model(self, model: Pipeline, path: str, X_check: pd.DataFrame, check_rows: int = 1000) -> Optional[str]:
+        """
+        Exports the compact inference representation of the model (see compiled_model.py),
+        after checking that its probabilities are identical to the pipeline's on a sample.
+
+        Parameters:
+            model (Pipeline): The fitted model.
+            path (str): Path of the compiled artifact.
+            X_check (pd.DataFrame): Data the compiled predictions are checked on.
+            check_rows (int): Number of rows of X_check used for the check.
+
+        Returns:
+            str: The path of the compiled artifact, or None if the model can't be compiled.
+        """
+        try:
+            compiled_model = compile_pipeline(model)
+            X_check = X_check.head(check_rows)
+            if not np.array_equal(compiled_model.predict_proba(X_check), model.predict_proba(X_check)):
+                raise ValueError("the compiled probabilities differ from the pipeline's.")
+            compiled_size = save_artifact(compiled_model, path)
+            print(f"Compiled model saved to {path} ({compiled_size / 1e6:.1f} MB)")
+            return path
+        except Exception as e:
+            print("Model not compiled:", e)
+            return None
+
+    def train_classifier(
+            self,
+            raw_data: pd.DataFrame,
+            report_cv_score: bool = False,
+            raw_features: Optional[list] = None,
+            search: bool = False,
+            n_jobs: int = -1,
+            data_watermark: Optional[str] = None,
+            watermark_row_hashes: Optional[list] = None,
+        ) -> Any:
         """
         Train the classifier on the input data.
 
         Parameters:
             raw_data (pd.DataFrame): Data from which training and testing splits will
                 be created from.
+            report_cv_score (bool): Cross validate the model (folds fitted in parallel).
+            raw_features (list): Raw input columns of the preprocessing, saved with the model.
+            search (bool): Search the forest hyperparameters with successive halving.
+            n_jobs (int): Processes used for the folds and the search. -1 uses all cores.
+            data_watermark (str): Date of the most recent transaction in raw_data, recorded in
+                the registry as the starting point of the next incremental retraining.
+            watermark_row_hashes (list): Row hashes of the raw transactions dated at
+                data_watermark, skipped by the next incremental retraining.
         Returns:
             Any: Training results or an error message if not in training mode.
         """
@@ -235,32 +345,138 @@ class ClassificationPipeline:
             print("====================================\n")
 
             # create the model bluepring and split the data
-            model_pipeline = self.create_model_pipeline()
-            X_train, X_test, y_train, y_test = self.tt_split(raw_data)
-            y_train = np.array(y_train)
-            y_test = np.array(y_test.values)
+            engine = TrainingEngine(n_jobs=n_jobs, cv=5 if report_cv_score or search else 0, search=search)
+            with engine.stage("split"):
+                model_pipeline = self.create_model_pipeline()
+                X_train, X_test, y_train, y_test = self.tt_split(raw_data)
+                y_train = np.array(y_train)
+                y_test = np.array(y_test.values)
 
-            # train the model
-            model_pipeline.fit(X_train, y_train)
+            # search / cross validate, train the model and evaluate it on the test set
+            model_pipeline, metrics = engine.run(model_pipeline, X_train, y_train, X_test, y_test)
 
-            # report cross val score
-            if report_cv_score:
-                self.report_cross_val_score(model=model_pipeline, X_train=X_train, y_train=y_train)
-            
-            # evaluate the model on the test set and report metrics.
-            self.report_classification_test_score(
-                model=model_pipeline,
-                X_test=X_test,
-                y_test=y_test,
-                X_train=X_train,
-                y_train=y_train,
-            )
             # re train on all data
 
             # TODO for production only. for now, we are keeping the simpler 
             # training version since we are going to predict on test.
             
             # Save the model weights in the "registry" (a local dir for this toy project)
-            self.save_model_to_registry(model_pipeline, X_train=X_train)
+            with engine.stage("save"):
+                self.save_model_to_registry(model_pipeline, X_train=X_train, raw_features=raw_features,
+                                            metrics=metrics, data_watermark=data_watermark,
+                                            watermark_row_hashes=watermark_row_hashes)
+            engine.report_timings()
+        else:
+            return "Can't train model if not in training mode."
+
+    def warm_start_fit(self, model: Pipeline, X: pd.DataFrame, y: np.ndarray, n_new_estimators: int) -> Pipeline:
+        """
+        Adds n_new_estimators trees to the fitted forest of the model, fitted only on X. The
+        fitted preprocessing is kept as is, so the new trees see the same feature space as
+        the old ones.
+
+        Parameters:
+            model (Pipeline): The fitted model pipeline, modified in place.
+            X (pd.DataFrame): New training data.
+            y (np.ndarray): Labels of the new training data.
+            n_new_estimators (int): Number of trees to add.
+
+        Returns:
+            Pipeline: The same model, with the new trees.
+        """
+        forest = model.named_steps["classifier"]
+        unseen_classes = np.setdiff1d(y, forest.classes_)
+        if len(unseen_classes):
+            raise ValueError(f"Categories not seen by the model: {list(unseen_classes)}. A full retraining is needed.")
+
+        X_transformed = model.named_steps["preprocessor"].transform(X)
+        # the forest recomputes its classes on every fit, the classes missing from the batch
+        # get a zero weight placeholder row so the new trees output the same classes
+        missing_classes = np.setdiff1d(forest.classes_, y)
+        if sp.issparse(X_transformed):
+            X_transformed = sp.vstack([X_transformed, sp.csr_matrix((len(missing_classes), X_transformed.shape[1]))], format="csr")
+        else:
+            X_transformed = np.vstack([X_transformed, np.zeros((len(missing_classes), X_transformed.shape[1]))])
+        y = np.concatenate([y, missing_classes])
+        sample_weight = np.concatenate([np.ones(len(X)), np.zeros(len(missing_classes))])
+
+        forest.set_params(warm_start=True, n_estimators=len(forest.estimators_) + n_new_estimators)
+        forest.fit(X_transformed, y, sample_weight=sample_weight)
+        forest.set_params(warm_start=False)
+        return model
+
+    def retrain_incremental(
+            self,
+            raw_data: pd.DataFrame,
+            base_version: Optional[int] = None,
+            n_new_estimators: int = 20,
+            raw_features: Optional[list] = None,
+            data_watermark: Optional[str] = None,
+            watermark_row_hashes: Optional[list] = None,
+        ) -> Any:
+        """
+        Retrains a registered model on the new transactions only: the forest is warm started
+        with n_new_estimators trees fitted on raw_data, so the cost depends on the size of the
+        new data and not on the whole history. The result is registered as a new version, and
+        only promoted to production if its test accuracy on the new transactions is not below
+        the base model's.
+
+        Parameters:
+            raw_data (pd.DataFrame): Preprocessed transactions after the data watermark of the
+                base model. 20% of them are kept to evaluate the retrained model.
+            base_version (int): Registry version to retrain. Default is the production model.
+            n_new_estimators (int): Number of trees added to the forest.
+            raw_features (list): Raw input columns of the preprocessing, saved with the model.
+            data_watermark (str): Date of the most recent transaction in raw_data.
+            watermark_row_hashes (list): Row hashes of the raw transactions dated at
+                data_watermark.
+        Returns:
+            Any: Training results or an error message if not in training mode.
+        """
+        if self.mode == "training":
+            print("\n====================================")
+            print("Starting Incremental Model Training")
+            print("====================================\n")
+
+            engine = TrainingEngine(cv=0)
+            with engine.stage("load"):
+                entry = self.registry.get(base_version)
+                if entry is None:
+                    raise FileNotFoundError(f"Model version {base_version or 'in production'} not found in the registry.")
+                model_pipeline = load_artifact(f"{os.getcwd()}/registry/{entry['artifact']}", memory_map=False)
+                print(f"- Base model version: {entry['version']} ({len(model_pipeline.named_steps['classifier'].estimators_)} trees)")
+
+            with engine.stage("split"):
+                # the new batch can be too small to stratify every category
+                X_train, X_test, y_train, y_test = self.tt_split(raw_data, stratify=False)
+                y_train = np.array(y_train)
+                y_test = np.array(y_test.values)
+
+            with engine.stage("base_evaluation"):
+                # the forest is extended in place, the base model is scored first
+                base_accuracy = accuracy_score(y_test, model_pipeline.predict(X_test))
+            with engine.stage("fit"):
+                self.warm_start_fit(model_pipeline, X_train, y_train, n_new_estimators)
+            metrics = engine.evaluate(model_pipeline, X_train, y_train, X_test, y_test)
+            metrics.update({
+                "base_version": entry["version"], "base_test_accuracy": base_accuracy,
+                "new_rows": len(raw_data), "stage_seconds": dict(engine.timings),
+            })
+            promote = metrics["test_accuracy"] >= base_accuracy
+            if not promote:
+                print(f"- Test accuracy {metrics['test_accuracy']:.4f} below the base model's {base_accuracy:.4f}, not promoting")
+
+            with engine.stage("save"):
+                self.save_model_to_registry(
+                    model_pipeline,
+                    X_train=X_train,
+                    raw_features=raw_features or entry.get("raw_features"),
+                    metrics=metrics,
+                    data_watermark=data_watermark,
+                    parent_version=entry["version"],
+                    watermark_row_hashes=watermark_row_hashes,
+                    promote=promote,
+                )
+            engine.report_timings()
         else:
-            return "Can't train model if not in training mode."
\ No newline at end of file
+            return "Can't train model if not in training mode."
@@ -0,0 +1,128 @@
+'''
+This file contains the cache of preprocessed training features. An entry is addressed by the
+hash of the raw data, the source of the preprocessing code and the feature config, and the
+preprocessor parameters, so training runs on unchanged inputs read the features from Parquet
+instead of loading and preprocessing the raw data again. Changing any of them produces a new
+key, stale entries are never reused.
+'''
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Optional
+import pandas as pd
+from .registry import file_sha256
+
+# files whose content defines the output of Preprocessor.preprocess
+PREPROCESSING_SOURCES = (
+    "components/preprocessor.py",
+    "components/utils/qa_functions.py",
+    "components/utils/feature_functions.py",
+    "components/utils/date_functions.py",
+    "config/feature_config.json",
+)
+
+
+def preprocessing_fingerprint(sources: tuple = PREPROCESSING_SOURCES) -> str:
+    """
+    Hash of the preprocessing code and config, relative to the repository root.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    for source in sources:
+        digest.update(source.encode())
+        digest.update(file_sha256(os.path.join(root, source)).encode())
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    def __init__(self, base_dir: str = "data/feature_cache", max_entries: int = 4):
+        """
+        Initialize the FeatureCache.
+
+        params
+            base_dir: Directory of the cache, one subdirectory per entry.
+            max_entries: Number of entries kept, the least recently used are deleted first.
+        """
+        self.base_dir = base_dir
+        self.max_entries = max_entries
+
+    def key(self, data_fingerprint: str, params: Optional[dict] = None) -> str:
+        """
+        Content address of the features of a raw dataset.
+
+        params
+            data_fingerprint: Hash of the raw data (see BatchFetcher.fingerprint).
+            params: Preprocessor parameters that change its output.
+
+        returns:
+            The key of the entry.
+        """
+        payload = json.dumps({
+            "data": data_fingerprint,
+            "code": preprocessing_fingerprint(),
+            "params": params or {},
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+    def load(self, key: str) -> Optional[tuple]:
+        """
+        Reads an entry.
+
+        returns:
+            Tuple with the features DataFrame and the metadata saved with it, or None if the
+            entry doesn't exist.
+        """
+        entry_dir = os.path.join(self.base_dir, key)
+        try:
+            with open(os.path.join(entry_dir, "metadata.json")) as f:
+                metadata = json.load(f)
+            features = pd.read_parquet(os.path.join(entry_dir, "features.parquet"))
+        except FileNotFoundError:
+            return None
+        # the modification time of the entry tracks its last use, for eviction
+        os.utime(entry_dir)
+        metadata["files"] = {name: os.path.join(entry_dir, file) for name, file in metadata.get("files", {}).items()}
+        return features, metadata
+
+    def save(self, key: str, features: pd.DataFrame, metadata: Optional[dict] = None, files: Optional[dict] = None) -> None:
+        """
+        Writes an entry. It is written in a temporary directory and renamed, so readers
+        never see a half written entry.
+
+        params
+            key: Key of the entry.
+            features: The preprocessed DataFrame.
+            metadata: JSON serializable data saved with the features (raw features, QA
+                report, ...).
+            files: Extra files copied into the entry, by name (e.g. the out of sample data
+                written by the preprocessing). load returns their paths in metadata['files'].
+        """
+        entry_dir = os.path.join(self.base_dir, key)
+        tmp_dir = os.path.join(self.base_dir, f".{key}.{uuid.uuid4().hex}.tmp")
+        os.makedirs(tmp_dir)
+        try:
+            features.to_parquet(os.path.join(tmp_dir, "features.parquet"), compression="zstd")
+            copied = {}
+            for name, path in (files or {}).items():
+                copied[name] = f"{name}{os.path.splitext(path)[1]}"
+                shutil.copyfile(path, os.path.join(tmp_dir, copied[name]))
+            with open(os.path.join(tmp_dir, "metadata.json"), "w") as f:
+                json.dump({**(metadata or {}), "files": copied, "created_at": time.time()}, f, indent=2)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.replace(tmp_dir, entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = [
+            os.path.join(self.base_dir, name) for name in os.listdir(self.base_dir)
+            if not name.startswith(".")
+        ]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry_dir in entries[self.max_entries:]:
+            shutil.rmtree(entry_dir, ignore_errors=True)
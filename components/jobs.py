@@ -0,0 +1,200 @@
+'''
+This file contains the job manager used by the server to run CPU-bound work (training and
+batch inference) outside of the server process, so a RandomForest fit never competes for
+the GIL with request handling. It also owns the thread pool used for realtime predictions.
+'''
+import multiprocessing
+import threading
+import time
+import uuid
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+from typing import Any, Callable, Optional
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+def _run_job(target: Callable, args: tuple, kwargs: dict) -> None:
+    """
+    Entrypoint of the job processes. Pipelines signal failure by returning False or None,
+    which is translated into a non zero exit code.
+    """
+    result = target(*args, **kwargs)
+    sys.exit(0 if result is not None and result is not False else 1)
+
+
+class Job:
+    def __init__(self, name: str, target: Callable, args: tuple, kwargs: dict):
+        """
+        A unit of work executed in its own process.
+
+        Parameters:
+            name (str): Human readable name of the job (e.g. 'training').
+            target (Callable): Module level function to run. Must be picklable.
+            args (tuple): Positional arguments for target.
+            kwargs (dict): Keyword arguments for target.
+        """
+        self.job_id = uuid.uuid4().hex
+        self.name = name
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.exit_code = None
+        self.process = None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "name": self.name,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "exit_code": self.exit_code,
+        }
+
+
+class JobManager:
+    def __init__(self, max_workers: int = 1, predict_workers: int = 4, max_finished_jobs: int = 100):
+        """
+        Initialize the JobManager.
+
+        Parameters:
+            max_workers (int): Maximum number of job processes running at the same time.
+                Jobs submitted beyond that are queued.
+            predict_workers (int): Size of the thread pool used for realtime predictions.
+            max_finished_jobs (int): Number of finished jobs kept for status queries.
+        """
+        self.max_workers = max_workers
+        self.max_finished_jobs = max_finished_jobs
+        self.predict_executor = ThreadPoolExecutor(max_workers=predict_workers, thread_name_prefix="predict")
+        # spawn instead of fork: the server process holds threads and an event loop
+        self._context = multiprocessing.get_context("spawn")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._monitor = None
+
+    def start(self) -> None:
+        """
+        Starts the thread that tracks running jobs and launches queued ones as slots free up.
+        """
+        self._stopped.clear()
+        self._monitor = threading.Thread(target=self._monitor_jobs, name="job-monitor", daemon=True)
+        self._monitor.start()
+
+    def submit(self, name: str, target: Callable, *args: Any, **kwargs: Any) -> Job:
+        """
+        Submits a job. It starts right away if there is a free worker, otherwise it is queued.
+
+        Parameters:
+            name (str): Human readable name of the job.
+            target (Callable): Module level function to run in a separate process.
+
+        Returns:
+            Job: The submitted job.
+        """
+        job = Job(name, target, args, kwargs)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._schedule()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> list:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Cancels a job. Queued jobs are dropped and running jobs have their process terminated.
+
+        Parameters:
+            job_id (str): The id of the job to cancel.
+
+        Returns:
+            Job: The cancelled job, or None if it does not exist.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATES:
+                return job
+
+            if job.status == RUNNING:
+                job.process.terminate()
+                job.process.join()
+                job.exit_code = job.process.exitcode
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            self._schedule()
+            return job
+
+    def shutdown(self) -> None:
+        """
+        Terminates running jobs and stops the worker pools.
+        """
+        self._stopped.set()
+        with self._lock:
+            for job in self._jobs.values():
+                if job.status in (QUEUED, RUNNING):
+                    if job.process is not None:
+                        job.process.terminate()
+                        job.process.join()
+                    job.status = CANCELLED
+                    job.finished_at = time.time()
+        if self._monitor is not None:
+            self._monitor.join()
+            self._monitor = None
+        self.predict_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _schedule(self) -> None:
+        # must be called holding the lock
+        running = sum(1 for job in self._jobs.values() if job.status == RUNNING)
+        for job in self._jobs.values():
+            if running >= self.max_workers:
+                break
+            if job.status == QUEUED:
+                job.process = self._context.Process(
+                    target=_run_job, args=(job.target, job.args, job.kwargs), name=f"job-{job.name}"
+                )
+                job.process.start()
+                job.status = RUNNING
+                job.started_at = time.time()
+                running += 1
+
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATES]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def _monitor_jobs(self) -> None:
+        while not self._stopped.is_set():
+            with self._lock:
+                sentinels = [job.process.sentinel for job in self._jobs.values() if job.status == RUNNING]
+
+            if sentinels:
+                wait(sentinels, timeout=0.5)
+            else:
+                self._stopped.wait(0.5)
+
+            with self._lock:
+                for job in self._jobs.values():
+                    if job.status == RUNNING and not job.process.is_alive():
+                        job.exit_code = job.process.exitcode
+                        job.status = SUCCEEDED if job.exit_code == 0 else FAILED
+                        job.finished_at = time.time()
+                self._schedule()
@@ -0,0 +1,180 @@
+'''
+This file contains the pool of loaded models used by the server. Models are kept warm keyed
+by registry version, so requests can pin a version, and the production pointer is swapped
+only once a newly promoted model is fully loaded: requests keep being served by the previous
+model meanwhile, and in-flight requests keep the model they started with.
+'''
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+from .classifier import ClassificationPipeline
+from .registry import ModelRegistry
+from .prediction_cache import PredictionCache
+
+
+class ModelPool:
+    def __init__(
+            self,
+            registry: ModelRegistry,
+            max_models: int = 3,
+            max_bytes: Optional[int] = None,
+            prediction_cache: Optional[PredictionCache] = None,
+            text_cache_size: int = 0,
+            compiled: bool = False,
+        ):
+        """
+        Initialize the ModelPool.
+
+        Parameters:
+            registry (ModelRegistry): Registry the models are loaded from.
+            max_models (int): Maximum number of loaded models.
+            max_bytes (int): Maximum total size of the loaded artifacts. No limit if None.
+            prediction_cache (PredictionCache): Cache shared by the loaded models, keyed by
+                version. Cleared when a new model is promoted.
+            text_cache_size (int): Size of the TF-IDF row cache of each loaded model.
+            compiled (bool): Load the compiled inference model of each version, if it has one.
+        """
+        self.registry = registry
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.prediction_cache = prediction_cache
+        self.text_cache_size = text_cache_size
+        self.compiled = compiled
+        self.serving_version = None
+        self._promoting_version = None
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+        registry.subscribe(self._on_registry_change)
+        if prediction_cache is not None:
+            registry.subscribe(prediction_cache.clear)
+
+    def _on_registry_change(self, index: dict) -> None:
+        version = index["production_version"]
+        if version is not None and version != self.serving_version:
+            # warm the new production model in the background, the pointer is swapped when
+            # it is loaded
+            threading.Thread(target=self._promote, args=(version,), daemon=True).start()
+
+    def _promote(self, version: int) -> None:
+        with self._lock:
+            self._promoting_version = version
+        try:
+            self.load(version)
+        except Exception as e:
+            print(f"Error loading model version {version}:", e)
+            with self._lock:
+                if self._promoting_version == version:
+                    self._promoting_version = None
+            return
+        # a newer promotion may have happened while loading, this one is then stale
+        promoted = self.registry.production_version() == version
+        with self._lock:
+            if promoted:
+                self.serving_version = version
+            if self._promoting_version == version:
+                self._promoting_version = None
+            self._evict()
+        if promoted:
+            print("Serving model version", version)
+
+    def check(self, version: Optional[int] = None) -> None:
+        """
+        Checks that a version (by default the production one) can be served, without loading it.
+
+        Raises:
+            LookupError: If the version is not in the registry, or the registry is empty.
+        """
+        if version is None:
+            if self.serving_version is None and self.registry.production_version() is None:
+                raise LookupError("There are no models in the registry yet.")
+        elif self.registry.get(version) is None:
+            raise LookupError(f"Model version {version} is not in the registry.")
+
+    def get(self, version: Optional[int] = None) -> ClassificationPipeline:
+        """
+        Returns a loaded model, loading it if needed.
+
+        Parameters:
+            version (int): Registry version of the model. By default, the production model.
+
+        Returns:
+            ClassificationPipeline: The loaded model.
+        """
+        if version is None:
+            # the stat of the index, which notifies a new production model if there is one
+            production_version = self.registry.production_version()
+            version = self.serving_version
+            if version is None:
+                if production_version is None:
+                    raise LookupError("There are no models in the registry yet.")
+                # nothing served yet, the first request waits for the load. The version is
+                # only served once it loaded, a failed load is retried by the next request
+                predictor = self.load(production_version)
+                with self._lock:
+                    if self.serving_version is None:
+                        self.serving_version = production_version
+                return predictor
+        return self.load(version)
+
+    def load(self, version: int) -> ClassificationPipeline:
+        with self._lock:
+            if version in self._models:
+                self._models.move_to_end(version)
+                return self._models[version]
+            # concurrent requests of the same version wait for a single load
+            loading = self._loading.setdefault(version, threading.Lock())
+
+        with loading:
+            with self._lock:
+                if version in self._models:
+                    return self._models[version]
+
+            try:
+                entry = self.registry.get(version)
+                if entry is None:
+                    raise LookupError(f"Model version {version} is not in the registry.")
+                predictor = ClassificationPipeline(
+                    version=version, prediction_cache=self.prediction_cache, text_cache_size=self.text_cache_size,
+                    compiled=self.compiled,
+                )
+                if predictor.model is None:
+                    raise LookupError(f"Model version {version} could not be loaded.")
+
+                with self._lock:
+                    self._models[version] = predictor
+                    self._sizes[version] = entry.get("size") or os.path.getsize(os.path.join(self.registry.base_dir, entry["artifact"]))
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._loading.pop(version, None)
+            return predictor
+
+    def _evict(self) -> None:
+        # least recently used first, the served model and the one being promoted are never
+        # evicted. Requests using an evicted model keep their reference until they finish.
+        for version in list(self._models):
+            over_count = len(self._models) > self.max_models
+            over_bytes = self.max_bytes is not None and sum(self._sizes.values()) > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+            if version in (self.serving_version, self._promoting_version) or len(self._models) == 1:
+                continue
+            del self._models[version]
+            del self._sizes[version]
+            print("Evicted model version", version)
+
+    def stats(self) -> dict:
+        """
+        Returns the served version and the loaded versions, least recently used first.
+        """
+        with self._lock:
+            return {
+                "serving_version": self.serving_version,
+                "loaded_versions": list(self._models),
+                "loaded_bytes": sum(self._sizes.values()),
+                "max_models": self.max_models,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,213 @@
+'''
+This file contains the staged pipeline runner used by the streaming inference. Every stage
+(read, preprocess, predict, write) runs in its own worker threads, connected to the next one
+by a bounded queue: while chunk N is predicted, chunk N+1 is already being read and chunk N-1
+written, and a slow stage blocks the ones before it instead of letting chunks pile up in
+memory. Arrow, NumPy and sklearn release the GIL in their inner loops, and file and database
+I/O always does, so the stages overlap. The busy, starved (waiting for input) and blocked
+(waiting for room downstream) time of every stage is reported, the bottleneck is the stage
+with the highest utilization.
+'''
+import heapq
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+# marks the end of the stream in the queues
+_END = object()
+
+
+class Stage:
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int = 1):
+        """
+        A step of a StagedPipeline.
+
+        Parameters:
+            name (str): Name of the stage in the report.
+            fn (Callable): Function applied to every item. Items for which it returns None
+                are dropped.
+            workers (int): Threads running the stage. With a single worker the items are
+                processed in the order of the input; stages with state (deduplication, an
+                output file) must have one.
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+
+class _StageStats:
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, busy: float = 0.0, starved: float = 0.0, blocked: float = 0.0, items: int = 0) -> None:
+        with self._lock:
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+            self.items += items
+
+    def report(self, wall_seconds: float) -> dict:
+        capacity = wall_seconds * self.workers
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "busy_seconds": self.busy,
+            "utilization": self.busy / capacity if capacity else 0.0,
+            "starved_seconds": self.starved,
+            "blocked_seconds": self.blocked,
+        }
+
+
+class StagedPipeline:
+    def __init__(self, stages: list, queue_size: int = 2, source_name: str = "read"):
+        """
+        Initialize the StagedPipeline.
+
+        Parameters:
+            stages (list): Stages applied in order to the items of the source.
+            queue_size (int): Maximum number of items waiting between two stages, bounds the
+                memory held by the pipeline to about (queue_size + 1) items per stage.
+            source_name (str): Name in the report of the stage pulling items from the source
+                iterable (e.g. reading chunks from parquet).
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.source_name = source_name
+        self.report = None
+
+    def run(self, source: Iterable) -> dict:
+        """
+        Runs the pipeline until the source is exhausted. If a stage raises, the other stages
+        are stopped and the exception is raised here.
+
+        Parameters:
+            source (Iterable): Items fed to the first stage, iterated in its own thread.
+
+        Returns:
+            dict: The report, also kept at self.report: wall time, the stats of every stage and
+                the bottleneck stage.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        stats = [_StageStats(self.source_name, 1)] + [_StageStats(stage.name, stage.workers) for stage in self.stages]
+        stop = threading.Event()
+        errors = []
+
+        def put(q: queue.Queue, item) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _END
+
+        def run_source() -> None:
+            source_stats, output = stats[0], queues[0]
+            iterator = iter(source)
+            seq = 0
+            try:
+                while not stop.is_set():
+                    start_time = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    put_time = time.perf_counter()
+                    if not put(output, (seq, item)):
+                        break
+                    source_stats.add(busy=put_time - start_time, blocked=time.perf_counter() - put_time, items=1)
+                    seq += 1
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(output, _END)
+
+        def run_stage(i: int, remaining: list, lock: threading.Lock) -> None:
+            stage, stage_stats = self.stages[i], stats[i + 1]
+            input_queue = queues[i]
+            output_queue = queues[i + 1] if i + 1 < len(queues) else None
+            # single worker stages reorder their input, multi worker stages before them
+            # complete items out of order
+            pending, next_seq = [], 0
+            try:
+                while not stop.is_set():
+                    wait_time = time.perf_counter()
+                    received = get(input_queue)
+                    if received is _END:
+                        # let the other workers of the stage see the end too
+                        put(input_queue, _END)
+                        break
+                    if stage.workers == 1:
+                        heapq.heappush(pending, received)
+                        ready = []
+                        while pending and pending[0][0] == next_seq:
+                            ready.append(heapq.heappop(pending))
+                            next_seq += 1
+                    else:
+                        ready = [received]
+                    stage_stats.add(starved=time.perf_counter() - wait_time)
+
+                    for seq, item in ready:
+                        start_time = time.perf_counter()
+                        # dropped items are passed on as None, to keep the sequence of the
+                        # next stage
+                        result = stage.fn(item) if item is not None else None
+                        put_time = time.perf_counter()
+                        stage_stats.add(busy=put_time - start_time, items=int(item is not None))
+                        if output_queue is not None and not put(output_queue, (seq, result)):
+                            return
+                        stage_stats.add(blocked=time.perf_counter() - put_time)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and output_queue is not None:
+                    put(output_queue, _END)
+
+        start_time = time.perf_counter()
+        n_threads = 1 + sum(stage.workers for stage in self.stages)
+        with ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="stage") as executor:
+            executor.submit(run_source)
+            for i, stage in enumerate(self.stages):
+                remaining, lock = [stage.workers], threading.Lock()
+                for _ in range(stage.workers):
+                    executor.submit(run_stage, i, remaining, lock)
+        wall_seconds = time.perf_counter() - start_time
+        if errors:
+            raise errors[0]
+
+        stage_reports = [stage_stats.report(wall_seconds) for stage_stats in stats]
+        self.report = {
+            "wall_seconds": wall_seconds,
+            "stages": stage_reports,
+            "bottleneck": max(stage_reports, key=lambda stage: stage["utilization"])["stage"],
+        }
+        return self.report
+
+    def print_report(self) -> None:
+        print(f"- Pipeline stages ({self.report['wall_seconds']:.2f}s wall):")
+        for stage in self.report["stages"]:
+            print(f"  {stage['stage']:<12} x{stage['workers']}  {stage['items']:>5} items  busy {stage['busy_seconds']:>7.2f}s "
+                  f"({stage['utilization']:>4.0%})  starved {stage['starved_seconds']:>7.2f}s  blocked {stage['blocked_seconds']:>7.2f}s")
+        print(f"  bottleneck: {self.report['bottleneck']}")
@@ -0,0 +1,124 @@
+'''
+This file contains the prediction cache used by the realtime and batch inference paths.
+Recurring transactions (internal sweep transfers, the same merchant from the same account,
+city and device...) produce identical model inputs, so their predictions are looked up by a
+hash of the model version and the normalized feature row instead of running TF-IDF and the
+forest again. Identical rows within a batch are also predicted once.
+'''
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+import numpy as np
+import pandas as pd
+
+
+def normalize_text(text: pd.Series) -> pd.Series:
+    """
+    Lowercases and collapses every run of non-word characters into a single space. TF-IDF
+    lowercases and tokenizes on word characters, so texts with the same normalized form get
+    the same TF-IDF vector.
+    """
+    return text.astype(str).str.lower().str.replace(r"\W+", " ", regex=True).str.strip()
+
+
+def row_hashes(X: pd.DataFrame, text_columns: tuple = ("transaction_details",)) -> np.ndarray:
+    """
+    64 bit hash of each row of X, with the text columns normalized.
+    """
+    X = X.copy(deep=False)
+    for col in text_columns:
+        if col in X.columns:
+            X[col] = normalize_text(X[col])
+    return pd.util.hash_pandas_object(X, index=False).to_numpy()
+
+
+class PredictionCache:
+    def __init__(self, max_size: int = 100_000, ttl_seconds: Optional[float] = None, text_columns: tuple = ("transaction_details",)):
+        """
+        Initialize the PredictionCache.
+
+        Parameters:
+            max_size (int): Maximum number of cached predictions, least recently used are
+                evicted first.
+            ttl_seconds (float): Time a prediction stays valid. No expiration if None.
+            text_columns (tuple): Text columns normalized before hashing.
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.text_columns = text_columns
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def predict(self, predict_fn: Callable[[pd.DataFrame], Any], X: pd.DataFrame, model_version: Hashable, columns: Optional[list] = None) -> np.ndarray:
+        """
+        Predicts X, running predict_fn only over the distinct rows that are not cached.
+
+        Parameters:
+            predict_fn (Callable): Model predict function.
+            X (pd.DataFrame): Input of the model.
+            model_version (Hashable): Version of the model, part of the cache key.
+            columns (list): Columns used by the model, the rest are not part of the key.
+                Defaults to all the columns of X.
+
+        Returns:
+            np.ndarray: The predictions, in the order of X.
+        """
+        if len(X) == 0:
+            return predict_fn(X)
+
+        hashes = row_hashes(X[columns] if columns is not None else X, self.text_columns)
+        unique_hashes, first_rows, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+
+        now = time.monotonic()
+        unique_predictions = [None] * len(unique_hashes)
+        missing = []
+        with self._lock:
+            for i, row_hash in enumerate(unique_hashes.tolist()):
+                entry = self._entries.get((model_version, row_hash))
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    self._entries.move_to_end((model_version, row_hash))
+                    unique_predictions[i] = entry[0]
+                else:
+                    missing.append(i)
+            self.hits += len(X) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            predictions = predict_fn(X.iloc[first_rows[missing]])
+            expires_at = now + self.ttl_seconds if self.ttl_seconds is not None else None
+            with self._lock:
+                for i, prediction in zip(missing, predictions):
+                    unique_predictions[i] = prediction
+                    self._entries[(model_version, int(unique_hashes[i]))] = (prediction, expires_at)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        return np.asarray(unique_predictions, dtype=object)[inverse]
+
+    def clear(self, *_) -> None:
+        """
+        Drops every cached prediction, e.g. when a new model is promoted. Accepts and ignores
+        the registry index, so it can be subscribed to the registry directly.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the size of the cache and its hit rate, counted in rows.
+        """
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else None,
+            "evictions": self.evictions,
+        }
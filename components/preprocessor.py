@@ -1,36 +1,67 @@
+import numpy as np
 import pandas as pd
+from typing import Optional
 from .utils.qa_functions import (
-    check_missing_values,
-    check_duplicates,
-    check_data_types,
-    check_value_ranges,
+    build_quality_report,
     clean_extra_strs,
-    check_unique_values,
-    check_date_format,
     print_separator,
-    decompose_dates
+    flag_seen_duplicates,
+    filter_rows,
+    RowHashSet
 )
-from .utils.feature_functions import create_extra_features
+from .utils.feature_functions import classify_transactions, compress_low_frequency_categories
+from .utils.date_functions import parse_dates, add_date_features
+from .utils.memory_profile import MemoryTracker
+from .utils.metrics import METRICS
+from .registry import get_registry
+from .bq_connector import write_clustered_parquet
+
+ROWS_IN = METRICS.counter("preprocess_input_rows_total", "Rows received by Preprocessor.transform.")
+ROWS_OUT = METRICS.counter("preprocess_output_rows_total", "Rows left by Preprocessor.transform after the QA filters.")
 
 class Preprocessor:
     def __init__(self, 
                  mode = "inference",
-                 date_col: str = "date", value_date_col: str = "value_date", model_features_path: str = "registry/model_features.csv") -> None:
+                 date_col: str = "date", value_date_col: str = "value_date", model_version: Optional[int] = None,
+                 date_format: Optional[str] = None,
+                 outsample_path: str = "data/bank_transactions_outsample.parquet",
+                 track_memory: bool = False) -> None:
         """
         Initializes the Preprocessor component.
 
         Args:
+            mode (str): 'training' separates the last 1% of the input as out of sample data.
+                'inference' and 'incremental' (retraining on new transactions) don't.
             date_col (str): The name of the date column.
             value_date_col (str): The name of the value date column.
+            model_version (int): Version of the model in the registry whose raw features are
+                expected in the input. Default is the production model.
+            date_format (str): Format of the date columns when they arrive as strings. If not
+                declared, it is inferred once per column and cached.
+            outsample_path (str): Where the out of sample data is written in 'training' mode.
+            track_memory (bool): If True, transform measures the peak memory of every stage
+                (see utils/memory_profile.py), available at self.memory_report.
         """
         print("====================================")
         print("Starting Preprocessor Component")
         print("====================================\n")
         self.date_col = date_col
         self.value_date_col = value_date_col
+        self.date_format = date_format
         self.mode = mode
+        self.outsample_path = outsample_path
+        self.track_memory = track_memory
+        # hashes of the rows already transformed, to drop duplicates across chunks
+        self.reset_seen_rows()
+        self.qa_report = None
+        self.memory_report = None
+        # raw input columns seen by the last preprocess call, saved with the trained model
+        self.raw_features = None
         try:
-            self.features = pd.read_csv(model_features_path)
+            entry = get_registry().get(model_version)
+            if entry is None or entry.get("raw_features") is None:
+                raise ValueError("No raw features recorded in the registry.")
+            self.features = entry["raw_features"]
             print("- Expected raw model features:\n", self.features, "\n")
         except Exception as e:
             print("Error loading model features:", e)
@@ -40,6 +71,17 @@ class Preprocessor:
         print("- Value date col:", self.value_date_col)
 
 
+    def cache_params(self) -> dict:
+        """
+        Parameters that change the output of preprocess, part of the feature cache key.
+        """
+        return {
+            "mode": self.mode,
+            "date_col": self.date_col,
+            "value_date_col": self.value_date_col,
+            "date_format": self.date_format,
+        }
+
     def check_columns_exist(self, X: pd.DataFrame, columns: list) -> None:
         """
         Checks if the raw features that the model saw during training exist in the input DataFrame.
@@ -56,63 +98,41 @@ class Preprocessor:
         if missing_columns:
             raise ValueError(f"Missing expected raw features in input DataFrame: {', '.join(missing_columns)}")
         
-    def run_quality_checks(self, df: pd.DataFrame) -> pd.DataFrame:
+    def quality_report(self, df: pd.DataFrame, sample_size: int = 10_000) -> dict:
         """
-        Executes all data quality checks.
+        Builds a sampled data quality report of the raw input. The report is opt-in and
+        doesn't modify the DataFrame.
 
         Args:
-            df (pd.DataFrame): The input DataFrame.
+            df (pd.DataFrame): The raw input DataFrame.
+            sample_size (int): Maximum number of rows used to compute the report.
 
         Returns:
-            pd.DataFrame: The DataFrame after performing quality checks.
+            dict: Machine-readable report (see qa_functions.build_quality_report).
         """
-        # Null check and cleaning
-        check_missing_values(df)
-        
-        print("Rows before cleaning nulls:", df.shape[0], "Columns:", df.shape[1])
-        df.drop(columns=["chq_no"], inplace=True)
-        df = df[~df.transaction_details.isnull()]
-        print("Rows after cleaning nulls:", df.shape[0], "Columns:", df.shape[1])
-        print_separator()
-        
-        # Duplicates
-        df = check_duplicates(df)
-        print_separator()
-        
-        # Data types
-        df = check_data_types(df)
+        report = build_quality_report(df, sample_size=sample_size)
+        print("===== Data quality report =====")
+        print(f"Rows: {report['rows']} | Sampled rows: {report['sampled_rows']}")
+        print(f"Columns with missing values: {list(report['missing_values'])}")
+        print(f"Duplicate rows in sample: {report['duplicate_rows']}")
         print_separator()
-        
-        # Value ranges
-        df = check_value_ranges(df)
-        
-        # Clean extra characters
-        df = clean_extra_strs(df)
-        print_separator()
-
-        # Unique values per category
-        df = check_unique_values(df)
-
-        # Date format check
-        date_columns = [col for col in df.columns if "date" in col]
-        df = check_date_format(df, date_columns)
-        print_separator()
-
-        # Final DataFrame
-        print("===== Dataframe post QA =====")
-        print(df)
-        return df
+        return report
     
-    def preprocess(self, X: pd.DataFrame) -> pd.DataFrame:
+    def preprocess(self, X: pd.DataFrame, run_qa: bool = False, qa_sample_size: int = 10_000, inplace: bool = False) -> pd.DataFrame:
         """
-        Preprocesses the input DataFrame by running quality checks and decomposing dates.
+        Preprocesses the input DataFrame: drops duplicates and applies the lean transform.
+        Optionally builds a sampled data quality report, available at self.qa_report.
 
         Args:
             X (pd.DataFrame): The input DataFrame.
+            run_qa (bool): If True, builds the data quality report of the input.
+            qa_sample_size (int): Maximum number of rows used by the quality report.
+            inplace (bool): If True, X is consumed by the preprocessing (see transform).
 
         Returns:
             pd.DataFrame: The preprocessed DataFrame.
         """
+        n_rows, keep_rows = len(X), None
         # If training, separate a fraction of the dataset for future inference (outsample data)
         if self.mode == "training":
             outsample_fraction = 0.01
@@ -120,12 +140,18 @@ class Preprocessor:
             
             N = int(len(X) * outsample_fraction)
             outsample_data = X.tail(N)
+            # the holdout is one more row filter of the transform
+            n_rows = len(X) - N
+            keep_rows = np.arange(len(X)) < n_rows
+            print("Shapes for raw_data:", (n_rows, X.shape[1]), "| Shape for out of sample: ", outsample_data.shape)
             
-            X = X.head(len(X) - N)
-            print("Shapes for raw_data:", X.shape, "| Shape for out of sample: ", outsample_data.shape)
-            
-            # Save the out of sample data as parquet to perform "batch inference later"
-            outsample_data.to_parquet("data/bank_transactions_outsample.parquet")
+            # Save the out of sample data as parquet to perform "batch inference later", clustered
+            # by date so inference runs over a date range only read its row groups
+            write_clustered_parquet(outsample_data, self.outsample_path, cluster_by=self.date_col)
+            # it is a view of X, it would keep the whole input alive
+            del outsample_data
+
+        self.raw_features = [col for col in X.columns if col not in ("chq_no", "category")]
 
         # column validation for preprocessing if not the first time
         try:
@@ -134,7 +160,114 @@ class Preprocessor:
             print("Error during column matching.", e)
             print("This might be the first time the model is being used. Skipping column check.")
 
-        X = self.run_quality_checks(X)
-        X = create_extra_features(X)
-        X = decompose_dates(X, date_col=self.date_col, value_date_col=self.value_date_col)
-        return X
\ No newline at end of file
+        if run_qa:
+            self.qa_report = self.quality_report(X.head(n_rows), sample_size=qa_sample_size)
+
+        # X is the whole dataset, duplicates are not tracked across calls
+        self.reset_seen_rows()
+        return self.transform(X, drop_duplicates=True, inplace=inplace, keep_rows=keep_rows)
+
+    def reset_seen_rows(self) -> None:
+        """
+        Forgets the rows transformed so far, the next transform deduplicates from scratch.
+        """
+        self.seen_row_hashes = RowHashSet()
+        self._last_seen_date = None
+        self._keep_all_hashes = False
+
+    def _flag_duplicates(self, X: pd.DataFrame, columns: list, sorted_by_date: bool) -> np.ndarray:
+        """
+        Flags the rows of X repeated in X or in the DataFrames transformed before. The hashes
+        of every unique row are kept (8 bytes each), unless the DataFrames arrive sorted by the
+        date column: duplicated rows share their date, so only the hashes of the last date seen
+        are kept and the state is bounded by the rows of a single day.
+        """
+        if not sorted_by_date or self._keep_all_hashes:
+            return flag_seen_duplicates(X, self.seen_row_hashes, columns)
+        dates = X[self.date_col]
+        if dates.isna().any():
+            # missing dates are sorted last, the hashes of their rows are all kept
+            self._keep_all_hashes = True
+            return flag_seen_duplicates(X, self.seen_row_hashes, columns)
+
+        first_date, last_date = dates.min(), dates.max()
+        if self._last_seen_date is not None:
+            if first_date < self._last_seen_date:
+                raise ValueError(f"Input not sorted by {self.date_col}: {first_date} comes after {self._last_seen_date}.")
+            if first_date > self._last_seen_date:
+                # rows of the previous dates can't be repeated anymore
+                self.seen_row_hashes = RowHashSet()
+        duplicated = flag_seen_duplicates(X, self.seen_row_hashes, columns)
+        if last_date != self._last_seen_date:
+            # only the rows of the last date can be repeated by the next DataFrames
+            self.seen_row_hashes = RowHashSet()
+            flag_seen_duplicates(X[(dates == last_date).to_numpy()], self.seen_row_hashes, columns)
+            self._last_seen_date = last_date
+        return duplicated
+
+    def transform(
+            self,
+            X: pd.DataFrame,
+            drop_duplicates: bool = False,
+            inplace: bool = False,
+            keep_rows: Optional[np.ndarray] = None,
+            sorted_by_date: bool = False,
+        ) -> pd.DataFrame:
+        """
+        Lean preprocessing path. Applies only the mutations that change the model input
+        (drop chq_no, filter null details, clean account_id, parse dates and create features).
+        The row filters are combined in a single mask and applied once, producing the frame
+        that every later stage modifies in place.
+
+        Args:
+            X (pd.DataFrame): The raw input DataFrame.
+            drop_duplicates (bool): If True, drops rows already seen in this DataFrame or in
+                any DataFrame previously transformed by this instance, so chunked inputs are
+                deduplicated as a whole. The hashes of the unique rows seen are kept, 8 bytes
+                per row, growing with the input unless sorted_by_date.
+            inplace (bool): If False, X is not modified and the filtered rows are a copy of it.
+                If True, X is consumed: its columns are moved to the output one at a time, so
+                the peak memory stays close to the size of the input. X must not be used
+                afterwards, except for its index.
+            keep_rows (np.ndarray): Boolean mask of the rows to preprocess, combined with the
+                row filters.
+            sorted_by_date (bool): The chunks arrive sorted by the date column (see
+                BatchFetcher.sorted_by). Deduplication then only keeps the hashes of the rows
+                of the last date seen. A chunk out of order raises a ValueError.
+
+        Returns:
+            pd.DataFrame: The preprocessed DataFrame, ready to be fed to the model.
+        """
+        tracker = MemoryTracker(
+            enabled=self.track_memory,
+            input_bytes=int(X.memory_usage(deep=True).sum()) if self.track_memory else None,
+        )
+        ROWS_IN.labels(mode=self.mode).inc(len(X))
+        columns = [col for col in X.columns if col != "chq_no"]
+        keep = X.transaction_details.notna().to_numpy()
+        if keep_rows is not None:
+            keep = keep & keep_rows
+        if drop_duplicates:
+            with tracker.stage("deduplicate"):
+                keep = keep & ~self._flag_duplicates(X, columns, sorted_by_date)
+        with tracker.stage("filter"):
+            X = filter_rows(X, keep, columns, inplace=inplace)
+        with tracker.stage("parse_dates"):
+            X = parse_dates(X, [self.date_col, self.value_date_col], date_format=self.date_format)
+        with tracker.stage("clean_strs"):
+            X = clean_extra_strs(X)
+        with tracker.stage("classify"):
+            X = classify_transactions(X)
+        # raw transactions received at inference time do not carry the label
+        if "category" in X.columns:
+            with tracker.stage("compress_categories"):
+                X = compress_low_frequency_categories(X)
+        with tracker.stage("date_features"):
+            X = add_date_features(X, date_col=self.date_col, value_date_col=self.value_date_col)
+
+        ROWS_OUT.labels(mode=self.mode).inc(len(X))
+        if self.track_memory:
+            tracker.stop()
+            self.memory_report = tracker.report()
+            tracker.print_report()
+        return X
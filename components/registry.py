@@ -0,0 +1,285 @@
+'''
+This file contains the index of the local "model registry". Every saved model is recorded
+in registry/index.json with its version, artifact file and hash, feature schema, metrics and
+promotion state, so finding the model to serve doesn't require listing and parsing the
+registry directory. The index is cached in memory and only re-read when the file changes.
+Version allocation and index updates hold an inter-process file lock, so concurrent training
+jobs get distinct versions and don't overwrite each other's index entries.
+'''
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Optional
+
+# promotion states
+PRODUCTION = "production"
+ARCHIVED = "archived"
+
+ARTIFACT_PATTERN = re.compile(r"trained_pipeline_v(\d+)\.pkl$")
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    def __init__(self, base_dir: str = "registry"):
+        """
+        Initialize the ModelRegistry.
+
+        params
+            base_dir: Directory where the model artifacts and the index are stored.
+        """
+        self.base_dir = base_dir
+        self.index_path = os.path.join(base_dir, "index.json")
+        self._index = None
+        self._version = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def _current_version(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _legacy_index(self) -> dict:
+        # registries written before the index existed: the artifacts are recorded without
+        # metadata, the features are still in the unversioned model_features.csv
+        features = None
+        features_path = os.path.join(self.base_dir, "model_features.csv")
+        if os.path.exists(features_path):
+            with open(features_path) as f:
+                features = [line.strip() for line in f if line.strip()]
+
+        models = {}
+        for path in glob.glob(os.path.join(self.base_dir, "trained_pipeline_v*.pkl")):
+            match = ARTIFACT_PATTERN.search(path)
+            if match:
+                version = int(match.group(1))
+                models[str(version)] = {
+                    "version": version,
+                    "artifact": os.path.basename(path),
+                    "features": features,
+                    "raw_features": None,
+                    "stage": ARCHIVED,
+                }
+        production_version = max((int(v) for v in models), default=None)
+        if production_version is not None:
+            models[str(production_version)]["stage"] = PRODUCTION
+        return {"latest_version": production_version, "production_version": production_version, "models": models}
+
+    @contextmanager
+    def _locked(self):
+        # flock is held per open file, it excludes other processes and other threads alike
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(os.path.join(self.base_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_locked(self) -> dict:
+        # inside the lock the index is re-read from disk, another process may just have
+        # written it within the mtime resolution of the cached version
+        if self._current_version() is None:
+            return self._legacy_index()
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def reserve_version(self) -> int:
+        """
+        Allocates the version of a new model by creating its (empty) artifact file, so
+        concurrent trainings in other processes can't get the same version. The artifact is
+        then saved over it and recorded with register.
+
+        returns:
+            The reserved version.
+        """
+        with self._locked():
+            index = self._read_locked()
+            versions = [index["latest_version"] or 0]
+            for path in glob.glob(os.path.join(self.base_dir, "trained_pipeline_v*.pkl")):
+                match = ARTIFACT_PATTERN.search(path)
+                if match:
+                    versions.append(int(match.group(1)))
+            version = max(versions) + 1
+            # O_EXCL: fails instead of sharing the version if the file appeared anyway
+            os.close(os.open(os.path.join(self.base_dir, f"trained_pipeline_v{version}.pkl"), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return version
+
+    def refresh(self) -> dict:
+        """
+        Re-reads the index if it changed since the last read and notifies the listeners.
+
+        returns:
+            The index.
+        """
+        version = self._current_version()
+        if self._index is not None and version == self._version:
+            return self._index
+
+        with self._lock:
+            if self._index is not None and version == self._version:
+                return self._index
+            if version is None:
+                index = self._legacy_index()
+            else:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+        self._swap(index, version)
+        return index
+
+    def _swap(self, index: dict, version: Optional[tuple]) -> None:
+        with self._lock:
+            previous, self._index, self._version = self._index, index, version
+        if previous is not None and previous.get("production_version") != index.get("production_version"):
+            for listener in self._listeners:
+                listener(index)
+
+    def subscribe(self, listener: Callable[[dict], None]) -> None:
+        """
+        Registers a function called with the new index when the production model changes
+        (e.g. a model trained by another process). Changes are detected on refresh, which
+        happens on every lookup.
+        """
+        self._listeners.append(listener)
+
+    def latest_version(self) -> Optional[int]:
+        """
+        Version of the last saved model, or None if the registry is empty.
+        """
+        return self.refresh()["latest_version"]
+
+    def production_version(self) -> Optional[int]:
+        """
+        Version of the model that is served by default, or None if the registry is empty.
+        """
+        return self.refresh()["production_version"]
+
+    def get(self, version: Optional[int] = None) -> Optional[dict]:
+        """
+        Metadata of a model version, by default the production one.
+
+        returns:
+            Dict with the version, artifact, features, metrics and stage, or None if the
+            version does not exist.
+        """
+        index = self.refresh()
+        if version is None:
+            version = index["production_version"]
+        if version is None:
+            return None
+        return index["models"].get(str(version))
+
+    def artifact_path(self, version: Optional[int] = None) -> Optional[str]:
+        entry = self.get(version)
+        return os.path.join(self.base_dir, entry["artifact"]) if entry else None
+
+    def _write(self, index: dict) -> None:
+        # atomic replace, readers in other processes never see a half written index
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+        self._swap(index, self._current_version())
+
+    def register(
+            self,
+            artifact_path: str,
+            version: int,
+            features: list,
+            raw_features: Optional[list] = None,
+            metrics: Optional[dict] = None,
+            promote: bool = True,
+            data_watermark: Optional[str] = None,
+            parent_version: Optional[int] = None,
+            compiled_artifact: Optional[str] = None,
+            watermark_row_hashes: Optional[list] = None,
+        ) -> dict:
+        """
+        Records a saved model artifact in the index. The features and metrics are written in
+        the same atomic update as the model, so they can't get out of sync.
+
+        params
+            artifact_path: Path of the saved artifact, inside the registry directory.
+            version: Version of the model.
+            features: Columns the model was trained on.
+            raw_features: Raw input columns the preprocessing expects.
+            metrics: Evaluation metrics of the model.
+            promote: If True, the model becomes the production model.
+            data_watermark: Date of the most recent transaction in the training data (ISO
+                format). Incremental retraining reads the transactions from that day on.
+            parent_version: Version the model was incrementally retrained from, if any.
+            compiled_artifact: Path of the compiled inference model exported from the artifact,
+                if any.
+            watermark_row_hashes: Hex row hashes of the training transactions dated at the
+                data watermark. Incremental retraining reads from the watermark day on and
+                skips these rows, so transactions arriving late for that day are not lost.
+
+        returns:
+            The index entry of the model.
+        """
+        entry = {
+            "version": version,
+            "artifact": os.path.basename(artifact_path),
+            "sha256": file_sha256(artifact_path),
+            "size": os.path.getsize(artifact_path),
+            "created_at": datetime.now().isoformat(),
+            "features": features,
+            "raw_features": raw_features,
+            "metrics": metrics or {},
+            "data_watermark": data_watermark,
+            "watermark_row_hashes": watermark_row_hashes,
+            "parent_version": parent_version,
+            "compiled_artifact": os.path.basename(compiled_artifact) if compiled_artifact else None,
+            "stage": ARCHIVED,
+        }
+        with self._locked():
+            index = self._read_locked()
+            index["models"][str(version)] = entry
+            index["latest_version"] = max(version, index["latest_version"] or 0)
+            if promote:
+                _set_production(index, version)
+            self._write(index)
+        return entry
+
+    def promote(self, version: int) -> None:
+        """
+        Makes a model version the production model, archiving the previous one.
+        """
+        with self._locked():
+            index = self._read_locked()
+            if str(version) not in index["models"]:
+                raise ValueError(f"Model version {version} is not in the registry.")
+            _set_production(index, version)
+            self._write(index)
+
+
+def _set_production(index: dict, version: int) -> None:
+    for entry in index["models"].values():
+        if entry["stage"] == PRODUCTION:
+            entry["stage"] = ARCHIVED
+    index["models"][str(version)]["stage"] = PRODUCTION
+    index["production_version"] = version
+
+
+@lru_cache(maxsize=None)
+def get_registry(base_dir: str = "registry") -> ModelRegistry:
+    """
+    Registry shared by all the components of the process, so the index is read once.
+    """
+    return ModelRegistry(base_dir)
@@ -0,0 +1,171 @@
+'''
+This file contains the in-memory index over the latest inference output used by the server
+to paginate results. The output is memory-mapped through Arrow and indexed by predicted
+category once per inference run, instead of being re-read on every request.
+'''
+import base64
+import json
+import os
+import threading
+from typing import Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from .sinks import latest_pointer_path, read_latest_run_info, read_warehouse_run
+
+
+class StaleCursorError(ValueError):
+    """
+    Raised when a cursor points to an inference run that is no longer the latest one.
+    """
+
+
+class ResultsIndex:
+    def __init__(self, table_name: str = "predictions", base_dir: str = "outputs", category_col: str = "predictions"):
+        """
+        Initialize the ResultsIndex.
+
+        params
+            table_name: Name of the output table to index.
+            base_dir: Directory where the tables are stored.
+            category_col: Column holding the predicted category, used for filtering.
+        """
+        self.table_name = table_name
+        self.base_dir = base_dir
+        self.category_col = category_col
+        # (table, category_rows, run_id) of the indexed run, replaced as a whole on refresh
+        self._snapshot = (None, {}, None)
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def table(self) -> Optional[pa.Table]:
+        return self._snapshot[0]
+
+    @property
+    def run_id(self) -> Optional[str]:
+        return self._snapshot[2]
+
+    def _current_version(self) -> Optional[tuple]:
+        # the pointer file only changes when a run completes, a stat is enough to detect it
+        for path in (latest_pointer_path(self.table_name, self.base_dir),
+                     os.path.join(self.base_dir, f"{self.table_name}.csv")):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                return (path, stat.st_mtime_ns, stat.st_size)
+        return None
+
+    def refresh(self) -> bool:
+        """
+        Rebuilds the index if a new inference run completed since the last build.
+
+        returns:
+            True if there is an output to serve, False otherwise.
+        """
+        version = self._current_version()
+        if version == self._version:
+            return self.table is not None
+
+        with self._lock:
+            if version == self._version:
+                return self.table is not None
+
+            run_info = read_latest_run_info(self.table_name, self.base_dir)
+            if run_info is None:
+                table = None
+            elif run_info["format"] == "parquet":
+                table = pq.read_table(run_info["path"], memory_map=True)
+            elif run_info["format"] == "warehouse":
+                table = read_warehouse_run(run_info)
+            else:
+                table = pa_csv.read_csv(run_info["path"])
+
+            category_rows = {}
+            if table is not None and self.category_col in table.column_names:
+                codes, uniques = pd.factorize(table.column(self.category_col).to_numpy(zero_copy_only=False))
+                order = np.argsort(codes, kind="stable")
+                boundaries = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+                for i, category in enumerate(uniques):
+                    category_rows[category] = order[boundaries[i]:boundaries[i + 1]]
+
+            # swap everything at once, concurrent queries keep using the previous snapshot
+            self._snapshot = (table, category_rows, run_info["run_id"] if run_info else None)
+            self._version = version
+            return table is not None
+
+    def query(
+            self,
+            offset: int = 0,
+            limit: int = 100,
+            cursor: Optional[str] = None,
+            columns: Optional[list] = None,
+            category: Optional[str] = None,
+        ) -> dict:
+        """
+        Returns a page of the latest inference output.
+
+        params
+            offset: Position of the first row of the page. Ignored if a cursor is given.
+            limit: Maximum number of rows in the page.
+            cursor: Opaque cursor returned by a previous query, pointing to the next page.
+            columns: Columns to return. All columns if not specified.
+            category: If given, only rows predicted with this category are returned.
+
+        returns:
+            Dict with the rows of the page, the total number of matching rows and the cursor
+            of the next page (None on the last page).
+        """
+        self.refresh()
+        table, category_rows, run_id = self._snapshot
+        if table is None:
+            return None
+        if cursor is not None:
+            cursor_state = decode_cursor(cursor)
+            if cursor_state["run_id"] != run_id:
+                raise StaleCursorError("The cursor belongs to a previous inference run.")
+            offset, category = cursor_state["offset"], cursor_state["category"]
+
+        if columns:
+            unknown = [col for col in columns if col not in table.column_names]
+            if unknown:
+                raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+            table = table.select(columns)
+
+        if category is not None:
+            rows = category_rows.get(category, np.array([], dtype=np.int64))
+            total = len(rows)
+            page = table.take(pa.array(rows[offset:offset + limit]))
+        else:
+            total = table.num_rows
+            page = table.slice(offset, limit)
+
+        next_offset = offset + limit
+        next_cursor = None
+        if next_offset < total:
+            next_cursor = encode_cursor({"run_id": run_id, "offset": next_offset, "category": category})
+
+        return {
+            "run_id": run_id,
+            "total": total,
+            "offset": offset,
+            "rows": page.to_pylist(),
+            "next_cursor": next_cursor,
+        }
+
+
+def encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor.")
+    # cursors come from clients, anything not shaped like the ones encode_cursor mints is rejected
+    if (not isinstance(state, dict) or not {"run_id", "offset", "category"} <= state.keys()
+            or type(state["offset"]) is not int or state["offset"] < 0
+            or not (state["category"] is None or isinstance(state["category"], str))):
+        raise ValueError("Invalid cursor.")
+    return state
@@ -0,0 +1,282 @@
+'''
+This file contains the output sinks used by the BatchFetcher to "write to BigQuery".
+The default sink writes compressed Parquet through Arrow, partitioned by run date and run
+id, and can be appended to chunk by chunk. The warehouse sink bulk inserts the run into a
+warehouse table (see warehouse.py). The CSV sink is kept as a legacy option.
+'''
+import json
+from abc import ABC, abstractmethod
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .warehouse import WarehouseConnector, connect
+from .utils.metrics import METRICS
+
+WRITE_SECONDS = METRICS.histogram("sink_write_seconds", "Time writing a DataFrame to an output table.")
+ROWS_WRITTEN = METRICS.counter("sink_rows_written_total", "Rows written to the output tables.")
+
+
+def latest_pointer_path(table_name: str, base_dir: str = "outputs") -> str:
+    """
+    Path of the file pointing to the output of the last completed run of a table.
+    """
+    return os.path.join(base_dir, f"{table_name}.latest.json")
+
+
+class Sink(ABC):
+    def __init__(self, table_name: str, base_dir: str = "outputs"):
+        """
+        Base class of the output sinks. A sink holds the output of a single run: it is
+        opened, receives one or many DataFrames through write() and is completed with close(),
+        which publishes the run as the latest output of the table.
+
+        params
+            table_name: Name of the table to write to.
+            base_dir: Directory where the tables are stored.
+        """
+        self.table_name = table_name
+        self.base_dir = base_dir
+        self.run_id = datetime.now().strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        self.rows = 0
+        self.path = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        """
+        Appends a DataFrame to the run.
+        """
+        start_time = time.perf_counter()
+        self._write(df)
+        WRITE_SECONDS.labels(table=self.table_name, format=self.format).observe(time.perf_counter() - start_time)
+        ROWS_WRITTEN.labels(table=self.table_name, format=self.format).inc(len(df))
+
+    @abstractmethod
+    def _write(self, df: pd.DataFrame) -> None:
+        pass
+
+    def _finish(self) -> None:
+        pass
+
+    def _abort(self) -> None:
+        self._finish()
+
+    def _run_info(self) -> dict:
+        # extra metadata of the run saved in the pointer
+        return {}
+
+    def close(self) -> dict:
+        """
+        Completes the run and points the table to it.
+
+        returns:
+            Metadata of the written run.
+        """
+        self._finish()
+        run_info = {
+            "table_name": self.table_name,
+            "run_id": self.run_id,
+            "format": self.format,
+            "path": self.path,
+            "rows": self.rows,
+            "written_at": datetime.now().isoformat(),
+            **self._run_info(),
+        }
+        # atomic replace, readers never see a half written pointer
+        pointer_path = latest_pointer_path(self.table_name, self.base_dir)
+        tmp_path = f"{pointer_path}.{self.run_id}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(run_info, f)
+        os.replace(tmp_path, pointer_path)
+        return run_info
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't publish partial outputs
+            self._abort()
+
+
+class ParquetSink(Sink):
+    format = "parquet"
+
+    def __init__(self, table_name: str, base_dir: str = "outputs", compression: str = "zstd"):
+        """
+        Writes the run into outputs/{table}/run_date=YYYY-MM-DD/run_id={run_id}/part-0.parquet.
+        Each write() is appended to the file as a new row group.
+
+        params
+            compression: Parquet compression codec.
+        """
+        super().__init__(table_name, base_dir)
+        self.compression = compression
+        run_date = datetime.now().strftime("%Y-%m-%d")
+        run_dir = os.path.join(base_dir, table_name, f"run_date={run_date}", f"run_id={self.run_id}")
+        self.path = os.path.join(run_dir, "part-0.parquet")
+        self._writer = None
+        self._schema = None
+
+    def _write(self, df: pd.DataFrame) -> None:
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            # columns with only nulls in the first chunk would get a null type
+            self._schema = pa.schema([
+                field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                for field in table.schema
+            ])
+            table = table.cast(self._schema)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._writer = pq.ParquetWriter(self.path, self._schema, compression=self.compression)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def _finish(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        elif not os.path.exists(self.path):
+            # a completed run without writes (e.g. filters matching no rows) publishes an
+            # empty table, _finish only runs on close
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            pq.write_table(pa.table({}), self.path)
+
+    def _abort(self) -> None:
+        # the partial file of a failed run is never published, its run directory is removed
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+
+
+class CsvSink(Sink):
+    format = "csv"
+
+    def __init__(self, table_name: str, base_dir: str = "outputs"):
+        """
+        Legacy sink: writes the run into outputs/{table}.csv, replacing the previous run.
+        """
+        super().__init__(table_name, base_dir)
+        self.path = os.path.join(base_dir, f"{table_name}.csv")
+
+    def _write(self, df: pd.DataFrame) -> None:
+        if self.rows == 0:
+            df.to_csv(self.path, index=False)
+        else:
+            df.to_csv(self.path, index=False, mode="a", header=False)
+        self.rows += len(df)
+
+
+class WarehouseSink(Sink):
+    format = "warehouse"
+
+    def __init__(self, table_name: str, connector: WarehouseConnector, base_dir: str = "outputs"):
+        """
+        Appends the run to a warehouse table with bulk inserts, every row tagged with the
+        run_id (indexed on the first write). Readers only see the run once it is published (see
+        read_warehouse_run), the rows of a failed run are deleted, and so are the rows of the
+        run it supersedes once it is published.
+
+        params
+            connector: Connector of the warehouse.
+        """
+        super().__init__(table_name, base_dir)
+        self.connector = connector
+        self.path = connector.url
+        self.columns = None
+
+    def _write(self, df: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.columns is None:
+            self.columns = table.schema.names
+        table = table.append_column("run_id", pa.array([self.run_id] * len(df), type=pa.string()))
+        first_write = self.rows == 0
+        self.rows += self.connector.write_batches(self.table_name, [table])
+        if first_write:
+            # runs are read and deleted by run_id, the table is created by the first write
+            self.connector.create_index(self.table_name, ["run_id"])
+
+    def _abort(self) -> None:
+        if self.rows:
+            self.connector.delete_rows(self.table_name, [("run_id", "=", self.run_id)])
+
+    def _run_info(self) -> dict:
+        # the table has the columns of every run written to it
+        return {"columns": self.columns}
+
+    def close(self) -> dict:
+        previous = read_latest_run_info(self.table_name, self.base_dir)
+        run_info = super().close()
+        # the previous run is no longer published, its rows would accumulate in the table
+        if (previous and previous["format"] == self.format and previous["path"] == self.path
+                and self.connector.table_exists(self.table_name)):
+            self.connector.delete_rows(self.table_name, [("run_id", "=", previous["run_id"])])
+        return run_info
+
+
+SINKS = {
+    "parquet": ParquetSink,
+    "csv": CsvSink,
+}
+
+def create_sink(output_format: str, table_name: str, base_dir: str = "outputs") -> Sink:
+    """
+    Creates a sink for the given output format ('parquet' or 'csv').
+    """
+    if output_format not in SINKS:
+        raise ValueError(f"Unknown output format '{output_format}'. Options: {', '.join(SINKS)}")
+    return SINKS[output_format](table_name, base_dir=base_dir)
+
+def read_latest_run_info(table_name: str, base_dir: str = "outputs") -> Optional[dict]:
+    """
+    Returns the metadata of the last completed run of a table, or None if the table was
+    never written.
+    """
+    pointer_path = latest_pointer_path(table_name, base_dir)
+    if os.path.exists(pointer_path):
+        with open(pointer_path) as f:
+            return json.load(f)
+
+    legacy_path = os.path.join(base_dir, f"{table_name}.csv")
+    if os.path.exists(legacy_path):
+        return {"table_name": table_name, "run_id": None, "format": "csv", "path": legacy_path}
+    return None
+
+def read_latest_output(table_name: str, base_dir: str = "outputs", columns: Optional[list] = None) -> Optional[pd.DataFrame]:
+    """
+    Reads the output of the last completed run of a table, falling back to the legacy
+    outputs/{table}.csv if no run was published.
+
+    returns:
+        DataFrame with the output, or None if the table was never written.
+    """
+    run_info = read_latest_run_info(table_name, base_dir)
+    if run_info is None:
+        return None
+    if run_info["format"] == "parquet":
+        return pd.read_parquet(run_info["path"], columns=columns)
+    if run_info["format"] == "warehouse":
+        return read_warehouse_run(run_info, columns).to_pandas()
+    return pd.read_csv(run_info["path"], usecols=columns)
+
+def read_warehouse_run(run_info: dict, columns: Optional[list] = None) -> pa.Table:
+    """
+    Reads the rows of a run written by a WarehouseSink, with the columns it wrote.
+    """
+    if columns is None:
+        columns = run_info.get("columns")
+        # a run without writes
+        if columns is None:
+            return pa.table({})
+    with connect(run_info["path"]) as connector:
+        return connector.read_table(run_info["table_name"], columns, filters=[("run_id", "=", run_info["run_id"])])
@@ -0,0 +1,208 @@
+'''
+This file contains the training engine used by ClassificationPipeline.train_classifier. It
+runs the cross validation folds (or a small hyperparameter search with successive halving)
+in parallel across cores, fits the final model and evaluates it, timing every stage.
+'''
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Optional
+import numpy as np
+import pandas as pd
+from joblib import Memory
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.metrics import accuracy_score, classification_report
+from sklearn.model_selection import HalvingGridSearchCV, StratifiedKFold, cross_validate
+from sklearn.pipeline import Pipeline
+
+# small search over the forest, the number of trees is the resource of successive halving
+DEFAULT_PARAM_GRID = {
+    "classifier__max_features": ["sqrt", "log2"],
+    "classifier__min_samples_leaf": [1, 2],
+}
+
+
+class TrainingEngine:
+    def __init__(
+            self,
+            n_jobs: int = -1,
+            cv: int = 5,
+            search: bool = False,
+            param_grid: Optional[dict] = None,
+            halving_factor: int = 3,
+            train_sample_size: int = 10_000,
+            scoring: str = "accuracy",
+            random_state: int = 42,
+        ):
+        """
+        Initialize the TrainingEngine.
+
+        Parameters:
+            n_jobs (int): Processes used for the folds and the search candidates. -1 uses all cores.
+            cv (int): Number of cross validation folds. 0 skips cross validation.
+            search (bool): If True, the hyperparameters in param_grid are searched with
+                successive halving over the number of trees, and the best ones are used.
+            param_grid (dict): Grid of pipeline parameters. Default is DEFAULT_PARAM_GRID.
+            halving_factor (int): Fraction of candidates kept (1 / factor) in every halving
+                iteration, and growth of the number of trees.
+            train_sample_size (int): Rows of the training set used to report train metrics.
+            scoring (str): Metric of the cross validation and the search.
+            random_state (int): Seed of the folds and the train sample.
+        """
+        self.n_jobs = n_jobs
+        self.cv = cv
+        self.search = search
+        self.param_grid = param_grid or DEFAULT_PARAM_GRID
+        self.halving_factor = halving_factor
+        self.train_sample_size = train_sample_size
+        self.scoring = scoring
+        self.random_state = random_state
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times a stage of the training, the wall-clock time is stored in self.timings.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start_time
+
+    def _folds(self) -> StratifiedKFold:
+        return StratifiedKFold(n_splits=self.cv, shuffle=True, random_state=self.random_state)
+
+    def cross_validate(self, model: Pipeline, X_train: pd.DataFrame, y_train: np.ndarray) -> dict:
+        """
+        Cross validates the model, fitting the folds in parallel.
+
+        Returns:
+            dict: Mean and std of the score across folds.
+        """
+        with self.stage("cross_validation"):
+            scores = cross_validate(model, X_train, y_train, cv=self._folds(), scoring=self.scoring, n_jobs=self.n_jobs)
+        cv_scores = scores["test_score"]
+        print(f"\n- CV {self.scoring} ({self.cv} folds): {np.mean(cv_scores):.4f} +/- {np.std(cv_scores):.4f}")
+        return {f"cv_{self.scoring}_mean": float(np.mean(cv_scores)), f"cv_{self.scoring}_std": float(np.std(cv_scores))}
+
+    def search_hyperparameters(self, model: Pipeline, X_train: pd.DataFrame, y_train: np.ndarray) -> tuple:
+        """
+        Successive halving over the parameter grid: every candidate is cross validated with a
+        few trees, and only the best 1 / factor keep going with factor times more trees, up
+        to the number of trees of the model. The fitted preprocessing of each fold is cached
+        and shared by all the candidates and iterations, since they only change the forest.
+
+        Returns:
+            tuple: The best model (refit on the whole training set) and its metrics.
+        """
+        max_trees = model.get_params()["classifier__n_estimators"]
+        with tempfile.TemporaryDirectory() as cache_dir, self.stage("search"):
+            model.set_params(memory=Memory(cache_dir, verbose=0))
+            try:
+                search = HalvingGridSearchCV(
+                    model,
+                    self.param_grid,
+                    factor=self.halving_factor,
+                    resource="classifier__n_estimators",
+                    max_resources=max_trees,
+                    min_resources="exhaust",
+                    cv=self._folds(),
+                    scoring=self.scoring,
+                    n_jobs=self.n_jobs,
+                    refit=False,
+                    random_state=self.random_state,
+                )
+                search.fit(X_train, y_train)
+            finally:
+                # the cache directory is deleted on exit, the model must not point to it
+                model.set_params(memory=None)
+
+        results = pd.DataFrame(search.cv_results_)
+        print(f"\n- Halving search: {search.n_candidates_[0]} candidates, {len(results) * self.cv} fits "
+              f"in {search.n_iterations_} iterations, trees per iteration: {list(search.n_resources_)}")
+        print("- Best params:", search.best_params_)
+        print(f"- Best CV {self.scoring}: {search.best_score_:.4f}")
+
+        best_params = {key: value for key, value in search.best_params_.items() if key != "classifier__n_estimators"}
+        model.set_params(**best_params)
+        best_row = results.iloc[search.best_index_]
+        metrics = {
+            "best_params": best_params,
+            f"cv_{self.scoring}_mean": float(best_row.mean_test_score),
+            f"cv_{self.scoring}_std": float(best_row.std_test_score),
+        }
+        return model, metrics
+
+    def evaluate(
+            self,
+            model: Pipeline,
+            X_train: pd.DataFrame,
+            y_train: np.ndarray,
+            X_test: pd.DataFrame,
+            y_test: np.ndarray,
+        ) -> dict:
+        """
+        Test metrics on the whole test set, train metrics on a sample of the training set
+        (enough to spot overfitting without predicting every training row).
+
+        Returns:
+            dict: Train and test accuracy.
+        """
+        with self.stage("evaluation"):
+            if len(X_train) > self.train_sample_size:
+                sample = np.random.default_rng(self.random_state).choice(len(X_train), self.train_sample_size, replace=False)
+                X_train, y_train = X_train.iloc[sample], y_train[sample]
+            y_pred_train = model.predict(X_train)
+            y_pred_test = model.predict(X_test)
+
+        metrics = {
+            "train_accuracy": accuracy_score(y_train, y_pred_train),
+            "test_accuracy": accuracy_score(y_test, y_pred_test),
+        }
+        print("\n====================================")
+        print(f"Train Accuracy ({len(X_train)} rows sample): {metrics['train_accuracy']}")
+        print(f"Test Accuracy: {metrics['test_accuracy']}")
+        print("====================================\n")
+
+        print("==================================================================")
+        print("                        Test Set Clasiffication Report")
+        print("==================================================================\n")
+        print(classification_report(y_test, y_pred_test))
+        return metrics
+
+    def run(
+            self,
+            model: Pipeline,
+            X_train: pd.DataFrame,
+            y_train: np.ndarray,
+            X_test: pd.DataFrame,
+            y_test: np.ndarray,
+        ) -> tuple:
+        """
+        Searches or cross validates, fits the final model and evaluates it.
+
+        Returns:
+            tuple: The fitted model and its metrics, including the seconds of every stage.
+        """
+        metrics = {}
+        if self.search:
+            model, search_metrics = self.search_hyperparameters(model, X_train, y_train)
+            metrics.update(search_metrics)
+        elif self.cv:
+            metrics.update(self.cross_validate(model, X_train, y_train))
+
+        with self.stage("fit"):
+            model.fit(X_train, y_train)
+        metrics.update(self.evaluate(model, X_train, y_train, X_test, y_test))
+        metrics["stage_seconds"] = dict(self.timings)
+        return model, metrics
+
+    def report_timings(self) -> None:
+        """
+        Prints the wall-clock time of every stage and its share of the total.
+        """
+        total = sum(self.timings.values())
+        print("\n- Wall-clock time per stage:")
+        for name, seconds in self.timings.items():
+            print(f"  {name:<18} {seconds:>8.1f}s {seconds / total:>6.1%}")
@@ -0,0 +1,379 @@
+'''
+    File containing the compiled inference representation of a trained model pipeline.
+
+    compile_pipeline flattens the fitted ColumnTransformer + RandomForestClassifier into plain
+    arrays: the vocabulary (or hashing size) and idf weights of the text features, the imputer
+    fill values and scaler mean/scale of the numerical features, the one-hot lookup tables of
+    the categorical features, and every tree of the forest concatenated into node arrays. The
+    CompiledPipeline evaluates them with vectorized NumPy, without going through the sklearn
+    object graph (input validation, ColumnTransformer dispatch, joblib over the trees), which
+    dominates the latency of 1-10 row predictions.
+
+    Every step reproduces the floating point operations of sklearn in the same order (the
+    features are cast to float32 like the trees do, the tree probabilities are accumulated in
+    estimator order), so the predictions and probabilities are identical to the pipeline's.
+'''
+from typing import Optional
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer, TfidfVectorizer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.utils import murmurhash3_32
+from .text_features import CachedTfidfVectorizer
+
+# rows of the dense feature matrix built at a time, bounds the memory of large batches
+CHUNK_SIZE = 128
+
+
+class TextFeatures:
+    def __init__(self, column: str, offset: int, analyzer_params, vocabulary: Optional[dict], n_features: int,
+                 idf: Optional[np.ndarray], sublinear_tf: bool, binary: bool, norm: Optional[str]):
+        """
+        Bag of words of a text column, either with a fitted vocabulary (TF-IDF) or hashed.
+
+        Args:
+            column (str): Input column.
+            offset (int): Position of the first text feature in the feature matrix.
+            analyzer_params: Unfitted clone of the vectorizer, only used to build its analyzer.
+            vocabulary (dict): Token -> column. None for hashed features.
+            n_features (int): Number of text features.
+            idf (np.ndarray): Idf weights, or None.
+            sublinear_tf (bool): Replace the counts by 1 + log(count).
+            binary (bool): Replace the counts by 1.
+            norm (str): 'l2' or None.
+        """
+        self.column = column
+        self.offset = offset
+        self.analyzer_params = analyzer_params
+        self.vocabulary = vocabulary
+        self.n_features = n_features
+        self.idf = idf
+        self.sublinear_tf = sublinear_tf
+        self.binary = binary
+        self.norm = norm
+
+    def _index(self, token: str) -> Optional[int]:
+        if self.vocabulary is not None:
+            return self.vocabulary.get(token)
+        # same as sklearn's _hashing_fast, abs(-2**31) included
+        h = murmurhash3_32(token, seed=0)
+        if h == -2147483648:
+            return (2147483647 - (self.n_features - 1)) % self.n_features
+        return abs(h) % self.n_features
+
+    def fill(self, values: np.ndarray, positions: dict, features: np.ndarray) -> None:
+        if "_analyzer" not in self.__dict__:
+            self._analyzer = self.analyzer_params.build_analyzer()
+        for row, document in enumerate(values[:, positions[self.column]].tolist()):
+            counts = {}
+            for token in self._analyzer(document):
+                index = self._index(token)
+                if index is not None:
+                    counts[index] = counts.get(index, 0) + 1
+            if not counts:
+                continue
+            # csr rows have sorted indices, the l2 norm is summed in that order
+            indices = np.array(sorted(counts), dtype=np.int64)
+            weights = np.array([counts[index] for index in indices], dtype=np.float64)
+            if self.binary:
+                weights.fill(1.0)
+            if self.sublinear_tf:
+                np.log(weights, weights)
+                weights += 1.0
+            if self.idf is not None:
+                weights *= self.idf[indices]
+            if self.norm == "l2":
+                squares = 0.0
+                for weight in weights.tolist():
+                    squares += weight * weight
+                if squares != 0.0:
+                    weights /= np.sqrt(squares)
+            features[row, self.offset + indices] = weights
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop("_analyzer", None)
+        return state
+
+
+class NumericalFeatures:
+    def __init__(self, columns: list, offset: int, fill_value: Optional[float], mean: Optional[np.ndarray],
+                 scale: Optional[np.ndarray]):
+        """
+        Numerical columns, imputed with a constant and standardized.
+
+        Args:
+            columns (list): Input columns.
+            offset (int): Position of the first column in the feature matrix.
+            fill_value (float): Value of the missing entries, None if there is no imputer.
+            mean (np.ndarray): Subtracted mean, or None.
+            scale (np.ndarray): Scale the values are divided by, or None.
+        """
+        self.columns = columns
+        self.offset = offset
+        self.fill_value = fill_value
+        self.mean = mean
+        self.scale = scale
+
+    def fill(self, values: np.ndarray, positions: dict, features: np.ndarray) -> None:
+        numbers = values[:, [positions[column] for column in self.columns]].astype(np.float64)
+        if self.fill_value is not None:
+            numbers[np.isnan(numbers)] = self.fill_value
+        if self.mean is not None:
+            numbers -= self.mean
+        if self.scale is not None:
+            numbers /= self.scale
+        features[:, self.offset:self.offset + len(self.columns)] = numbers
+
+
+class CategoricalFeatures:
+    def __init__(self, columns: list, offset: int, fill_value: Optional[str], lookups: list):
+        """
+        Categorical columns, imputed with a constant and one-hot encoded. Unknown categories
+        get all their columns at zero.
+
+        Args:
+            columns (list): Input columns.
+            offset (int): Position of the first one-hot column in the feature matrix.
+            fill_value (str): Value of the missing entries, None if there is no imputer.
+            lookups (list): For each column, dict of category -> position in the feature matrix.
+        """
+        self.columns = columns
+        self.offset = offset
+        self.fill_value = fill_value
+        self.lookups = lookups
+
+    def fill(self, values: np.ndarray, positions: dict, features: np.ndarray) -> None:
+        for column, lookup in zip(self.columns, self.lookups):
+            categories = values[:, positions[column]].tolist()
+            if self.fill_value is not None:
+                # SimpleImputer only considers nan missing in object columns
+                categories = [self.fill_value if category != category else category for category in categories]
+            columns = np.array([lookup.get(category, -1) for category in categories], dtype=np.int64)
+            known = columns >= 0
+            features[np.flatnonzero(known), columns[known]] = 1.0
+
+
+class CompiledForest:
+    def __init__(self, estimators: list, classes: np.ndarray, steps_per_check: int = 8):
+        """
+        The trees of a fitted forest concatenated into flat node arrays. The children of node
+        i are stored at 2 * i (right) and 2 * i + 1 (left), and leaves point to themselves, so
+        a walk that reached its leaf can take extra steps without moving.
+
+        Args:
+            estimators (list): Fitted DecisionTreeClassifier of the forest.
+            classes (np.ndarray): Classes of the forest.
+            steps_per_check (int): Steps taken between two removals of the walks that reached
+                their leaf.
+        """
+        self.classes = classes
+        self.steps_per_check = steps_per_check
+        features, thresholds, children, leaf_slots, leaf_values, roots = [], [], [], [], [], []
+        n_nodes = 0
+        n_leaves = 0
+        for estimator in estimators:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count)
+            is_leaf = tree.children_left == -1
+            roots.append(n_nodes)
+            features.append(np.where(is_leaf, 0, tree.feature).astype(np.int64))
+            thresholds.append(np.where(is_leaf, 0.0, tree.threshold))
+            right = np.where(is_leaf, nodes, tree.children_right) + n_nodes
+            left = np.where(is_leaf, nodes, tree.children_left) + n_nodes
+            children.append(np.column_stack([right, left]).ravel())
+            slots = np.full(tree.node_count, -1, dtype=np.int64)
+            slots[is_leaf] = np.arange(is_leaf.sum()) + n_leaves
+            leaf_slots.append(slots)
+            # DecisionTreeClassifier.predict_proba returns tree_.value as is
+            leaf_values.append(tree.value[is_leaf, 0, :])
+            n_nodes += tree.node_count
+            n_leaves += is_leaf.sum()
+
+        self.feature = np.concatenate(features)
+        # the trees compare float32 features with float64 thresholds: x <= t is the same as
+        # x <= the largest float32 not above t, so the walk compares float32 values only
+        thresholds = np.concatenate(thresholds)
+        self.threshold = thresholds.astype(np.float32)
+        rounded_up = self.threshold > thresholds
+        self.threshold[rounded_up] = np.nextafter(self.threshold[rounded_up], np.float32(-np.inf))
+        self.children = np.concatenate(children)
+        self.leaf_slot = np.concatenate(leaf_slots)
+        self.leaf_values = np.concatenate(leaf_values)
+        self.roots = np.array(roots, dtype=np.int64)
+
+    def apply(self, features: np.ndarray) -> np.ndarray:
+        """
+        Leaf slot reached by every row in every tree, shape (n_rows, n_trees).
+        """
+        n_rows, n_features = features.shape
+        n_trees = len(self.roots)
+        flat_features = features.astype(np.float32).ravel()
+        # one walk per (row, tree), only the walks that haven't reached their leaf are kept
+        walks = np.arange(n_rows * n_trees)
+        nodes = np.tile(self.roots, n_rows)
+        row_starts = np.repeat(np.arange(n_rows) * n_features, n_trees)
+        leaves = np.empty(n_rows * n_trees, dtype=np.int64)
+        while len(walks):
+            for _ in range(self.steps_per_check):
+                positions = self.feature.take(nodes)
+                if n_rows > 1:
+                    positions += row_starts
+                go_left = flat_features.take(positions) <= self.threshold.take(nodes)
+                nodes = self.children.take(2 * nodes + go_left)
+            slots = self.leaf_slot.take(nodes)
+            done = slots >= 0
+            leaves[walks[done]] = slots[done]
+            walks, nodes, row_starts = walks[~done], nodes[~done], row_starts[~done]
+        return leaves.reshape(n_rows, n_trees)
+
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        tree_proba = self.leaf_values[self.apply(features)]
+        # summed tree by tree, in estimator order, like the forest does
+        proba = np.cumsum(tree_proba, axis=1)[:, -1]
+        proba /= len(self.roots)
+        return proba
+
+
+class CompiledPipeline:
+    def __init__(self, steps: list, n_features: int, forest: CompiledForest, feature_names_in: Optional[np.ndarray] = None):
+        """
+        Compiled model, see compile_pipeline.
+
+        Args:
+            steps (list): TextFeatures, NumericalFeatures and CategoricalFeatures filling the
+                feature matrix.
+            n_features (int): Number of columns of the feature matrix.
+            forest (CompiledForest): The compiled classifier.
+            feature_names_in (np.ndarray): Columns the pipeline was fitted on.
+        """
+        self.steps = steps
+        self.n_features = n_features
+        self.forest = forest
+        self.classes_ = forest.classes
+        if feature_names_in is not None:
+            self.feature_names_in_ = feature_names_in
+
+    def _features(self, values: np.ndarray, positions: dict) -> np.ndarray:
+        features = np.zeros((len(values), self.n_features), dtype=np.float64)
+        for step in self.steps:
+            step.fill(values, positions, features)
+        return features
+
+    def _values(self, X: pd.DataFrame) -> tuple:
+        # a single conversion of the frame, selecting its columns one by one is slower
+        return X.to_numpy(dtype=object), {column: position for position, column in enumerate(X.columns)}
+
+    def transform(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Dense feature matrix of X, equal to the output of the fitted ColumnTransformer.
+        """
+        return self._features(*self._values(X))
+
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        values, positions = self._values(X)
+        probas = [
+            self.forest.predict_proba(self._features(values[start:start + CHUNK_SIZE], positions))
+            for start in range(0, len(values), CHUNK_SIZE)
+        ]
+        return np.concatenate(probas) if probas else np.zeros((0, len(self.classes_)))
+
+    def predict(self, X: pd.DataFrame) -> np.ndarray:
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+def _compile_text(vectorizer, column: str, offset: int) -> TextFeatures:
+    if isinstance(vectorizer, CachedTfidfVectorizer):
+        vectorizer = vectorizer.vectorizer_
+    if isinstance(vectorizer, TfidfVectorizer):
+        return TextFeatures(column, offset, clone(vectorizer), dict(vectorizer.vocabulary_), len(vectorizer.vocabulary_),
+                            vectorizer.idf_ if vectorizer.use_idf else None, vectorizer.sublinear_tf, vectorizer.binary,
+                            vectorizer.norm)
+
+    tfidf = None
+    if isinstance(vectorizer, Pipeline) and len(vectorizer.steps) == 2 and isinstance(vectorizer.steps[1][1], TfidfTransformer):
+        vectorizer, tfidf = vectorizer.steps[0][1], vectorizer.steps[1][1]
+    if not isinstance(vectorizer, HashingVectorizer) or vectorizer.alternate_sign:
+        raise ValueError(f"Text transformer {vectorizer} can't be compiled.")
+    if tfidf is None:
+        return TextFeatures(column, offset, clone(vectorizer), None, vectorizer.n_features, None, False,
+                            vectorizer.binary, vectorizer.norm)
+    if vectorizer.norm is not None or vectorizer.binary:
+        raise ValueError(f"Text transformer {vectorizer} can't be compiled.")
+    return TextFeatures(column, offset, clone(vectorizer), None, vectorizer.n_features,
+                        tfidf.idf_ if tfidf.use_idf else None, tfidf.sublinear_tf, False, tfidf.norm)
+
+
+def _steps(transformer) -> list:
+    return [step for _, step in transformer.steps] if isinstance(transformer, Pipeline) else [transformer]
+
+
+def _compile_numerical(transformer, columns: list, offset: int) -> NumericalFeatures:
+    fill_value, mean, scale = None, None, None
+    for step in _steps(transformer):
+        if isinstance(step, SimpleImputer) and step.strategy == "constant" and fill_value is None and mean is None:
+            fill_value = float(step.statistics_[0])
+        elif isinstance(step, StandardScaler) and mean is None and scale is None:
+            mean, scale = step.mean_, step.scale_
+        else:
+            raise ValueError(f"Numerical step {step} can't be compiled.")
+    return NumericalFeatures(list(columns), offset, fill_value, mean, scale)
+
+
+def _compile_categorical(transformer, columns: list, offset: int) -> CategoricalFeatures:
+    steps = _steps(transformer)
+    fill_value = None
+    if isinstance(steps[0], SimpleImputer) and steps[0].strategy == "constant":
+        fill_value = steps[0].statistics_[0]
+        steps = steps[1:]
+    encoder = steps[0] if len(steps) == 1 else None
+    if (not isinstance(encoder, OneHotEncoder) or encoder.handle_unknown != "ignore" or encoder.drop is not None
+            or getattr(encoder, "infrequent_categories_", None) is not None):
+        raise ValueError(f"Categorical transformer {transformer} can't be compiled.")
+    lookups = []
+    start = offset
+    for categories in encoder.categories_:
+        lookups.append({category: start + position for position, category in enumerate(categories.tolist())})
+        start += len(categories)
+    return CategoricalFeatures(list(columns), offset, fill_value, lookups)
+
+
+def compile_pipeline(model: Pipeline) -> CompiledPipeline:
+    """
+    Compiles a fitted model pipeline (see ClassificationPipeline.create_model_pipeline).
+
+    Args:
+        model (Pipeline): The fitted model pipeline.
+
+    Returns:
+        CompiledPipeline: Model with the same predictions as the pipeline.
+
+    Raises:
+        ValueError: If the pipeline has a component without a compiled equivalent.
+    """
+    preprocessor, forest = model.named_steps["preprocessor"], model.named_steps["classifier"]
+    if not isinstance(preprocessor, ColumnTransformer) or not isinstance(forest, (RandomForestClassifier, ExtraTreesClassifier)):
+        raise ValueError("Only ColumnTransformer + forest pipelines can be compiled.")
+    if forest.n_outputs_ != 1:
+        raise ValueError("Multi-output forests can't be compiled.")
+
+    steps = []
+    for name, transformer, columns in preprocessor.transformers_:
+        if transformer == "drop" or preprocessor.output_indices_[name].stop == preprocessor.output_indices_[name].start:
+            continue
+        offset = preprocessor.output_indices_[name].start
+        if isinstance(columns, str):
+            steps.append(_compile_text(transformer, columns, offset))
+        elif isinstance(_steps(transformer)[-1], OneHotEncoder):
+            steps.append(_compile_categorical(transformer, columns, offset))
+        else:
+            steps.append(_compile_numerical(transformer, columns, offset))
+
+    n_features = max(indices.stop for indices in preprocessor.output_indices_.values())
+    return CompiledPipeline(steps, n_features, CompiledForest(forest.estimators_, forest.classes_),
+                            getattr(model, "feature_names_in_", None))
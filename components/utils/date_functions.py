@@ -0,0 +1,152 @@
+'''
+    File containing the date feature stage: date parsing with a cached/declared format and
+    the decomposition of the dates into calendar features in a single vectorized pass.
+'''
+from typing import Optional
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from pandas.tseries.api import guess_datetime_format
+
+NS_PER_DAY = 86_400 * 10**9
+NAT = np.iinfo(np.int64).min
+# widest range of days whose calendar is computed day by day (100 years)
+MAX_CALENDAR_DAYS = 36_525
+
+# formats inferred per column, so pandas does not re-infer them on every call
+_inferred_formats = {}
+
+def parse_dates(df: DataFrame, date_cols: list, date_format: Optional[str] = None) -> DataFrame:
+    """
+    Converts columns to datetime. Columns that already are datetimes are left untouched. String
+    columns are parsed with the declared format or, if not declared, with a format inferred once
+    per column and cached.
+
+    Args:
+        df (DataFrame): The DataFrame with the date columns.
+        date_cols (list): Columns to convert to datetime.
+        date_format (str): Declared format of the date columns (e.g. '%Y-%m-%d').
+
+    Returns:
+        DataFrame: The DataFrame with the date columns converted.
+    """
+    for col in date_cols:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            continue
+
+        fmt = date_format or _inferred_formats.get(col)
+        if fmt is None:
+            first_valid = df[col].first_valid_index()
+            if first_valid is not None and isinstance(df[col][first_valid], str):
+                fmt = guess_datetime_format(df[col][first_valid])
+                if fmt is not None:
+                    _inferred_formats[col] = fmt
+
+        parsed = pd.to_datetime(df[col], format=fmt, errors="coerce")
+        if fmt is not None and date_format is None and parsed.isnull().sum() > df[col].isnull().sum():
+            # the cached format doesn't fit this input, fall back to per call inference
+            parsed = pd.to_datetime(df[col], errors="coerce")
+        df[col] = parsed
+    return df
+
+def calendar_from_days(days: np.ndarray) -> tuple:
+    """
+    Computes year, month, day and weekday (Monday=0) from days since the unix epoch, using
+    integer arithmetic only (civil from days algorithm, proleptic gregorian calendar).
+
+    Args:
+        days (np.ndarray): int64 days since 1970-01-01.
+
+    Returns:
+        tuple: year, month, day and weekday arrays.
+    """
+    z = days + 719_468
+    era = np.floor_divide(z, 146_097)
+    day_of_era = z - era * 146_097
+    year_of_era = (day_of_era - day_of_era // 1_460 + day_of_era // 36_524 - day_of_era // 146_096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = np.where(shifted_month < 10, shifted_month + 3, shifted_month - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    # 1970-01-01 was a Thursday
+    weekday = np.mod(days + 3, 7)
+    return year, month, day, weekday
+
+def add_date_features(
+    X: DataFrame,
+    date_col: str = "date",
+    value_date_col: str = "value_date",
+    date_diff_col: str = "date_diff",
+) -> DataFrame:
+    """
+    Adds the date difference and the calendar features of both date columns, then deletes the
+    original date columns in place. Transactions cluster heavily by day, so the features are
+    computed once per day in the range of the dates and looked up for every row.
+
+    Args:
+        X (DataFrame): The DataFrame with datetime columns.
+        date_col (str): The name of the date column.
+        value_date_col (str): The name of the value date column.
+        date_diff_col (str): The name of the date difference column to be created.
+
+    Returns:
+        DataFrame: The DataFrame with the date features.
+    """
+    dates = X[date_col].to_numpy(dtype="datetime64[ns]").view(np.int64)
+    value_dates = X[value_date_col].to_numpy(dtype="datetime64[ns]").view(np.int64)
+    date_nat = dates == NAT
+    value_date_nat = value_dates == NAT
+    date_days = np.floor_divide(dates, NS_PER_DAY)
+    value_date_days = np.floor_divide(value_dates, NS_PER_DAY)
+
+    # the calendar is computed for every day between the first and the last date and the rows
+    # look their day up by offset, without hashing; a range too wide (outliers) is factorized
+    int64 = np.iinfo(np.int64)
+    first_day = min(date_days.min(where=~date_nat, initial=int64.max), value_date_days.min(where=~value_date_nat, initial=int64.max))
+    last_day = max(date_days.max(where=~date_nat, initial=int64.min), value_date_days.max(where=~value_date_nat, initial=int64.min))
+    if last_day < first_day:
+        first_day = last_day = 0
+    if last_day - first_day < MAX_CALENDAR_DAYS:
+        calendar_days = np.arange(first_day, last_day + 1)
+        date_days -= first_day
+        value_date_days -= first_day
+    else:
+        n_rows = len(dates)
+        codes, calendar_days = pd.factorize(np.concatenate([date_days, value_date_days]))
+        date_days, value_date_days = codes[:n_rows], codes[n_rows:]
+    date_days[date_nat] = 0
+    value_date_days[value_date_nat] = 0
+    calendar = [values.astype(np.int32) for values in calendar_from_days(calendar_days)]
+
+    def lookup(values: np.ndarray, column_days: np.ndarray, column_nat: np.ndarray) -> np.ndarray:
+        # same dtypes as the .dt accessor: int32, or float64 with NaN when there are NaT
+        if column_nat.any():
+            return np.where(column_nat, np.nan, values[column_days].astype(np.float64))
+        return values[column_days]
+
+    date_diff = np.floor_divide(value_dates - dates, NS_PER_DAY)
+    if (date_nat | value_date_nat).any():
+        X[date_diff_col] = np.where(date_nat | value_date_nat, np.nan, date_diff.astype(np.float64))
+    else:
+        X[date_diff_col] = date_diff
+    del date_diff
+
+    # with copy on write pandas copies the arrays assigned to a column, so they are computed
+    # one at a time and only one of them is alive besides its copy
+    year, month, day, weekday = calendar
+    for feature, values, column_days, column_nat in (
+        ('year', year, date_days, date_nat),
+        ('month_date', month, date_days, date_nat),
+        ('day', day, date_days, date_nat),
+        ('weekday', weekday, date_days, date_nat),
+        ('year_value_date', year, value_date_days, value_date_nat),
+        ('month_value_date', month, value_date_days, value_date_nat),
+        ('day_value_date', day, value_date_days, value_date_nat),
+        ('weekday_value_date', weekday, value_date_days, value_date_nat),
+        ('month', month, date_days, date_nat),
+    ):
+        X[feature] = lookup(values, column_days, column_nat)
+
+    del X[date_col], X[value_date_col]
+    return X
@@ -1,7 +1,29 @@
+import json
+import os
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 from typing import Optional
 
+FEATURE_CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "config", "feature_config.json")
+
+# labels of classify_transactions, indexed by the codes computed there
+TRANSACTION_TYPES = np.array(['withdrawal', 'deposit', 'no transaction', 'both'], dtype=object)
+
+@lru_cache(maxsize=None)
+def load_feature_config(path: str = FEATURE_CONFIG_PATH) -> dict:
+    """
+    Load the feature configuration (category mapping) from a json file. Cached per path.
+
+    Parameters:
+        path (str): Path to the json config file. Default is config/feature_config.json.
+
+    Returns:
+        dict: The feature configuration.
+    """
+    with open(path) as f:
+        return json.load(f)
+
 def classify_transactions(
     X: pd.DataFrame, 
     withdrawal_col: str = 'withdrawal_amt', 
@@ -18,14 +40,20 @@ def classify_transactions(
         transaction_type_col (str): The name of the transaction type column to be created. Default is 'transactionType'.
 
     Returns:
-        pd.DataFrame: The DataFrame with the transaction type column added.
+        pd.DataFrame: The DataFrame with the transaction type column added, as a categorical.
     """
-    X[transaction_type_col] = np.where(
-        (X[withdrawal_col] > 0) & pd.isnull(X[deposit_col]), 'withdrawal', 
-        np.where(pd.isnull(X[withdrawal_col]) & (X[deposit_col] > 0), 'deposit',
-        np.where(pd.isnull(X[withdrawal_col]) & pd.isnull(X[deposit_col]), 'no transaction', 'both')
-        )
-    )
+    withdrawal = X[withdrawal_col].to_numpy(dtype=float)
+    deposit = X[deposit_col].to_numpy(dtype=float)
+    withdrawal_null = np.isnan(withdrawal)
+    deposit_null = np.isnan(deposit)
+
+    # masks are mutually exclusive, rows matching none of them are 'both'
+    codes = np.full(len(X), 3, dtype=np.int8)
+    codes[withdrawal_null & deposit_null] = 2
+    codes[withdrawal_null & (deposit > 0)] = 1
+    codes[(withdrawal > 0) & deposit_null] = 0
+
+    X[transaction_type_col] = pd.Categorical.from_codes(codes, categories=TRANSACTION_TYPES)
     return X
 
 def calculate_date_diff(
@@ -52,29 +80,35 @@ def calculate_date_diff(
 def compress_low_frequency_categories(
     X: pd.DataFrame, 
     category_col: str = 'category', 
-    target_category_col: str = 'target_category'
+    target_category_col: str = 'target_category',
+    config: Optional[dict] = None,
 ) -> pd.DataFrame:
     """
-    Compress low frequency categories in the given DataFrame.
+    Compress low frequency categories (and missing ones) in the given DataFrame into a single
+    'others' category. The mapping is applied to the unique categories only and the target is
+    built as a categorical from the codes of the rows, no label is materialized per row.
 
     Parameters:
         X (pd.DataFrame): The input DataFrame.
         category_col (str): The name of the category column. Default is 'category'.
         target_category_col (str): The name of the target category column to be created. Default is 'target_category'.
+        config (dict): Category mapping with 'low_frequency_categories' and 'others_category'.
+            Default is the one in config/feature_config.json.
 
     Returns:
-        pd.DataFrame: The DataFrame with the compressed categories.
+        pd.DataFrame: The DataFrame with the compressed categories, as a categorical.
     """
-    classes = X[category_col].value_counts().index.tolist()
-    
-    # TODO move this to a config file
-    low_freq = ['Pets & Pet Care', 'Travel',
-       'Insurance', 'Transportation', 'Health & Wellness', 'Entertainment',
-       'Education', 'Childcare & Parenting']
-    not_low_freq = [x for x in classes if x not in low_freq]
-    X[target_category_col] = X[category_col].apply(lambda x: 'others' if x not in not_low_freq else x)
-    X.drop(category_col, axis=1, inplace=True)
-    
+    config = config or load_feature_config()
+    low_freq = set(config['low_frequency_categories'])
+    others = config['others_category']
+
+    codes, uniques = pd.factorize(X[category_col])
+    # the extra trailing label is picked by the -1 code of missing values
+    labels = np.array([others if category in low_freq else category for category in uniques] + [others], dtype=object)
+    label_codes, target_categories = pd.factorize(labels)
+    X[target_category_col] = pd.Categorical.from_codes(label_codes[codes], categories=target_categories)
+    del X[category_col]
+
     return X
 
 def create_extra_features(
@@ -107,6 +141,8 @@ def create_extra_features(
     """
     X = classify_transactions(X, withdrawal_col, deposit_col, transaction_type_col)
     X = calculate_date_diff(X, value_date_col, date_col, date_diff_col)
-    X = compress_low_frequency_categories(X, category_col, target_category_col)
+    # raw transactions received at inference time do not carry the label
+    if category_col in X.columns:
+        X = compress_low_frequency_categories(X, category_col, target_category_col)
     
     return X
\ No newline at end of file
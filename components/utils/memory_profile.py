@@ -0,0 +1,123 @@
+'''
+    File containing the per stage memory tracker of the preprocessing. On Linux the resident
+    set size of the process is measured (its peak is reset at the start of every stage through
+    /proc/self/clear_refs), at no cost. Elsewhere Python and NumPy allocations are traced with
+    tracemalloc and the Arrow buffers of the string columns with the pyarrow memory pool.
+    The duration of every stage is observed in METRICS, also when memory is not tracked.
+'''
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional
+import pyarrow as pa
+from .metrics import METRICS
+
+STAGE_SECONDS = METRICS.histogram("preprocess_stage_seconds", "Time of every stage of Preprocessor.transform.")
+
+
+def _read_status(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+    raise OSError(f"{field} not found in /proc/self/status")
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class MemoryTracker:
+    def __init__(self, enabled: bool = True, input_bytes: Optional[int] = None):
+        """
+        Initialize the MemoryTracker.
+
+        Args:
+            enabled (bool): If False, the memory of the stages is not measured, only their
+                duration in METRICS.
+            input_bytes (int): Size of the input, the peaks are also reported relative to it.
+        """
+        self.enabled = enabled
+        self.input_bytes = input_bytes
+        self.stages = []
+        self.method = None
+        self._baseline = None
+
+    def _measure(self) -> tuple:
+        # current and peak memory since the last reset
+        if self.method == "rss":
+            return _read_status("VmRSS"), _read_status("VmHWM")
+        current, peak = tracemalloc.get_traced_memory()
+        arrow = pa.total_allocated_bytes()
+        return current + arrow, peak + arrow
+
+    def _reset_peak(self) -> None:
+        if self.method == "rss":
+            _reset_peak_rss()
+        else:
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures a stage: its peak memory above the memory held when the tracking started
+        (so the input is not counted), and the memory it retained when it finished.
+        """
+        if not self.enabled:
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                STAGE_SECONDS.labels(stage=name).observe(time.perf_counter() - start_time)
+            return
+
+        if self.method is None:
+            self.method = "rss" if _reset_peak_rss() else "tracemalloc"
+            if self.method == "tracemalloc" and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._baseline = self._measure()[0]
+        self._reset_peak()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            current, peak = self._measure()
+            seconds = time.perf_counter() - start_time
+            STAGE_SECONDS.labels(stage=name).observe(seconds)
+            self.stages.append({
+                "stage": name,
+                "seconds": seconds,
+                "peak_mb": (peak - self._baseline) / 1e6,
+                "retained_mb": (current - self._baseline) / 1e6,
+            })
+
+    def stop(self) -> None:
+        if self.method == "tracemalloc" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def report(self) -> dict:
+        """
+        Returns:
+            dict: How memory was measured ('rss' or 'tracemalloc'), the measures of every
+                stage, the overall peak and, if the input size is known, the peak of input +
+                preprocessing relative to the input.
+        """
+        peak_mb = max((stage["peak_mb"] for stage in self.stages), default=0.0)
+        report = {"method": self.method, "stages": self.stages, "peak_mb": peak_mb}
+        if self.input_bytes:
+            report["input_mb"] = self.input_bytes / 1e6
+            report["peak_to_input"] = 1 + peak_mb * 1e6 / self.input_bytes
+        return report
+
+    def print_report(self) -> None:
+        report = self.report()
+        print(f"- Memory per stage, above the input ({report['method']}):")
+        for stage in report["stages"]:
+            print(f"  {stage['stage']:<20} peak {stage['peak_mb']:>8.1f} MB  retained {stage['retained_mb']:>8.1f} MB  {stage['seconds']:>6.2f}s")
+        if "peak_to_input" in report:
+            print(f"  input {report['input_mb']:.1f} MB, peak {report['peak_to_input']:.2f}x the input")
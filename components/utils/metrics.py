@@ -0,0 +1,296 @@
+'''
+    File containing lightweight metric primitives used to expose performance signals
+    (latencies, batch sizes, stage timings, row counts) of the pipelines and the serving
+    components. METRICS is the process wide registry: its counters and histograms are rendered
+    in the Prometheus text format by the server at /metrics. A recording is a perf_counter
+    call and a locked increment, cheap enough to leave on. RunLog writes one structured JSON
+    line per pipeline run.
+'''
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+# upper bounds (seconds) of the duration histograms
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+
+class Histogram:
+    def __init__(self, buckets: list):
+        """
+        Cumulative histogram with fixed upper bounds, in the spirit of Prometheus histograms.
+
+        Args:
+            buckets (list): Sorted upper bounds of the buckets. An implicit +Inf bucket is added.
+        """
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """
+        Records a single observation.
+
+        Args:
+            value (float): The observed value.
+        """
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> dict:
+        """
+        Returns a consistent, JSON serializable view of the histogram.
+
+        Returns:
+            dict: Cumulative counts per upper bound, plus the total count and sum.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+            total_count = self._count
+
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets + ["+Inf"], counts):
+            running += count
+            cumulative[str(bound)] = running
+
+        return {
+            "buckets": cumulative,
+            "count": total_count,
+            "sum": total_sum,
+            "mean": total_sum / total_count if total_count else 0.0,
+        }
+
+
+class Counter:
+    def __init__(self):
+        """
+        Monotonic counter, in the spirit of Prometheus counters.
+        """
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def value(self) -> float:
+        return self._value
+
+
+class MetricFamily:
+    def __init__(self, name: str, kind: str, help: str = "", buckets: Optional[list] = None):
+        """
+        A named metric with one child (Counter or Histogram) per combination of labels.
+
+        Args:
+            name (str): Metric name, e.g. 'pipeline_stage_seconds'.
+            kind (str): 'counter' or 'histogram'.
+            help (str): Description shown in the exposition.
+            buckets (list): Upper bounds of the buckets of the histograms.
+        """
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.buckets = buckets or SECONDS_BUCKETS
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(sorted((name, str(value)) for name, value in labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = Counter() if self.kind == "counter" else Histogram(self.buckets)
+                    self._children[key] = child
+        return child
+
+    def add(self, child, **labels) -> None:
+        """
+        Exposes an existing Histogram (e.g. owned by a component) under this family.
+        """
+        key = tuple(sorted((name, str(value)) for name, value in labels.items()))
+        with self._lock:
+            self._children[key] = child
+
+    def children(self) -> list:
+        with self._lock:
+            return list(self._children.items())
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Registry of the metric families of the process.
+        """
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _family(self, name: str, kind: str, help: str, buckets: Optional[list]) -> MetricFamily:
+        family = self._families.get(name)
+        if family is None:
+            with self._lock:
+                family = self._families.setdefault(name, MetricFamily(name, kind, help, buckets))
+        if help and not family.help:
+            family.help = help
+        return family
+
+    def counter(self, name: str, help: str = "") -> MetricFamily:
+        return self._family(name, "counter", help, None)
+
+    def histogram(self, name: str, help: str = "", buckets: Optional[list] = None) -> MetricFamily:
+        return self._family(name, "histogram", help, buckets)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        self.counter(name).labels(**labels).inc(amount)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self.histogram(name).labels(**labels).observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes the duration of the block, in seconds, in the histogram name.
+        """
+        histogram = self.histogram(name).labels(**labels)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
+
+    def render_prometheus(self) -> str:
+        """
+        Returns:
+            str: Every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, family in sorted(self._families.items()):
+            if family.help:
+                lines.append(f"# HELP {name} {family.help}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for labels, child in family.children():
+                if family.kind == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {child.value()}")
+                    continue
+                snapshot = child.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {snapshot['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {snapshot['count']}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.histogram("pipeline_stage_seconds", "Time of every stage of a pipeline run (see RunLog).")
+METRICS.counter("pipeline_runs_total", "Finished pipeline runs, by status.")
+
+
+class RunLog:
+    def __init__(self, pipeline: str, path: str = "outputs/run_log.jsonl", params: Optional[dict] = None):
+        """
+        Structured log of a pipeline run: the duration and rows of every stage, counters and
+        the final status are appended as one JSON line to path when the run finishes. Stage
+        durations are also observed in METRICS ('pipeline_stage_seconds').
+
+        Args:
+            pipeline (str): Name of the pipeline, e.g. 'inference'.
+            path (str): JSON lines file the runs are appended to.
+            params (dict): JSON serializable parameters of the run.
+        """
+        self.pipeline = pipeline
+        self.path = path
+        self.run_id = datetime.now().strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        self.params = params or {}
+        self.stages = []
+        self.counts = {}
+        self.extra = {}
+        self._start_time = None
+        self._started_at = None
+
+    def __enter__(self):
+        self._start_time = time.perf_counter()
+        self._started_at = datetime.now().isoformat()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish("failed" if exc_type is not None else "succeeded", error=exc_value)
+
+    @contextmanager
+    def stage(self, name: str, rows: Optional[int] = None):
+        """
+        Times a stage of the run. Rows can be given, or set afterwards on the yielded record.
+        """
+        record = {"stage": name, "seconds": None, "rows": rows}
+        self.stages.append(record)
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start_time
+            METRICS.observe("pipeline_stage_seconds", record["seconds"], pipeline=self.pipeline, stage=name)
+
+    def add_stage(self, name: str, seconds: float, rows: Optional[int] = None) -> None:
+        """
+        Records a stage timed elsewhere (e.g. the busy time of a concurrent stage).
+        """
+        self.stages.append({"stage": name, "seconds": seconds, "rows": rows})
+        METRICS.observe("pipeline_stage_seconds", seconds, pipeline=self.pipeline, stage=name)
+
+    def count(self, name: str, amount: float = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+        METRICS.inc(f"pipeline_{name}_total", amount, pipeline=self.pipeline)
+
+    def finish(self, status: str, error: Optional[BaseException] = None) -> dict:
+        """
+        Appends the run to the log. Failing to write it never fails the run.
+
+        Returns:
+            dict: The logged record.
+        """
+        record = {
+            "run_id": self.run_id,
+            "pipeline": self.pipeline,
+            "status": status,
+            "started_at": self._started_at,
+            "finished_at": datetime.now().isoformat(),
+            "seconds": time.perf_counter() - self._start_time if self._start_time else None,
+            "params": self.params,
+            "stages": self.stages,
+            "counts": self.counts,
+            **self.extra,
+        }
+        if error is not None:
+            record["error"] = str(error)
+        METRICS.inc("pipeline_runs_total", pipeline=self.pipeline, status=status)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            print("Error writing the run log:", e)
+        return record
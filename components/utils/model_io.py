@@ -0,0 +1,103 @@
+'''
+    File containing the serialization of the model artifacts stored in the registry.
+
+    An artifact is a single file with the pickled model and, stored out-of-band right after
+    it, the raw data of its numpy arrays (tree nodes, idf vector, scaler statistics, ...):
+
+        magic (8 bytes) | header length (8 bytes) | json header | pickle stream | aligned buffers
+
+    On load the file is memory-mapped and the arrays are rebuilt on top of the mapped pages, so
+    loading doesn't parse a huge pickle stream and processes loading the same artifact share
+    the pages through the OS page cache. Plain pickle files are still loaded as before.
+'''
+import json
+import mmap
+import os
+import pickle
+from typing import Any
+
+MAGIC = b"MLPKLv1\0"
+ALIGNMENT = 64
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def save_artifact(model: Any, path: str) -> int:
+    """
+    Saves a model with its numpy arrays stored out-of-band (pickle protocol 5). The file is
+    written next to path and renamed over it once synced: a crash never leaves a truncated
+    artifact, and processes with the previous file memory-mapped keep reading its pages.
+
+    Args:
+        model (Any): The object to save.
+        path (str): Path of the artifact.
+
+    Returns:
+        int: Size of the artifact in bytes.
+    """
+    buffers = []
+    payload = pickle.dumps(model, protocol=5, buffer_callback=buffers.append)
+    raw_buffers = [buffer.raw() for buffer in buffers]
+
+    # offsets are relative to the start of the data, which is aligned right after the header
+    offsets = []
+    position = _aligned(len(payload))
+    for raw in raw_buffers:
+        offsets.append(position)
+        position = _aligned(position + raw.nbytes)
+
+    header = json.dumps({
+        "pickle_nbytes": len(payload),
+        "buffers": [[offset, raw.nbytes] for offset, raw in zip(offsets, raw_buffers)],
+    }).encode()
+    start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            f.seek(start)
+            f.write(payload)
+            for offset, raw in zip(offsets, raw_buffers):
+                f.seek(start + offset)
+                f.write(raw)
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+def load_artifact(path: str, memory_map: bool = True) -> Any:
+    """
+    Loads a model saved with save_artifact, or a plain pickle file.
+
+    Args:
+        path (str): Path of the artifact.
+        memory_map (bool): If True the arrays are read-only views of the memory-mapped file.
+            If False they are read into private memory.
+
+    Returns:
+        Any: The loaded object.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+
+        if memory_map:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            f.seek(0)
+            data = memoryview(bytearray(f.read()))
+
+    header_len = int.from_bytes(data[len(MAGIC):len(MAGIC) + 8], "little")
+    header = json.loads(bytes(data[len(MAGIC) + 8:len(MAGIC) + 8 + header_len]))
+    start = _aligned(len(MAGIC) + 8 + header_len)
+    buffers = [data[start + offset:start + offset + nbytes] for offset, nbytes in header["buffers"]]
+    return pickle.loads(data[start:start + header["pickle_nbytes"]], buffers=buffers)
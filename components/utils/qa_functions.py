@@ -2,9 +2,15 @@
     File containing axuiliary functions for data quality assessment.
     Usually called in the Preprocessor component or usefull for Pre-EDA processing.
 '''
+from typing import Optional
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from pandas import DataFrame
 
+# rows hashed at once by hash_rows
+HASH_CHUNK_SIZE = 65_536
+
 def check_missing_values(df: DataFrame) -> DataFrame:
     """
     Checks for missing values in each column and displays the count of nulls over the total rows.
@@ -48,6 +54,145 @@ def check_duplicates(df: DataFrame) -> DataFrame:
     
     return df
 
+def hash_column(values: pd.Series) -> np.ndarray:
+    """
+    64 bit hashes of the values of a column, equal to pd.util.hash_pandas_object. String and
+    categorical columns are factorized first and only their unique values are hashed.
+
+    Args:
+        values (pd.Series): The column to hash.
+
+    Returns:
+        np.ndarray: uint64 hash of every value.
+    """
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+        return pd.util.hash_pandas_object(values, index=False).to_numpy()
+    codes, uniques = pd.factorize(values)
+    unique_hashes = pd.util.hash_array(np.asarray(uniques, dtype=object), categorize=False)
+    # the extra trailing hash is picked by the -1 code of missing values, as pandas hashes them
+    return np.append(unique_hashes, np.iinfo(np.uint64).max)[codes]
+
+def hash_rows(df: DataFrame, columns: Optional[list] = None) -> np.ndarray:
+    """
+    64 bit row hashes, equal to pd.util.hash_pandas_object(df[columns], index=False). The
+    columns are not selected into a new frame and the rows are hashed in chunks, so Arrow
+    strings are only converted to Python objects a chunk at a time.
+
+    Args:
+        df (DataFrame): The DataFrame to hash.
+        columns (list): Columns that identify a row. Default is all of them.
+
+    Returns:
+        np.ndarray: uint64 hash of every row.
+    """
+    columns = list(df.columns) if columns is None else columns
+    hashes = np.empty(len(df), dtype=np.uint64)
+    for start in range(0, len(df), HASH_CHUNK_SIZE):
+        chunk = df.iloc[start:start + HASH_CHUNK_SIZE]
+        # same combination as pandas' combine_hash_arrays
+        chunk_hashes = np.full(len(chunk), 0x345678, dtype=np.uint64)
+        mult = np.uint64(1000003)
+        for i, col in enumerate(columns):
+            chunk_hashes ^= hash_column(chunk[col])
+            chunk_hashes *= mult
+            mult += np.uint64(82520 + 2 * (len(columns) - i))
+        hashes[start:start + HASH_CHUNK_SIZE] = chunk_hashes + np.uint64(97531)
+    return hashes
+
+class RowHashSet:
+    """
+    Hashes of the rows already processed, kept as sorted uint64 arrays: 8 bytes per row
+    instead of the ~70 of a Python set of ints, and vectorized lookups. New hashes are added
+    as a sorted run, and the last two runs are merged while the older one is not larger, so
+    there are at most log2(n) runs and every hash is merged O(log n) times over a stream
+    instead of the whole array being rebuilt on every chunk.
+    """
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            positions = np.searchsorted(run, hashes)
+            positions[positions == len(run)] = 0
+            found |= run[positions] == hashes
+        return found
+
+    def add(self, sorted_hashes: np.ndarray) -> None:
+        if not len(sorted_hashes):
+            return
+        self.runs.append(np.array(sorted_hashes, dtype=np.uint64))
+        while len(self.runs) > 1 and len(self.runs[-2]) <= len(self.runs[-1]):
+            # two sorted runs, the stable sort (timsort) merges them in linear time
+            last = self.runs.pop()
+            merged = np.concatenate([self.runs.pop(), last])
+            merged.sort(kind="stable")
+            self.runs.append(merged)
+
+def flag_seen_duplicates(df: DataFrame, seen_hashes: RowHashSet, columns: Optional[list] = None) -> np.ndarray:
+    """
+    Flags duplicate records using 64 bit row hashes, including rows whose hash is in seen_hashes.
+    Allows deduplicating a dataset processed in chunks without holding all of it in memory.
+
+    Args:
+        df (DataFrame): The DataFrame to check for duplicates.
+        seen_hashes (RowHashSet): Hashes of the rows already processed. Updated in place.
+        columns (list): Columns compared to find duplicates. Default is all of them.
+
+    Returns:
+        np.ndarray: Boolean mask, True for the rows that were seen before.
+    """
+    hashes = hash_rows(df, columns)
+    # a stable sort keeps the first occurrence of every hash in front of its duplicates
+    order = np.argsort(hashes, kind="stable")
+    sorted_hashes = hashes[order]
+    del hashes
+    sorted_duplicated = np.zeros(len(sorted_hashes), dtype=bool)
+    sorted_duplicated[1:] = sorted_hashes[1:] == sorted_hashes[:-1]
+    sorted_duplicated |= seen_hashes.contains(sorted_hashes)
+    seen_hashes.add(sorted_hashes[~sorted_duplicated])
+    duplicated = np.empty(len(sorted_hashes), dtype=bool)
+    duplicated[order] = sorted_duplicated
+    return duplicated
+
+def filter_rows(df: DataFrame, keep: np.ndarray, columns: list, inplace: bool = False) -> DataFrame:
+    """
+    Selects the rows flagged in keep and the given columns.
+
+    Args:
+        df (DataFrame): The DataFrame to filter.
+        keep (np.ndarray): Boolean mask of the rows to keep.
+        columns (list): Columns to keep.
+        inplace (bool): If True, df is consumed: its columns are moved to the result one at a
+            time (or, if no row is dropped, df itself is returned without the other columns),
+            so the filtered copy never coexists with the whole input. df must not be used
+            afterwards, except for its index.
+
+    Returns:
+        DataFrame: The filtered DataFrame.
+    """
+    if not inplace:
+        return df[columns] if keep.all() else df.loc[keep, columns]
+
+    if keep.all():
+        for col in [col for col in df.columns if col not in columns]:
+            del df[col]
+        return df
+
+    rows = np.flatnonzero(keep)
+    data = {}
+    for col in columns:
+        data[col] = df[col].array.take(rows)
+        del df[col]
+        # the allocator keeps the freed buffers, return them before the next column is copied
+        pa.default_memory_pool().release_unused()
+    for col in list(df.columns):
+        del df[col]
+    return pd.DataFrame(data, index=df.index[rows], copy=False)
+
 def check_data_types(df: DataFrame) -> DataFrame:
     """
     Checks the data types and possible issues.
@@ -136,6 +281,52 @@ def check_date_format(df: DataFrame, date_cols: list[str]) -> DataFrame:
             print(f"⚠️ {invalid_dates.shape[0]} invalid values in {col}")
     return df
 
+def build_quality_report(df: DataFrame, sample_size: int = 10_000, random_state: int = 42) -> dict:
+    """
+    Builds a machine-readable data quality report over a random sample of the DataFrame:
+    missing values, duplicates, data types, numeric summary, unique values and date ranges.
+
+    Args:
+        df (DataFrame): The DataFrame to assess.
+        sample_size (int): Maximum number of rows used to compute the report.
+        random_state (int): Seed of the sample.
+
+    Returns:
+        dict: JSON serializable report.
+    """
+    sample = df.sample(n=sample_size, random_state=random_state) if len(df) > sample_size else df
+    missing = sample.isnull().sum()
+    missing = missing[missing > 0]
+    numeric_summary = sample.select_dtypes(include="number").describe()
+
+    date_ranges = {}
+    for col in [col for col in sample.columns if "date" in col]:
+        dates = pd.to_datetime(sample[col], errors="coerce")
+        date_ranges[col] = {
+            "min": None if dates.isnull().all() else dates.min().isoformat(),
+            "max": None if dates.isnull().all() else dates.max().isoformat(),
+            "invalid": int(dates.isnull().sum() - sample[col].isnull().sum()),
+        }
+
+    return {
+        "rows": int(len(df)),
+        "sampled_rows": int(len(sample)),
+        "dtypes": {col: str(dtype) for col, dtype in sample.dtypes.items()},
+        "missing_values": {
+            col: {"count": int(count), "percentage": float(count / len(sample) * 100)}
+            for col, count in missing.items()
+        },
+        "duplicate_rows": int(sample.duplicated().sum()),
+        "numeric_summary": {
+            col: {stat: (None if pd.isnull(value) else float(value)) for stat, value in stats.items()}
+            for col, stats in numeric_summary.to_dict().items()
+        },
+        "unique_values": {
+            col: int(sample[col].nunique()) for col in sample.select_dtypes(include=["object"]).columns
+        },
+        "date_ranges": date_ranges,
+    }
+
 def print_separator() -> None:
     """
     Prints a separator line.
@@ -0,0 +1,155 @@
+'''
+    File containing the text featurization stage of the model: a TF-IDF vectorizer that
+    transforms each distinct transaction_details string once per batch and scatters the
+    sparse rows back, with an optional cache of string -> sparse row across batches.
+
+    Two text feature modes are available: 'tfidf' (fitted vocabulary) and 'hashing' (feature
+    hashing into a fixed number of columns plus optional idf weights), whose memory and model
+    size don't grow with the training corpus.
+'''
+import threading
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer, TfidfVectorizer
+from sklearn.pipeline import Pipeline
+
+TEXT_FEATURE_MODES = ("tfidf", "hashing")
+
+
+class CachedTfidfVectorizer(TransformerMixin, BaseEstimator):
+    def __init__(self, vectorizer: Optional[TfidfVectorizer] = None, cache_size: int = 0):
+        """
+        Wraps a text vectorizer, which is fit as usual. On transform, the distinct strings of
+        the batch are vectorized once and their rows are repeated for the duplicates.
+
+        Parameters:
+            vectorizer: The wrapped vectorizer (TfidfVectorizer, or a hashing pipeline built
+                by make_text_vectorizer). Default is TfidfVectorizer().
+            cache_size (int): Number of strings whose sparse rows are kept between batches,
+                least recently used are evicted first. 0 disables the cache.
+        """
+        self.vectorizer = vectorizer
+        self.cache_size = cache_size
+
+    def fit(self, raw_documents, y=None):
+        # the document frequencies depend on the duplicates, fit sees every row. The param is
+        # cloned, fit doesn't modify the vectorizer it was given
+        self.vectorizer_ = clone(self.vectorizer) if self.vectorizer is not None else TfidfVectorizer()
+        self.vectorizer_.fit(raw_documents)
+        return self
+
+    def fit_transform(self, raw_documents, y=None):
+        return self.fit(raw_documents).transform(raw_documents)
+
+    def transform(self, raw_documents) -> sp.csr_matrix:
+        codes, uniques = pd.factorize(pd.Series(raw_documents, copy=False))
+        if (codes < 0).any():
+            # missing documents, let the vectorizer raise its usual error
+            return self.vectorizer_.transform(raw_documents)
+
+        if self.cache_size > 0:
+            unique_rows = self._transform_cached(uniques.tolist())
+        else:
+            unique_rows = self.vectorizer_.transform(uniques)
+        return unique_rows[codes]
+
+    def _transform_cached(self, documents: list) -> sp.csr_matrix:
+        cache = self.__dict__.setdefault("_cache", OrderedDict())
+        lock = self.__dict__.setdefault("_cache_lock", threading.Lock())
+        with lock:
+            rows = [cache.get(document) for document in documents]
+        missing = [i for i, row in enumerate(rows) if row is None]
+
+        if missing:
+            matrix = self.vectorizer_.transform([documents[i] for i in missing])
+            for position, i in enumerate(missing):
+                start, end = matrix.indptr[position], matrix.indptr[position + 1]
+                # copies: a view would keep the arrays of the whole batch alive while the row is cached
+                rows[i] = (matrix.indices[start:end].copy(), matrix.data[start:end].copy())
+        with lock:
+            for document, row in zip(documents, rows):
+                cache[document] = row
+                cache.move_to_end(document)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(indices) for indices, _ in rows])
+        indices = np.concatenate([indices for indices, _ in rows]) if rows else np.array([], dtype=np.int32)
+        data = np.concatenate([data for _, data in rows]) if rows else np.array([], dtype=np.float64)
+        return sp.csr_matrix((data, indices, indptr), shape=(len(rows), self._n_features_out()))
+
+    def _n_features_out(self) -> int:
+        if "_n_features" not in self.__dict__:
+            self._n_features = self.vectorizer_.transform([""]).shape[1]
+        return self._n_features
+
+    def get_feature_names_out(self, input_features=None) -> np.ndarray:
+        return self.vectorizer_.get_feature_names_out()
+
+    def __getstate__(self) -> dict:
+        # the cache is runtime state, it is not saved with the model
+        state = super().__getstate__()
+        state.pop("_cache", None)
+        state.pop("_cache_lock", None)
+        return state
+
+
+def cache_text_features(model: Pipeline, cache_size: int = 0, step: str = "text_features") -> Pipeline:
+    """
+    Wraps the fitted TfidfVectorizer of a model trained before CachedTfidfVectorizer existed,
+    so it gets the same deduplication without retraining. Models that already use it get the
+    cache size updated.
+
+    Parameters:
+        model (Pipeline): The fitted model pipeline.
+        cache_size (int): Cross-batch cache size of the vectorizer.
+        step (str): Name of the text transformer inside the preprocessor ColumnTransformer.
+
+    Returns:
+        Pipeline: The same model, modified in place.
+    """
+    column_transformer = model.named_steps["preprocessor"]
+    for i, (name, transformer, columns) in enumerate(column_transformer.transformers_):
+        if name != step:
+            continue
+        if isinstance(transformer, TfidfVectorizer):
+            cached = CachedTfidfVectorizer(transformer, cache_size=cache_size)
+            cached.vectorizer_ = transformer
+            column_transformer.transformers_[i] = (name, cached, columns)
+        elif isinstance(transformer, CachedTfidfVectorizer):
+            transformer.cache_size = cache_size
+    return model
+
+
+def make_text_vectorizer(mode: str = "tfidf", n_features: int = 2**14, idf: bool = True) -> CachedTfidfVectorizer:
+    """
+    Builds the text feature stage of the model.
+
+    Parameters:
+        mode (str): 'tfidf' for a TfidfVectorizer with a fitted vocabulary, or 'hashing' for
+            a stateless HashingVectorizer with n_features columns.
+        n_features (int): Number of hashed columns, only used in 'hashing' mode.
+        idf (bool): In 'hashing' mode, if True the hashed counts are weighted by an idf array
+            fitted on the training data (n_features floats) and l2 normalized, like TF-IDF.
+            If False, the counts are only l2 normalized.
+
+    Returns:
+        CachedTfidfVectorizer: The text vectorizer, deduplicating the strings of each batch.
+    """
+    if mode == "tfidf":
+        return CachedTfidfVectorizer(TfidfVectorizer())
+    if mode == "hashing":
+        if idf:
+            vectorizer = Pipeline([
+                ('hashing', HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)),
+                ('idf', TfidfTransformer()),
+            ])
+        else:
+            vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False, norm='l2')
+        return CachedTfidfVectorizer(vectorizer)
+    raise ValueError(f"Unknown text feature mode '{mode}'. Options: {', '.join(TEXT_FEATURE_MODES)}")
@@ -0,0 +1,351 @@
+'''
+This file contains the warehouse connectors used by the BatchFetcher. WarehouseConnector is the
+interface to a SQL warehouse (BigQuery in production): reads stream Arrow record batches from a
+cursor, with the column projection and the filters pushed down to the query, and writes are
+bulk inserts of Arrow data. SQLiteConnector implements it on a SQLite file as a local stand-in,
+with a pool of connections shared by the readers and writers of a process.
+'''
+import queue
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# name of the table holding the Arrow schema of every table, SQL types alone lose it
+SCHEMAS_TABLE = "_arrow_schemas"
+
+SQL_OPERATORS = {"=": "=", "==": "=", "!=": "!=", ">": ">", ">=": ">=", "<": "<", "<=": "<=", "in": "IN", "not in": "NOT IN"}
+
+
+class ConnectionPool:
+    def __init__(self, connect: Callable, max_size: int = 4, timeout: float = 30.0):
+        """
+        Initialize the ConnectionPool. Connections are opened on demand, up to max_size, and
+        reused once released.
+
+        params
+            connect: Function opening a new connection.
+            max_size: Maximum number of open connections.
+            timeout: Seconds waited for a free connection before failing.
+        """
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._all = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection, it is returned to the pool when the block exits.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free connection after {self.timeout}s (pool size {self.max_size})")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+                with self._lock:
+                    self._all.append(conn)
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+        self._idle = queue.LifoQueue()
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _storage_type(field_type: pa.DataType) -> pa.DataType:
+    # Arrow type of the values as stored in SQLite (INTEGER, REAL or TEXT)
+    if pa.types.is_dictionary(field_type):
+        return _storage_type(field_type.value_type)
+    if pa.types.is_integer(field_type) or pa.types.is_boolean(field_type) or pa.types.is_temporal(field_type):
+        return pa.int64()
+    if pa.types.is_floating(field_type):
+        return pa.float64()
+    if pa.types.is_string(field_type) or pa.types.is_large_string(field_type) or pa.types.is_null(field_type):
+        return pa.string()
+    raise TypeError(f"Unsupported column type {field_type}")
+
+
+SQL_TYPES = {pa.int64(): "INTEGER", pa.float64(): "REAL", pa.string(): "TEXT"}
+
+
+def _to_sql_values(array: pa.Array) -> list:
+    # timestamps are stored as integers in the unit of their type, categories as their values
+    if pa.types.is_dictionary(array.type):
+        array = array.cast(array.type.value_type)
+    return array.cast(_storage_type(array.type)).to_pylist()
+
+
+def _from_sql_values(values: tuple, field_type: pa.DataType) -> pa.Array:
+    array = pa.array(values, type=_storage_type(field_type))
+    if pa.types.is_dictionary(field_type):
+        return array.dictionary_encode().cast(field_type)
+    if pa.types.is_null(field_type):
+        return array
+    return array.cast(field_type)
+
+
+def _arrow_value_type(field_type: pa.DataType) -> pa.DataType:
+    # type of the filter values of a column: the values of a categorical column
+    return field_type.value_type if pa.types.is_dictionary(field_type) else field_type
+
+
+class WarehouseConnector(ABC):
+    """
+    Interface of the warehouse connectors. Tables are read and written as Arrow data, filters
+    are lists of (column, op, value) tuples combined with AND (the pyarrow filters format).
+    """
+    url = None
+
+    @abstractmethod
+    def schema(self, table: str) -> pa.Schema:
+        pass
+
+    @abstractmethod
+    def table_exists(self, table: str) -> bool:
+        pass
+
+    @abstractmethod
+    def read_batches(
+            self,
+            table: str,
+            columns: Optional[list] = None,
+            filters: Optional[list] = None,
+            batch_size: int = 50_000,
+        ) -> Iterator[pa.RecordBatch]:
+        """
+        Streams the rows of a table from a cursor, batch_size rows at a time.
+
+        params
+            table: Name of the table.
+            columns: Columns to read, all of them if None.
+            filters: Row filters, evaluated by the warehouse.
+            batch_size: Maximum number of rows per batch.
+
+        returns:
+            Iterator of record batches.
+        """
+
+    @abstractmethod
+    def write_batches(self, table: str, batches: Iterable) -> int:
+        """
+        Appends Arrow tables, record batches or DataFrames to a table with bulk inserts,
+        creating it on the first write. Columns missing from the table are added to it.
+
+        returns:
+            Number of inserted rows.
+        """
+
+    @abstractmethod
+    def delete_rows(self, table: str, filters: list) -> int:
+        pass
+
+    def create_index(self, table: str, columns: list) -> None:
+        """
+        Indexes columns of a table, so filters on them don't scan it. A no-op on warehouses
+        without indexes.
+        """
+
+    def close(self) -> None:
+        pass
+
+    def read_table(self, table: str, columns: Optional[list] = None, filters: Optional[list] = None) -> pa.Table:
+        """
+        Reads a whole table (or its filtered rows) as a single Arrow table.
+        """
+        schema = self.schema(table)
+        if columns is not None:
+            schema = pa.schema([schema.field(col) for col in columns])
+        return pa.Table.from_batches(list(self.read_batches(table, columns, filters)), schema=schema)
+
+    def import_parquet(self, path: str, table: str, batch_size: int = 50_000) -> int:
+        """
+        Loads a parquet file into a table, batch by batch.
+
+        returns:
+            Number of inserted rows.
+        """
+        return self.write_batches(table, pq.ParquetFile(path).iter_batches(batch_size=batch_size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SQLiteConnector(WarehouseConnector):
+    def __init__(self, path: str, pool_size: int = 4, insert_batch_size: int = 10_000):
+        """
+        Initialize the SQLiteConnector. The database runs in WAL mode, so a streaming read and
+        the inserts of its results can run at the same time on two pooled connections.
+
+        params
+            path: Path of the SQLite database file, created if it doesn't exist.
+            pool_size: Maximum number of open connections.
+            insert_batch_size: Rows per executemany call of the bulk inserts.
+        """
+        self.path = path
+        self.url = f"sqlite:///{path}"
+        self.insert_batch_size = insert_batch_size
+        self.pool = ConnectionPool(self._connect, max_size=pool_size)
+        self._schemas = {}
+        self._schemas_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {SCHEMAS_TABLE} (table_name TEXT PRIMARY KEY, schema BLOB)")
+        return conn
+
+    def table_exists(self, table: str) -> bool:
+        try:
+            self.schema(table)
+            return True
+        except KeyError:
+            return False
+
+    def schema(self, table: str) -> pa.Schema:
+        with self.pool.connection() as conn:
+            return self._schema(conn, table)
+
+    def _schema(self, conn: sqlite3.Connection, table: str) -> pa.Schema:
+        with self._schemas_lock:
+            if table not in self._schemas:
+                row = conn.execute(f"SELECT schema FROM {SCHEMAS_TABLE} WHERE table_name = ?", (table,)).fetchone()
+                if row is None:
+                    raise KeyError(f"Table '{table}' not found in {self.url}")
+                self._schemas[table] = pa.ipc.read_schema(pa.py_buffer(row[0]))
+            return self._schemas[table]
+
+    def _where(self, schema: pa.Schema, filters: Optional[list]) -> tuple:
+        # filter values are converted like the stored values of their column
+        clauses, params = [], []
+        for col, op, value in filters or []:
+            if op.lower() not in SQL_OPERATORS:
+                raise ValueError(f"Unsupported filter operator '{op}'")
+            field_type = schema.field(col).type
+            if op.lower() in ("in", "not in"):
+                values = _to_sql_values(pa.array(list(value), type=_arrow_value_type(field_type)))
+                clauses.append(f"{_quote(col)} {SQL_OPERATORS[op.lower()]} ({', '.join('?' * len(values))})")
+                params.extend(values)
+            else:
+                clauses.append(f"{_quote(col)} {SQL_OPERATORS[op]} ?")
+                params.extend(_to_sql_values(pa.array([value], type=_arrow_value_type(field_type))))
+        return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+    def read_batches(
+            self,
+            table: str,
+            columns: Optional[list] = None,
+            filters: Optional[list] = None,
+            batch_size: int = 50_000,
+        ) -> Iterator[pa.RecordBatch]:
+        with self.pool.connection() as conn:
+            table_schema = self._schema(conn, table)
+            schema = pa.schema([table_schema.field(col) for col in columns]) if columns is not None else table_schema
+            where, params = self._where(table_schema, filters)
+            query = f"SELECT {', '.join(_quote(col) for col in schema.names)} FROM {_quote(table)}{where}"
+            # SQLite steps the query as rows are fetched, the result is never held whole
+            cursor = conn.execute(query, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield pa.RecordBatch.from_arrays(
+                        [_from_sql_values(values, field.type) for values, field in zip(zip(*rows), schema)],
+                        schema=schema,
+                    )
+            finally:
+                cursor.close()
+
+    def _ensure_table(self, conn: sqlite3.Connection, table: str, schema: pa.Schema) -> pa.Schema:
+        try:
+            current = self._schema(conn, table)
+        except KeyError:
+            current = pa.schema([])
+            columns = [f"{_quote(field.name)} {SQL_TYPES[_storage_type(field.type)]}" for field in schema]
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {_quote(table)} ({', '.join(columns)})")
+        new_fields = [field for field in schema if field.name not in current.names]
+        if current.names:
+            for field in new_fields:
+                conn.execute(f"ALTER TABLE {_quote(table)} ADD COLUMN {_quote(field.name)} {SQL_TYPES[_storage_type(field.type)]}")
+        if new_fields:
+            merged = pa.schema(list(current) + new_fields)
+            conn.execute(
+                f"INSERT OR REPLACE INTO {SCHEMAS_TABLE} (table_name, schema) VALUES (?, ?)",
+                (table, merged.serialize().to_pybytes()),
+            )
+            with self._schemas_lock:
+                self._schemas[table] = merged
+            return merged
+        return current
+
+    def write_batches(self, table: str, batches: Iterable) -> int:
+        rows = 0
+        with self.pool.connection() as conn:
+            with conn:
+                for batch in batches:
+                    if isinstance(batch, pd.DataFrame):
+                        batch = pa.Table.from_pandas(batch, preserve_index=False)
+                    self._ensure_table(conn, table, batch.schema)
+                    query = (
+                        f"INSERT INTO {_quote(table)} ({', '.join(_quote(col) for col in batch.schema.names)}) "
+                        f"VALUES ({', '.join('?' * batch.num_columns)})"
+                    )
+                    for start in range(0, batch.num_rows, self.insert_batch_size):
+                        chunk = batch.slice(start, self.insert_batch_size)
+                        conn.executemany(query, zip(*(_to_sql_values(column) for column in chunk.columns)))
+                    rows += batch.num_rows
+        return rows
+
+    def delete_rows(self, table: str, filters: list) -> int:
+        with self.pool.connection() as conn:
+            where, params = self._where(self._schema(conn, table), filters)
+            with conn:
+                return conn.execute(f"DELETE FROM {_quote(table)}{where}", params).rowcount
+
+    def create_index(self, table: str, columns: list) -> None:
+        name = _quote(f"idx_{table}_{'_'.join(columns)}")
+        with self.pool.connection() as conn:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {_quote(table)} ({', '.join(_quote(col) for col in columns)})")
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+CONNECTORS = {
+    "sqlite": SQLiteConnector,
+}
+
+def connect(url: str, **kwargs) -> WarehouseConnector:
+    """
+    Creates the connector of a warehouse url, '<engine>:///<location>' (e.g.
+    'sqlite:///data/warehouse.db').
+    """
+    engine, _, location = url.partition(":///")
+    if engine not in CONNECTORS or not location:
+        raise ValueError(f"Unknown warehouse url '{url}'. Engines: {', '.join(CONNECTORS)}")
+    return CONNECTORS[engine](location, **kwargs)
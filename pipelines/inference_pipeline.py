@@ -1,43 +1,286 @@
 from components.preprocessor import Preprocessor
 from components.classifier import ClassificationPipeline
 from components.bq_connector import BatchFetcher
+from components.prediction_cache import PredictionCache
+from components.pipeline_runner import StagedPipeline, Stage
+from components.utils.metrics import RunLog
+from components.utils.qa_functions import flag_seen_duplicates, RowHashSet
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import argparse
+import os
+import numpy as np
+import pandas as pd
 import time
+from typing import Optional
 
-def run_inference():
+# components loaded once per worker process in sharded mode
+_worker_components = {}
+
+# the concurrent streaming stages only pay off with more than one core, on a single core the
+# thread switches make the run slower than the sequential loop
+DEFAULT_PREFETCH = 2 if (os.cpu_count() or 1) > 1 else 0
+
+def run_inference(streaming: bool = False, chunk_size: int = 50_000, n_workers: int = 1, prediction_cache_size: int = 0,
+                  since: Optional[str] = None, until: Optional[str] = None, account_ids: Optional[list] = None,
+                  warehouse: Optional[str] = None, prefetch: int = DEFAULT_PREFETCH):
     '''
-    Runs batch inference from a specific data source.
+    Runs batch inference from a specific data source. Only the columns of the model are read,
+    and the date range and accounts filters are pushed down to the source.
+
+    Parameters:
+        streaming (bool): If True, the input is processed in chunks of chunk_size rows and
+            the predictions are appended to the output table chunk by chunk. Memory is
+            bounded by the chunk size, plus the row hashes kept to drop duplicates across
+            chunks (see run_streaming_inference).
+        chunk_size (int): Number of rows per chunk in streaming mode.
+        n_workers (int): If greater than 1, the input is sharded and preprocessed + predicted
+            across a pool of n_workers processes.
+        prediction_cache_size (int): If greater than 0, rows with the same features are
+            predicted once, keeping up to this many predictions cached (per worker).
+        since (str): If given, only the transactions after this date are predicted.
+        until (str): If given, only the transactions before this date are predicted.
+        account_ids (list): If given, only the transactions of these accounts are predicted.
+        warehouse (str): Url of a warehouse (e.g. 'sqlite:///data/warehouse.db') the input is
+            read from and the predictions are written to. In streaming mode the input is
+            streamed from a cursor and every chunk is bulk inserted.
+        prefetch (int): In streaming mode, chunks queued between the read, preprocess,
+            predict and write stages, which run concurrently (see run_streaming_inference).
+            0 runs them one after the other, the default on a single core.
+
+    Returns:
+        The predictions array, or the number of predicted rows in streaming mode.
+        None if the pipeline fails.
     '''
+    filters = {"since": since, "until": until, "account_ids": account_ids}
+    params = {
+        "streaming": streaming, "chunk_size": chunk_size, "n_workers": n_workers, "prediction_cache_size": prediction_cache_size,
+        "warehouse": warehouse, "prefetch": prefetch, **filters,
+    }
     try:
-        # initialize components
-        batchFetcher = BatchFetcher()
-        preprocessor = Preprocessor()
-        predictor = ClassificationPipeline()
-        
-        print("\n\n============================")
-        print("Starting Inference Pipeline")
-        print("============================\n\n")
-
-        # pipeline steps
-        raw_data = batchFetcher.load_data()
-        preprocessed_data = preprocessor.preprocess(raw_data)
-        predictions = predictor.run_batch_pred(preprocessed_data)
-
-        print("\n\nPredictions array:", predictions)
-        preprocessed_data["predictions"] = predictions
-        batchFetcher.write_to_bq(preprocessed_data, "predictions")
-        
-        print("\n\n========================================================")
-        print("Inference Pipeline Completed Succesfully")
-        print("========================================================")
-
-        return predictions
+        with RunLog("inference", params=params) as run_log:
+            if n_workers > 1 and not streaming:
+                # the model is only loaded by the worker processes
+                batchFetcher = BatchFetcher(warehouse=warehouse)
+                print("\n\n============================")
+                print(f"Starting Sharded Inference Pipeline ({n_workers} workers)")
+                print("============================\n\n")
+
+                with run_log.stage("load") as stage:
+                    raw_data = batchFetcher.load_data(**filters)
+                    stage["rows"] = len(raw_data)
+                with run_log.stage("sharded_predict") as stage:
+                    preprocessed_data = run_sharded_inference(
+                        raw_data, n_workers=n_workers, prediction_cache_size=prediction_cache_size
+                    )
+                    stage["rows"] = len(preprocessed_data)
+                with run_log.stage("write", rows=len(preprocessed_data)):
+                    batchFetcher.write_to_bq(preprocessed_data, "predictions")
+                run_log.count("predicted_rows", len(preprocessed_data))
+
+                print("\n\n========================================================")
+                print("Inference Pipeline Completed Succesfully")
+                print("========================================================")
+                return preprocessed_data["predictions"].to_numpy()
+
+            # initialize components
+            with run_log.stage("init"):
+                batchFetcher = BatchFetcher(warehouse=warehouse)
+                preprocessor = Preprocessor()
+                predictor = ClassificationPipeline(
+                    prediction_cache=PredictionCache(max_size=prediction_cache_size) if prediction_cache_size > 0 else None
+                )
+
+            print("\n\n============================")
+            print("Starting Inference Pipeline")
+            print("============================\n\n")
+
+            if streaming:
+                predicted_rows = run_streaming_inference(batchFetcher, preprocessor, predictor, chunk_size, filters, prefetch, run_log)
+                run_log.count("predicted_rows", predicted_rows)
+
+                print("\n\n========================================================")
+                print("Inference Pipeline Completed Succesfully")
+                print("========================================================")
+                return predicted_rows
+
+            # pipeline steps
+            with run_log.stage("load") as stage:
+                raw_data = batchFetcher.load_data(**filters)
+                stage["rows"] = len(raw_data)
+            with run_log.stage("preprocess") as stage:
+                preprocessed_data = preprocessor.preprocess(raw_data, inplace=True)
+                stage["rows"] = len(preprocessed_data)
+            if preprocessed_data.empty:
+                # nothing matched the filters, an empty predictions table is still written
+                predictions = np.array([], dtype=object)
+            else:
+                with run_log.stage("predict", rows=len(preprocessed_data)):
+                    predictions = predictor.run_batch_pred(preprocessed_data)
+
+            print("\n\nPredictions array:", predictions)
+            if predictor.prediction_cache is not None:
+                print("Prediction cache:", predictor.prediction_cache.stats())
+                run_log.extra["prediction_cache"] = predictor.prediction_cache.stats()
+            preprocessed_data["predictions"] = predictions
+            with run_log.stage("write", rows=len(preprocessed_data)):
+                batchFetcher.write_to_bq(preprocessed_data, "predictions")
+            run_log.count("predicted_rows", len(preprocessed_data))
+
+            print("\n\n========================================================")
+            print("Inference Pipeline Completed Succesfully")
+            print("========================================================")
+
+            return predictions
     except Exception as e:
         print("Error during pipeline execution:", e)
         return None
-    
+
+def run_streaming_inference(
+        batchFetcher: BatchFetcher,
+        preprocessor: Preprocessor,
+        predictor: ClassificationPipeline,
+        chunk_size: int,
+        filters: Optional[dict] = None,
+        prefetch: int = DEFAULT_PREFETCH,
+        run_log: Optional[RunLog] = None,
+    ) -> int:
+    '''
+    Streams the input through preprocessing and prediction chunk by chunk, appending each
+    chunk of predictions to the output table. Duplicates are dropped across chunks: if the
+    input is sorted by date only the row hashes of the last date are kept, otherwise the
+    hashes of every unique row (8 bytes each) are kept until the end of the run.
+    filters (since, until, account_ids) are passed to BatchFetcher.iter_batches.
+
+    With prefetch > 0 the read, preprocess, predict and write stages run in their own threads
+    connected by queues of prefetch chunks (see components/pipeline_runner.py): the next chunk
+    is read and the previous one written while a chunk is predicted. The utilization of every
+    stage is printed at the end, and the time of every stage is added to run_log.
+
+    Returns:
+        int: Number of predicted rows.
+    '''
+    predicted_rows = 0
+    sorted_by_date = batchFetcher.sorted_by(preprocessor.date_col)
+
+    def preprocess(item: tuple) -> Optional[tuple]:
+        i, raw_chunk = item
+        preprocessed_chunk = preprocessor.transform(raw_chunk, drop_duplicates=True, inplace=True, sorted_by_date=sorted_by_date)
+        return None if preprocessed_chunk.empty else (i, len(raw_chunk), preprocessed_chunk)
+
+    def predict(item: tuple) -> tuple:
+        preprocessed_chunk = item[2]
+        preprocessed_chunk["predictions"] = predictor.run_batch_pred(preprocessed_chunk)
+        return item
+
+    def write(item: tuple) -> None:
+        nonlocal predicted_rows
+        i, raw_rows, preprocessed_chunk = item
+        sink.write(preprocessed_chunk)
+        predicted_rows += len(preprocessed_chunk)
+        print(f"- Chunk {i}: {raw_rows} raw rows, {len(preprocessed_chunk)} predicted rows")
+
+    with batchFetcher.open_sink("predictions") as sink:
+        chunks = enumerate(batchFetcher.iter_batches(chunk_size=chunk_size, **(filters or {})))
+        if prefetch > 0:
+            # preprocess keeps the seen duplicates and write the output file, one worker each
+            pipeline = StagedPipeline(
+                [Stage("preprocess", preprocess), Stage("predict", predict), Stage("write", write)],
+                queue_size=prefetch,
+            )
+            pipeline.run(chunks)
+            pipeline.print_report()
+            stage_seconds = {stage["stage"]: stage["busy_seconds"] for stage in pipeline.report["stages"]}
+        else:
+            stage_seconds = {"read": 0.0, "preprocess": 0.0, "predict": 0.0, "write": 0.0}
+            start_time = time.perf_counter()
+            for item in chunks:
+                stage_seconds["read"] += time.perf_counter() - start_time
+                for name, fn in (("preprocess", preprocess), ("predict", predict), ("write", write)):
+                    start_time = time.perf_counter()
+                    item = fn(item)
+                    stage_seconds[name] += time.perf_counter() - start_time
+                    if item is None:
+                        break
+                start_time = time.perf_counter()
+            stage_seconds["read"] += time.perf_counter() - start_time
+
+    if run_log is not None:
+        for name, seconds in stage_seconds.items():
+            run_log.add_stage(name, seconds)
+
+    print(f"\n\nPredicted rows: {predicted_rows}")
+    if predictor.prediction_cache is not None:
+        print("Prediction cache:", predictor.prediction_cache.stats())
+    return predicted_rows
+
+def _init_worker(prediction_cache_size: int = 0) -> None:
+    '''
+    Initializer of the sharded inference workers: loads the model from the registry once
+    per process instead of once per shard.
+    '''
+    _worker_components["preprocessor"] = Preprocessor()
+    _worker_components["predictor"] = ClassificationPipeline(
+        prediction_cache=PredictionCache(max_size=prediction_cache_size) if prediction_cache_size > 0 else None
+    )
+
+def _predict_shard(raw_shard: pd.DataFrame) -> pd.DataFrame:
+    preprocessed_shard = _worker_components["preprocessor"].transform(raw_shard, inplace=True)
+    if preprocessed_shard.empty:
+        preprocessed_shard["predictions"] = np.array([], dtype=object)
+    else:
+        preprocessed_shard["predictions"] = _worker_components["predictor"].run_batch_pred(preprocessed_shard)
+    return preprocessed_shard
+
+def run_sharded_inference(raw_data: pd.DataFrame, n_workers: int, shards_per_worker: int = 4, prediction_cache_size: int = 0) -> pd.DataFrame:
+    '''
+    Shards the raw data and runs preprocessing + prediction across a process pool. Shards
+    are reassembled in the original order.
+
+    Parameters:
+        raw_data (pd.DataFrame): Raw input data.
+        n_workers (int): Number of worker processes.
+        shards_per_worker (int): Shards per worker, smaller shards balance the load better.
+        prediction_cache_size (int): Size of the prediction cache of each worker, 0 disables it.
+
+    Returns:
+        pd.DataFrame: The preprocessed data with a 'predictions' column.
+    '''
+    # duplicates are dropped before sharding, so they are detected across shards
+    columns = [col for col in raw_data.columns if col != "chq_no"]
+    duplicated = flag_seen_duplicates(raw_data, RowHashSet(), columns)
+    raw_data = raw_data[~duplicated]
+
+    n_shards = max(1, min(len(raw_data), n_workers * shards_per_worker))
+    shards = [raw_data.iloc[idx] for idx in np.array_split(np.arange(len(raw_data)), n_shards)]
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=_init_worker, initargs=(prediction_cache_size,)) as executor:
+        results = list(executor.map(_predict_shard, shards))
+
+    return pd.concat(results)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs batch inference with the latest model in the registry.")
+    parser.add_argument("--streaming", action="store_true", help="Process the input in chunks instead of loading it whole.")
+    parser.add_argument("--chunk-size", type=int, default=50_000, help="Rows per chunk in streaming mode.")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH,
+                        help="Chunks queued between the concurrent stages of the streaming mode, 0 runs them sequentially "
+                             "(default 2, or 0 on a single core).")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used to shard the inference.")
+    parser.add_argument("--prediction-cache", type=int, default=0, help="Size of the prediction cache, 0 disables it.")
+    parser.add_argument("--since", default=None, help="Only predict the transactions after this date.")
+    parser.add_argument("--until", default=None, help="Only predict the transactions before this date.")
+    parser.add_argument("--account-ids", nargs="+", default=None, help="Only predict the transactions of these accounts (with or without the quotes of the raw ids).")
+    parser.add_argument("--warehouse", default=None, help="Warehouse url to read from and write to, e.g. sqlite:///data/warehouse.db")
+    args = parser.parse_args()
+
     start_time = time.time()
-    run_inference()
+    run_inference(
+        streaming=args.streaming, chunk_size=args.chunk_size, n_workers=args.workers,
+        prediction_cache_size=args.prediction_cache, since=args.since, until=args.until, account_ids=args.account_ids,
+        warehouse=args.warehouse, prefetch=args.prefetch,
+    )
     end_time = time.time()
     elapsed_time = end_time - start_time
-    print(f"Elapsed training time: {elapsed_time:.2f} seconds")
\ No newline at end of file
+    print(f"Elapsed inference time: {elapsed_time:.2f} seconds")
@@ -1,31 +1,187 @@
 from components.preprocessor import Preprocessor
 from components.classifier import ClassificationPipeline
 from components.bq_connector import BatchFetcher
+from components.registry import get_registry, file_sha256
+from components.feature_cache import FeatureCache
+from components.utils.text_features import TEXT_FEATURE_MODES
+from components.utils.metrics import RunLog
+from components.utils.qa_functions import hash_rows
+import argparse
+import json
+import os
+import shutil
 import time
+import numpy as np
+import pandas as pd
 
-def run_training():
+def watermark_rows(raw_data: pd.DataFrame) -> tuple:
     '''
-    Runs batch inference from a specific data source.
+    Data watermark of the raw data (the date of its most recent transaction) and the hex row
+    hashes of the transactions dated at it. The next incremental retraining reads from the
+    watermark day on, so transactions arriving later for that day are not missed, and skips
+    the rows with these hashes.
+
+    Returns:
+        tuple: The watermark in ISO format and the list of row hashes.
+    '''
+    data_watermark = raw_data["date"].max()
+    at_watermark = (raw_data["date"] == data_watermark).to_numpy()
+    return data_watermark.isoformat(), [f"{h:016x}" for h in hash_rows(raw_data[at_watermark])]
+
+def load_training_features(batchFetcher: BatchFetcher, preprocessor: Preprocessor, use_cache: bool = True) -> tuple:
+    '''
+    Loads and preprocesses the training data, or reads the features from the feature cache
+    when the raw data, the preprocessing code and its parameters haven't changed. On a cache
+    hit the out of sample data is only restored if it differs from the one of the entry.
+
+    Parameters:
+        batchFetcher (BatchFetcher): Source of the raw data.
+        preprocessor (Preprocessor): Preprocessor in training mode, gets its raw_features and
+            qa_report set as if preprocess had run.
+        use_cache (bool): If False, always preprocesses and refreshes the cache entry.
+
+    Returns:
+        tuple: The preprocessed DataFrame, the data watermark of the raw data and the row
+            hashes of the transactions at the watermark (see watermark_rows).
+    '''
+    cache = FeatureCache()
+    key = cache.key(batchFetcher.fingerprint(), preprocessor.cache_params())
+    cached = cache.load(key) if use_cache else None
+    if cached is not None:
+        preprocessed_data, metadata = cached
+        print(f"- Preprocessed features read from the feature cache ({key})")
+        preprocessor.raw_features = metadata["raw_features"]
+        preprocessor.qa_report = metadata["qa_report"]
+        outsample_copy = metadata["files"]["outsample"]
+        if not os.path.exists(preprocessor.outsample_path) or file_sha256(preprocessor.outsample_path) != file_sha256(outsample_copy):
+            shutil.copyfile(outsample_copy, preprocessor.outsample_path)
+        return preprocessed_data, metadata["data_watermark"], metadata.get("watermark_row_hashes")
+
+    raw_data = batchFetcher.load_data()
+    # the out of sample rows are reserved for inference, they are not retrained on either
+    data_watermark, watermark_row_hashes = watermark_rows(raw_data)
+    # raw_data is consumed by the preprocessing, only one copy of the data is in memory
+    preprocessed_data = preprocessor.preprocess(raw_data, run_qa=True, inplace=True)
+    cache.save(
+        key,
+        preprocessed_data,
+        {"raw_features": preprocessor.raw_features, "qa_report": preprocessor.qa_report,
+         "data_watermark": data_watermark, "watermark_row_hashes": watermark_row_hashes},
+        files={"outsample": preprocessor.outsample_path},
+    )
+    return preprocessed_data, data_watermark, watermark_row_hashes
+
+def run_training(text_features: str = "tfidf", search: bool = False, n_jobs: int = -1, use_feature_cache: bool = True,
+                 memory_report: bool = False):
+    '''
+    Runs the training pipeline and saves the model in the registry.
+
+    Parameters:
+        text_features (str): Text feature mode of the model, 'tfidf' or 'hashing'.
+        search (bool): Search the forest hyperparameters with successive halving.
+        n_jobs (int): Processes used for the cross validation folds and the search.
+        use_feature_cache (bool): Reuse the cached features when the inputs haven't changed.
+        memory_report (bool): Report the peak memory of every preprocessing stage.
+    '''
+    params = {"text_features": text_features, "search": search, "n_jobs": n_jobs, "use_feature_cache": use_feature_cache}
+    try:
+        with RunLog("training", params=params) as run_log:
+            # initialize components
+            with run_log.stage("init"):
+                batchFetcher = BatchFetcher(mode="training")
+                preprocessor = Preprocessor(mode="training", track_memory=memory_report)
+                predictor = ClassificationPipeline(mode="training", text_features=text_features)
+
+            print("\n\n============================")
+            print("Starting Training Pipeline")
+            print("============================\n\n")
+
+            # pipeline steps
+            with run_log.stage("load_features") as stage:
+                preprocessed_data, data_watermark, watermark_row_hashes = load_training_features(
+                    batchFetcher, preprocessor, use_cache=use_feature_cache
+                )
+                stage["rows"] = len(preprocessed_data)
+            with open("outputs/qa_report.json", "w") as f:
+                json.dump(preprocessor.qa_report, f, indent=2)
+            with run_log.stage("train", rows=len(preprocessed_data)):
+                predictor.train_classifier(preprocessed_data, report_cv_score=True, raw_features=preprocessor.raw_features,
+                                           search=search, n_jobs=n_jobs, data_watermark=data_watermark,
+                                           watermark_row_hashes=watermark_row_hashes)
+            if preprocessor.memory_report is not None:
+                run_log.extra["memory_report"] = preprocessor.memory_report
+
+            print("\n\n========================================================")
+            print("Training Pipeline Completed Succesfully")
+            print("========================================================")
+
+            return True
+    except Exception as e:
+        print("Error during pipeline execution:", e)
+        return False
+
+def run_incremental_training(n_new_estimators: int = 20, min_new_rows: int = 1000):
+    '''
+    Retrains the production model on the transactions it was not trained on, adding trees
+    to its forest, and saves the result in the registry as a new version. The transactions
+    are read from the day of its data watermark on, skipping the rows it was trained on that
+    day. Models registered without a watermark are retrained from scratch.
+
+    Parameters:
+        n_new_estimators (int): Number of trees fitted on the new transactions.
+        min_new_rows (int): Below this many new transactions nothing is retrained, the
+            watermark stays and they are accumulated for the next run: a tiny batch can't
+            evaluate the retrained model.
     '''
     try:
-        # initialize components
-        batchFetcher = BatchFetcher(mode="training")
-        preprocessor = Preprocessor(mode="training")
-        predictor = ClassificationPipeline(mode="training")
-
-        
-        print("\n\n============================")
-        print("Starting Training Pipeline")
-        print("============================\n\n")
-
-        # pipeline steps
-        raw_data = batchFetcher.load_data()
-        preprocessed_data = preprocessor.preprocess(raw_data)
-        predictor.train_classifier(preprocessed_data, report_cv_score=True)
-        
-        print("\n\n========================================================")
-        print("Training Pipeline Completed Succesfully")
-        print("========================================================")
+        entry = get_registry().get()
+        data_watermark = entry.get("data_watermark") if entry else None
+        if data_watermark is None:
+            print("The production model has no data watermark, running a full training.")
+            return run_training()
+
+        params = {"n_new_estimators": n_new_estimators, "min_new_rows": min_new_rows, "since": data_watermark}
+        with RunLog("incremental_training", params=params) as run_log:
+            # initialize components
+            with run_log.stage("init"):
+                batchFetcher = BatchFetcher(mode="training")
+                preprocessor = Preprocessor(mode="incremental")
+                predictor = ClassificationPipeline(mode="training")
+
+            print("\n\n========================================")
+            print("Starting Incremental Training Pipeline")
+            print("========================================\n\n")
+
+            # pipeline steps
+            # models registered before the watermark rows were recorded read after the watermark day
+            seen_hashes = entry.get("watermark_row_hashes")
+            with run_log.stage("load") as stage:
+                raw_data = batchFetcher.load_data(since=data_watermark, since_inclusive=seen_hashes is not None)
+                if seen_hashes and not raw_data.empty:
+                    new_watermark, watermark_row_hashes = watermark_rows(raw_data)
+                    seen = np.isin(hash_rows(raw_data), np.array([int(h, 16) for h in seen_hashes], dtype=np.uint64))
+                    raw_data = raw_data[~seen]
+                stage["rows"] = len(raw_data)
+            print(f"- New transactions since {data_watermark}: {len(raw_data)}")
+            if raw_data.empty:
+                print("Nothing to retrain on, the production model is up to date.")
+                return True
+            if len(raw_data) < min_new_rows:
+                print(f"Less than {min_new_rows} new transactions, retraining skipped until more arrive.")
+                return True
+            if not seen_hashes:
+                new_watermark, watermark_row_hashes = watermark_rows(raw_data)
+            with run_log.stage("preprocess") as stage:
+                preprocessed_data = preprocessor.preprocess(raw_data, inplace=True)
+                stage["rows"] = len(preprocessed_data)
+            with run_log.stage("retrain", rows=len(preprocessed_data)):
+                predictor.retrain_incremental(preprocessed_data, base_version=entry["version"], n_new_estimators=n_new_estimators,
+                                              raw_features=preprocessor.raw_features, data_watermark=new_watermark,
+                                              watermark_row_hashes=watermark_row_hashes)
+
+            print("\n\n========================================================")
+            print("Incremental Training Pipeline Completed Succesfully")
+            print("========================================================")
 
         return True
     except Exception as e:
@@ -33,8 +189,31 @@ def run_training():
         return False
     
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trains a model and saves it in the registry.")
+    parser.add_argument("--text-features", choices=TEXT_FEATURE_MODES, default="tfidf",
+                        help="tfidf: fitted vocabulary. hashing: fixed size hashed features.")
+    parser.add_argument("--search", action="store_true",
+                        help="Search the forest hyperparameters with successive halving.")
+    parser.add_argument("--n-jobs", type=int, default=-1,
+                        help="Processes used for the cross validation folds and the search (-1: all cores).")
+    parser.add_argument("--no-feature-cache", action="store_true",
+                        help="Preprocess the raw data even if its features are cached.")
+    parser.add_argument("--memory-report", action="store_true",
+                        help="Report the peak memory of every preprocessing stage.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Retrain the production model only on the transactions after its data watermark.")
+    parser.add_argument("--new-trees", type=int, default=20,
+                        help="Trees added to the forest by an incremental retraining.")
+    parser.add_argument("--min-new-rows", type=int, default=1000,
+                        help="New transactions needed to run an incremental retraining.")
+    args = parser.parse_args()
+
     start_time = time.time()
-    run_training()
+    if args.incremental:
+        run_incremental_training(n_new_estimators=args.new_trees, min_new_rows=args.min_new_rows)
+    else:
+        run_training(text_features=args.text_features, search=args.search, n_jobs=args.n_jobs,
+                     use_feature_cache=not args.no_feature_cache, memory_report=args.memory_report)
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Elapsed training time: {elapsed_time:.2f} seconds")
\ No newline at end of file
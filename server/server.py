@@ -1,17 +1,189 @@
-from fastapi import FastAPI, BackgroundTasks, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional, Union
+import asyncio
+import time
+from urllib.parse import quote
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse
+from pydantic import BaseModel
 import pandas as pd
 import os
 from pipelines.inference_pipeline import run_inference
 from pipelines.training_pipeline import run_training
+from components.preprocessor import Preprocessor
+from components.classifier import ClassificationPipeline
+from components.batcher import MicroBatcher
+from components.jobs import JobManager
+from components.sinks import read_latest_run_info
+from components.results_index import ResultsIndex, StaleCursorError
+from components.registry import get_registry
+from components.model_pool import ModelPool
+from components.prediction_cache import PredictionCache
+from components.utils.metrics import METRICS
 
-app = FastAPI()
+registry = get_registry()
 
 def model_exists():
-    return any(fname.endswith('.pkl') for fname in os.listdir('registry'))
+    # the registry index is cached, this is a stat of the index file
+    return registry.production_version() is not None
 
 def predictions_exist():
-    return any(fname.endswith('.csv') for fname in os.listdir('outputs'))
+    return read_latest_run_info("predictions") is not None
+
+
+class Transaction(BaseModel):
+    """
+    Raw transaction as received by the realtime inference endpoint. Mirrors the
+    columns of the raw parquet files, without the target category.
+    """
+    account_id: str
+    date: datetime
+    transaction_details: str
+    chq_no: Optional[float] = None
+    value_date: datetime
+    withdrawal_amt: Optional[float] = None
+    deposit_amt: Optional[float] = None
+    balance_amt: Optional[float] = None
+    city: Optional[str] = None
+    device: Optional[str] = None
+
+
+# dtypes of the raw parquet columns, so that JSON nulls end up as NaN and not as None
+NUMERIC_TRANSACTION_COLS = ["chq_no", "withdrawal_amt", "deposit_amt", "balance_amt"]
+
+
+# Micro-batching window for single-row realtime requests
+PREDICT_BATCH_WINDOW_MS = float(os.getenv("PREDICT_BATCH_WINDOW_MS", "2"))
+PREDICT_MAX_BATCH_SIZE = int(os.getenv("PREDICT_MAX_BATCH_SIZE", "64"))
+
+# Training and batch inference run in separate processes, realtime predictions in a thread pool
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "1"))
+PREDICT_THREAD_WORKERS = int(os.getenv("PREDICT_THREAD_WORKERS", "4"))
+
+# Loaded model versions kept warm for realtime inference
+MODEL_POOL_SIZE = int(os.getenv("MODEL_POOL_SIZE", "3"))
+MODEL_POOL_MAX_MB = os.getenv("MODEL_POOL_MAX_MB")
+
+# Cache of realtime predictions of repeated transactions, disabled unless a size is set
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "0"))
+PREDICTION_CACHE_TTL_S = os.getenv("PREDICTION_CACHE_TTL_S")
+
+prediction_cache = None
+if PREDICTION_CACHE_SIZE > 0:
+    prediction_cache = PredictionCache(
+        max_size=PREDICTION_CACHE_SIZE,
+        ttl_seconds=float(PREDICTION_CACHE_TTL_S) if PREDICTION_CACHE_TTL_S else None,
+    )
+
+# TF-IDF rows of transaction_details strings cached between realtime requests
+TEXT_FEATURES_CACHE_SIZE = int(os.getenv("TEXT_FEATURES_CACHE_SIZE", "10000"))
+
+# Small realtime requests are predicted with the compiled model exported with each version
+REALTIME_COMPILED_MODEL = os.getenv("REALTIME_COMPILED_MODEL", "1") == "1"
+
+model_pool = ModelPool(
+    registry,
+    max_models=MODEL_POOL_SIZE,
+    max_bytes=int(float(MODEL_POOL_MAX_MB) * 1e6) if MODEL_POOL_MAX_MB else None,
+    prediction_cache=prediction_cache,
+    text_cache_size=TEXT_FEATURES_CACHE_SIZE,
+    compiled=REALTIME_COMPILED_MODEL,
+)
+
+# Preprocessor kept resident for realtime inference, the transform doesn't depend on the model version
+realtime_components = {}
+
+def get_realtime_preprocessor() -> Preprocessor:
+    if "preprocessor" not in realtime_components:
+        realtime_components["preprocessor"] = Preprocessor()
+    return realtime_components["preprocessor"]
+
+def check_servable(version: Optional[int] = None) -> None:
+    """
+    Raises 503 if there is no model to serve, or 404 if a pinned version doesn't exist.
+    """
+    try:
+        model_pool.check(version)
+    except LookupError as e:
+        raise HTTPException(status_code=503 if version is None else 404, detail=str(e))
+
+def get_realtime_predictor(version: Optional[int] = None) -> ClassificationPipeline:
+    check_servable(version)
+    try:
+        return model_pool.get(version)
+    except LookupError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def predict_transactions(transactions: List[Transaction], version: Optional[int] = None) -> list:
+    """
+    Preprocesses and predicts a list of raw transactions with a single vectorized call.
+    """
+    predictor = get_realtime_predictor(version)
+    preprocessor = get_realtime_preprocessor()
+
+    raw_data = pd.DataFrame([transaction.model_dump() for transaction in transactions])
+    raw_data[NUMERIC_TRANSACTION_COLS] = raw_data[NUMERIC_TRANSACTION_COLS].astype(float)
+    preprocessed_data = preprocessor.transform(raw_data)
+    return predictor.run_realtime_pred(preprocessed_data).tolist()
+
+def predict_batch(items: list) -> list:
+    """
+    Predicts a micro-batch of (version, transaction) items, with one call per model version.
+    """
+    predictions = [None] * len(items)
+    positions_by_version = {}
+    for position, (version, _) in enumerate(items):
+        positions_by_version.setdefault(version, []).append(position)
+
+    for version, positions in positions_by_version.items():
+        version_predictions = predict_transactions([items[position][1] for position in positions], version)
+        for position, prediction in zip(positions, version_predictions):
+            predictions[position] = prediction
+    return predictions
+
+results_index = ResultsIndex("predictions")
+
+job_manager = JobManager(max_workers=JOB_MAX_WORKERS, predict_workers=PREDICT_THREAD_WORKERS)
+
+batcher = MicroBatcher(
+    predict_batch,
+    max_batch_size=PREDICT_MAX_BATCH_SIZE,
+    max_wait_ms=PREDICT_BATCH_WINDOW_MS,
+    executor=job_manager.predict_executor,
+)
+
+# the micro-batcher histograms are exposed at /metrics too
+METRICS.histogram("predict_batch_size", "Rows per micro-batch of the realtime endpoint.").add(batcher.batch_size_histogram)
+METRICS.histogram("predict_queue_wait_ms", "Time single-row requests wait for their micro-batch.").add(batcher.queue_wait_histogram)
+REQUEST_SECONDS = METRICS.histogram("http_request_seconds", "Latency of the HTTP requests, by route and status.")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if model_exists():
+        get_realtime_preprocessor()
+        model_pool.get()
+    job_manager.start()
+    await batcher.start()
+    yield
+    await batcher.stop()
+    job_manager.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    # the route template, so /jobs/{job_id} is a single series
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(
+        method=request.method, route=route.path if route is not None else "unmatched", status=response.status_code,
+    ).observe(time.perf_counter() - start_time)
+    return response
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -42,9 +214,9 @@ async def root():
     return HTMLResponse(content=html_content)
 
 @app.get("/train_model", response_class=HTMLResponse)
-async def train_model(request: Request, background_tasks: BackgroundTasks):
-    # Ejecutar el script de entrenamiento en segundo plano
-    background_tasks.add_task(run_training)
+async def train_model(request: Request):
+    # Ejecutar el script de entrenamiento en un proceso separado
+    job = job_manager.submit("training", run_training)
     
     # Mostrar una página de progreso
     html_content = """
@@ -62,21 +234,22 @@ async def train_model(request: Request, background_tasks: BackgroundTasks):
         <h1>Entrenando el Modelo...</h1>
         <div class="spinner"></div>
         <p>Por favor, espera mientras entrenamos el modelo 🧠</p>
+        <button onclick="fetch('/jobs/JOB_ID/cancel', {method: 'POST'})">Cancelar</button>
         <script>
-            async function checkModel() {
-                const response = await fetch('/check_model');
+            async function checkJob() {
+                const response = await fetch('/jobs/JOB_ID');
                 const data = await response.json();
-                if (data.model_ready) {
+                if (["succeeded", "failed", "cancelled"].includes(data.status)) {
                     window.location.href = "/";
                 } else {
-                    setTimeout(checkModel, 2000);  // Volver a chequear en 5 segundos
+                    setTimeout(checkJob, 2000);  // Volver a chequear en 2 segundos
                 }
             }
-            checkModel();
+            checkJob();
         </script>
     </body>
     </html>
-    """
+    """.replace("JOB_ID", job.job_id)
     return HTMLResponse(content=html_content)
 
 @app.get("/check_model")
@@ -90,9 +263,9 @@ async def check_model():
     return {"preds_ready": preds_ready}
 
 @app.get("/batch_inference", response_class=HTMLResponse)
-async def batch_inference(request: Request, background_tasks: BackgroundTasks):
-    # Ejecutar el script de inferencia en segundo plano
-    background_tasks.add_task(run_inference)
+async def batch_inference(request: Request):
+    # Ejecutar el script de inferencia en un proceso separado
+    job = job_manager.submit("batch_inference", run_inference)
 
     # Mostrar una página de progreso
     html_content = """
@@ -110,31 +283,96 @@ async def batch_inference(request: Request, background_tasks: BackgroundTasks):
         <h1>Realizando Inferencia...</h1>
         <div class="spinner"></div>
         <p>Por favor, espera mientras nuestros modelos piensan 🧠</p>
+        <button onclick="fetch('/jobs/JOB_ID/cancel', {method: 'POST'})">Cancelar</button>
             <script>
-            async function checkModel() {
-                const response = await fetch('/check_predictions');
+            async function checkJob() {
+                const response = await fetch('/jobs/JOB_ID');
                 const data = await response.json();
-                if (data.preds_ready) {
+                if (data.status === "succeeded") {
                     window.location.href = "/inference_results";
+                } else if (["failed", "cancelled"].includes(data.status)) {
+                    window.location.href = "/";
                 } else {
-                    setTimeout(checkModel, 2000);  // Volver a chequear en 5 segundos
+                    setTimeout(checkJob, 2000);  // Volver a chequear en 2 segundos
                 }
             }
-            checkModel();
+            checkJob();
         </script>
     </body>
     </html>
-    """
+    """.replace("JOB_ID", job.job_id)
     return HTMLResponse(content=html_content)
 
+@app.get("/jobs")
+async def list_jobs():
+    return {"jobs": [job.to_dict() for job in job_manager.list_jobs()]}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job.to_dict()
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = await asyncio.get_running_loop().run_in_executor(None, job_manager.cancel, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job.to_dict()
+
+def query_results(offset: int, limit: int, cursor: Optional[str], columns: Optional[str], category: Optional[str]) -> dict:
+    """
+    Queries a page of the latest inference results, translating errors into HTTP errors.
+    """
+    if offset < 0 or not 0 < limit <= 1000:
+        raise HTTPException(status_code=400, detail="offset must be >= 0 and limit between 1 and 1000.")
+    try:
+        page = results_index.query(
+            offset=offset,
+            limit=limit,
+            cursor=cursor,
+            columns=columns.split(",") if columns else None,
+            category=category,
+        )
+    except StaleCursorError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if page is None:
+        raise HTTPException(status_code=404, detail="There are no inference results yet.")
+    return page
+
+@app.get("/api/inference_results")
+def api_inference_results(
+        offset: int = 0,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        columns: Optional[str] = None,
+        category: Optional[str] = None,
+    ):
+    """
+    Paginated inference results. Supports offset or cursor pagination, column projection
+    (comma separated list of columns) and filtering by predicted category.
+    """
+    return query_results(offset, limit, cursor, columns, category)
+
 @app.get("/inference_results", response_class=HTMLResponse)
-async def inference_results(request: Request):
-    # Leer el archivo de resultados
-    cwd = os.getcwd()
-    results_df = pd.read_csv(f"{cwd}/outputs/predictions.csv")
+def inference_results(request: Request, offset: int = 0, limit: int = 100, category: Optional[str] = None):
+    # Leer una página de los resultados desde el índice en memoria
+    page = query_results(offset, limit, None, None, category)
 
     # Convertir los resultados a HTML
-    results_html = results_df.to_html(index=False, classes="table table-striped")
+    results_html = pd.DataFrame(page["rows"]).to_html(index=False, classes="table table-striped")
+
+    # Links de paginado
+    category_param = f"&category={quote(category)}" if category else ""
+    pagination = f"Filas {page['offset'] + 1} a {page['offset'] + len(page['rows'])} de {page['total']}"
+    if offset > 0:
+        pagination += f' | <a href="/inference_results?offset={max(0, offset - limit)}&limit={limit}{category_param}">Anterior</a>'
+    if page["next_cursor"] is not None:
+        pagination += f' | <a href="/inference_results?offset={offset + limit}&limit={limit}{category_param}">Siguiente</a>'
 
     # Crear una página HTML sencilla para mostrar los resultados
     html_content = f"""
@@ -155,6 +393,7 @@ async def inference_results(request: Request):
     <body>
         <h1>Prediccion de categorias de transacciones</h1>
         <h2>Predicciones en la última columna</h2>
+        <div>{pagination}</div>
         <div>{results_html}</div>
     </body>
     </html>
@@ -163,7 +402,7 @@ async def inference_results(request: Request):
 
 @app.get("/realtime_inference", response_class=HTMLResponse)
 async def realtime_inference():
-    # Mostrar una página de "Todavía en construcción"
+    # Página simple para probar el endpoint POST /predict
     html_content = """
     <!DOCTYPE html>
     <html>
@@ -171,19 +410,109 @@ async def realtime_inference():
         <title>Real-Time Inference</title>
         <style>
             body { font-family: Arial, sans-serif; text-align: center; padding: 50px; }
-            .construction { margin: 100px auto; width: 50px; height: 50px; border: 5px solid #ccc; border-top: 5px solid #ff5733; border-radius: 50%; animation: spin 1s linear infinite; }
-            @keyframes spin { 100% { transform: rotate(360deg); } }
+            textarea { width: 80%; height: 250px; font-family: monospace; }
+            pre { text-align: left; margin: 20px auto; width: 80%; background-color: #f4f4f4; padding: 10px; }
         </style>
     </head>
     <body>
         <h1>Real-Time Inference</h1>
-        <h1>🛠️</h1>
-        <p>Esta funcionalidad está todavía en construcción. Vuelve Pronto!</p>
+        <p>Envia una transaccion (o una lista de ellas) en formato JSON al endpoint <code>POST /predict</code></p>
+        <textarea id="payload">{
+    "account_id": "409000611074",
+    "date": "2017-06-29",
+    "transaction_details": "TRF FROM  Indiaforensic SERVICES",
+    "value_date": "2017-06-29",
+    "withdrawal_amt": null,
+    "deposit_amt": 1000000.0,
+    "balance_amt": 1000000.0,
+    "city": "New York",
+    "device": "Tablet"
+}</textarea>
+        <div><button onclick="predict()">Predecir</button></div>
+        <pre id="result"></pre>
+        <script>
+            async function predict() {
+                const response = await fetch('/predict', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: document.getElementById('payload').value
+                });
+                const data = await response.json();
+                document.getElementById('result').textContent = JSON.stringify(data, null, 2);
+            }
+        </script>
     </body>
     </html>
     """
     return HTMLResponse(content=html_content)
 
+@app.post("/predict")
+async def predict(transactions: Union[Transaction, List[Transaction]], version: Optional[int] = None):
+    """
+    Realtime inference over one or many raw transactions. Uses the resident model and
+    the lean preprocessing path, so no registry access nor QA reports happen per request.
+    Single transactions are coalesced with concurrent requests by the micro-batcher.
+    The production model is used unless a registry version is pinned with ?version=N.
+    """
+    if isinstance(transactions, Transaction):
+        transactions = [transactions]
+    if not transactions:
+        return {"predictions": []}
+
+    # fail fast instead of queueing requests that can't be served
+    check_servable(version)
+
+    if len(transactions) == 1:
+        prediction = await batcher.submit((version, transactions[0]))
+        return {"predictions": [prediction]}
+
+    loop = asyncio.get_running_loop()
+    predictions = await loop.run_in_executor(job_manager.predict_executor, predict_transactions, transactions, version)
+    return {"predictions": predictions}
+
+@app.get("/predict/stats")
+async def predict_stats():
+    """
+    Batch-size and queue-wait histograms of the realtime micro-batcher, and the hit rate of
+    the prediction cache.
+    """
+    stats = batcher.stats()
+    stats["prediction_cache"] = prediction_cache.stats() if prediction_cache is not None else None
+    return stats
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Metrics of the server process in the Prometheus text format: request latencies, model
+    load and predict times, rows predicted, preprocessing stages and micro-batches. Training
+    and batch inference run in job processes, their timings are in outputs/run_log.jsonl.
+    """
+    return PlainTextResponse(METRICS.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/models")
+async def list_models():
+    """
+    Models in the registry, and the versions loaded in the server.
+    """
+    index = registry.refresh()
+    models = [
+        {key: value for key, value in entry.items() if key not in ("features", "raw_features")}
+        for entry in sorted(index["models"].values(), key=lambda entry: entry["version"])
+    ]
+    return {"production_version": index["production_version"], "models": models, "pool": model_pool.stats()}
+
+@app.post("/models/{version}/promote")
+async def promote_model(version: int):
+    """
+    Promotes a model version to production (e.g. to roll back). The server keeps serving the
+    previous model until the promoted one is loaded.
+    """
+    try:
+        registry.promote(version)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"production_version": version}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,72 @@
+import itertools
+import threading
+import time
+import pytest
+from components.pipeline_runner import StagedPipeline, Stage
+
+
+def _collector(results: list) -> Stage:
+    return Stage("collect", results.append)
+
+
+def _stage_threads() -> list:
+    return [thread for thread in threading.enumerate() if thread.name.startswith("stage")]
+
+
+def test_multi_worker_stage_keeps_input_order():
+    def slow(item):
+        # later items finish first
+        time.sleep(0.002 * (20 - item))
+        return item * 10
+
+    results = []
+    pipeline = StagedPipeline([Stage("slow", slow, workers=4), _collector(results)], queue_size=2)
+    report = pipeline.run(range(20))
+
+    assert results == [item * 10 for item in range(20)]
+    assert [stage["items"] for stage in report["stages"]] == [20, 20, 20]
+
+
+def test_stage_exception_is_raised_and_stops_the_pipeline():
+    def fail_on_five(item):
+        if item == 5:
+            raise ValueError("bad chunk")
+        return item
+
+    results = []
+    pipeline = StagedPipeline([Stage("fail", fail_on_five, workers=2), _collector(results)], queue_size=1)
+    with pytest.raises(ValueError, match="bad chunk"):
+        # the source would never end on its own
+        pipeline.run(itertools.count())
+
+    assert 5 not in results
+    assert not _stage_threads()
+
+
+def test_source_exception_is_raised():
+    def source():
+        yield 1
+        raise RuntimeError("read failed")
+
+    with pytest.raises(RuntimeError, match="read failed"):
+        StagedPipeline([Stage("identity", lambda item: item)]).run(source())
+    assert not _stage_threads()
+
+
+def test_none_results_are_dropped():
+    seen = []
+
+    def odd_only(item):
+        return item if item % 2 else None
+
+    def record(item):
+        seen.append(item)
+        return item
+
+    results = []
+    pipeline = StagedPipeline([Stage("filter", odd_only, workers=3), Stage("record", record), _collector(results)])
+    report = pipeline.run(range(10))
+
+    assert seen == [1, 3, 5, 7, 9]
+    assert results == [1, 3, 5, 7, 9]
+    assert [stage["items"] for stage in report["stages"]] == [10, 10, 5, 5]